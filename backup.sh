@@ -8,14 +8,15 @@ DATE=$(date +%Y%m%d_%H%M%S)
 # 创建备份目录
 mkdir -p "$BACKUP_DIR"
 
-# 备份数据库
-cp "$PROJECT_DIR/chat.db" "$BACKUP_DIR/chat_$DATE.db"
+# 数据库和上传文件由服务器在线备份（CHAT_BACKUP_FOLDER，管理员也可以用 /backup 命令触发），
+# 运行中直接复制 chat.db 可能得到不一致的文件，这里只备份项目文件
+tar -czf "$BACKUP_DIR/chat_$DATE.tar.gz" \
+    --exclude='chat.db*' --exclude='chat_bus.db*' --exclude='static/uploads' \
+    --exclude='uploads_tmp' --exclude='venv' --exclude='backups' \
+    "$PROJECT_DIR"
 
-# 备份项目文件
-tar -czf "$BACKUP_DIR/chat_$DATE.tar.gz" "$PROJECT_DIR"
-
-# 删除7天前的备份
-find "$BACKUP_DIR" -type f -mtime +7 -delete
+# 删除7天前的项目文件备份（服务器的备份目录按份数轮换，不在这里删除）
+find "$BACKUP_DIR" -maxdepth 1 -type f -name 'chat_*.tar.gz' -mtime +7 -delete
 
 # 输出结果
 echo "备份完成: $BACKUP_DIR/chat_$DATE.tar.gz"
\ No newline at end of file
@@ -0,0 +1,488 @@
+"""聊天服务压测：模拟多个用户登录并通过 Socket.IO 收发消息，统计吞吐量、端到端延迟和服务器资源占用
+
+默认在临时目录中启动一个使用全新数据库的服务器进程，压测结束后自动关闭；
+结果以 JSON 输出，可以保存下来与之后的结果比较。
+
+场景：
+    connect_storm  所有用户同时建立连接
+    steady         每个用户按固定速率持续发送消息
+    burst          每个用户同时连续发送一批消息
+    upload         并发上传文件
+
+用法（需要 pip install requests websocket-client）：
+    python bench/chat_bench.py --users 50 --output result.json
+    python bench/chat_bench.py --async-mode gevent --scenarios steady,burst
+    python bench/chat_bench.py --url http://127.0.0.1:5000      # 压测已在运行的服务（不统计服务器资源）
+    python bench/chat_bench.py --baseline result.json           # 与之前的结果比较，有退步时返回 1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+import socketio
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOM = 'chat_room'
+SCENARIOS = ('connect_storm', 'steady', 'burst', 'upload')
+
+# 与基线比较的指标：(场景, 指标路径, 越大越好)
+COMPARED_METRICS = (
+    ('connect_storm', ('connect_ms', 'p95'), False),
+    ('connect_storm', ('connections_per_second',), True),
+    ('steady', ('latency_ms', 'p50'), False),
+    ('steady', ('latency_ms', 'p99'), False),
+    ('steady', ('deliveries_per_second',), True),
+    ('burst', ('latency_ms', 'p99'), False),
+    ('burst', ('deliveries_per_second',), True),
+    ('upload', ('latency_ms', 'p95'), False),
+    ('upload', ('megabytes_per_second',), True),
+)
+
+
+def percentiles(samples):
+    """毫秒为单位的延迟分布"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def pick(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 2)
+
+    return {
+        'count': len(samples),
+        'mean': round(sum(samples) / len(samples) * 1000, 2),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(samples[-1] * 1000, 2),
+    }
+
+
+class ServerProcess:
+    """在临时目录中启动服务器（全新的数据库和上传目录）"""
+
+    def __init__(self, async_mode, port=None):
+        self.async_mode = async_mode
+        self.port = port or self._free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.workdir = tempfile.mkdtemp(prefix='chat_bench_')
+        self.process = None
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    def start(self, timeout=30):
+        env = dict(os.environ, CHAT_ASYNC_MODE=self.async_mode,
+                   PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+        # 压测会超过正常用户的限流额度，关闭消息和上传限流
+        code = ('import server.app as chat_app\n'
+                'from server.app import app, socketio, ChatManager\n'
+                'ChatManager.MESSAGE_RATE = ChatManager.MESSAGE_USER_RATE = chat_app.UPLOAD_RATE = (1e9, 1e9)\n'
+                f'socketio.run(app, host="127.0.0.1", port={self.port}, allow_unsafe_werkzeug=True)')
+        self.log = open(os.path.join(self.workdir, 'server.log'), 'wb')
+        self.process = subprocess.Popen([sys.executable, '-c', code], cwd=self.workdir, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'服务器启动失败，日志见 {self.log.name}')
+            try:
+                requests.get(f'{self.url}/login', timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise RuntimeError('等待服务器启动超时')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class ProcessMonitor:
+    """通过 /proc 采样进程的 CPU 时间和内存占用（仅 Linux）"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.rss_peak = 0
+        self._ticks = os.sysconf('SC_CLK_TCK')
+        self._running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self._ticks  # utime + stime
+
+    def rss(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    self.rss_peak = max(self.rss_peak, rss)
+                    return rss
+        return 0
+
+    def _run(self):
+        while self._running:
+            try:
+                self.rss()
+            except OSError:
+                return
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+
+
+class LatencyRecorder:
+    """按消息内容中的发送时间计算端到端延迟（发送和接收都在本进程中，使用同一个时钟）"""
+
+    def __init__(self):
+        self.tag = None
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def reset(self, tag):
+        with self._lock:
+            self.tag = tag
+            self.samples = []
+
+    def text(self):
+        return f'bench:{self.tag}:{time.perf_counter():.6f}'
+
+    def receive(self, messages):
+        now = time.perf_counter()
+        latencies = []
+        for message in messages:
+            parts = message.get('text', '').split(':')
+            if len(parts) == 3 and parts[0] == 'bench' and parts[1] == self.tag:
+                latencies.append(now - float(parts[2]))
+        if latencies:
+            with self._lock:
+                self.samples.extend(latencies)
+
+    def count(self):
+        with self._lock:
+            return len(self.samples)
+
+
+class BenchUser:
+    """一个模拟用户：HTTP 会话（登录状态）加一个 Socket.IO 连接"""
+
+    def __init__(self, url, username, password, recorder):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.recorder = recorder
+        self.session = requests.Session()
+        self.client = None
+
+    def login(self):
+        self.session.post(f'{self.url}/register', data={'username': self.username, 'password': self.password})
+        response = self.session.post(f'{self.url}/login', allow_redirects=False,
+                                     data={'username': self.username, 'password': self.password})
+        if response.status_code != 302 or 'login' in response.headers.get('Location', ''):
+            raise RuntimeError(f'{self.username} 登录失败')
+
+    def connect(self):
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('message', lambda message: self.recorder.receive([message]))
+        self.client.on('messages', lambda data: self.recorder.receive(data['messages']))
+        cookie = '; '.join(f'{k}={v}' for k, v in self.session.cookies.items())
+        self.client.connect(self.url, headers={'Cookie': cookie}, transports=['websocket'])
+
+    def send(self):
+        self.client.emit('message', {'text': self.recorder.text(), 'room': ROOM})
+
+    def disconnect(self):
+        if self.client is not None:
+            self.client.disconnect()
+            self.client = None
+
+
+def wait_for_deliveries(recorder, expected, timeout):
+    """等待所有消息送达，超时后按已收到的数量统计"""
+    deadline = time.perf_counter() + timeout
+    while recorder.count() < expected and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+
+def run_connect_storm(users, args):
+    """所有用户同时建立连接"""
+    barrier = threading.Barrier(len(users))
+
+    def connect(user):
+        barrier.wait()
+        started = time.perf_counter()
+        user.connect()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies, failed = [], 0
+    with ThreadPoolExecutor(len(users)) as pool:
+        for future in [pool.submit(connect, user) for user in users]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                failed += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'connections': len(latencies),
+        'failed': failed,
+        'duration': round(elapsed, 3),
+        'connections_per_second': round(len(latencies) / elapsed, 1),
+        'connect_ms': percentiles(latencies),
+    }
+
+
+def _delivery_result(recorder, sent, receivers, elapsed):
+    expected = sent * receivers
+    delivered = recorder.count()
+    return {
+        'sent': sent,
+        'delivered': delivered,
+        'lost': max(0, expected - delivered),
+        'duration': round(elapsed, 3),
+        'messages_per_second': round(sent / elapsed, 1),
+        'deliveries_per_second': round(delivered / elapsed, 1),
+        'latency_ms': percentiles(recorder.samples),
+    }
+
+
+def run_steady(users, recorder, args):
+    """每个用户按 --rate 条/秒持续发送 --duration 秒"""
+    recorder.reset('steady')
+    interval = 1.0 / args.rate
+    sent = []
+
+    def send_loop(user):
+        # 各用户错开起始时间，避免每个周期的消息同时到达
+        next_at = time.perf_counter() + random.random() * interval
+        deadline = time.perf_counter() + args.duration
+        count = 0
+        while next_at < deadline:
+            time.sleep(max(0, next_at - time.perf_counter()))
+            user.send()
+            count += 1
+            next_at += interval
+        return count
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(len(users)) as pool:
+        sent = sum(pool.map(send_loop, users))
+    wait_for_deliveries(recorder, sent * len(users), args.drain_timeout)
+    return _delivery_result(recorder, sent, len(users), time.perf_counter() - started)
+
+
+def run_burst(users, recorder, args):
+    """每个用户同时连续发送 --burst-size 条消息"""
+    recorder.reset('burst')
+    barrier = threading.Barrier(len(users))
+
+    def send_burst(user):
+        barrier.wait()
+        for _ in range(args.burst_size):
+            user.send()
+        return args.burst_size
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(len(users)) as pool:
+        sent = sum(pool.map(send_burst, users))
+    wait_for_deliveries(recorder, sent * len(users), args.drain_timeout)
+    return _delivery_result(recorder, sent, len(users), time.perf_counter() - started)
+
+
+def run_upload(users, args):
+    """--upload-concurrency 个用户并发上传共 --uploads 个随机内容的文件（内容不同，不会被去重）"""
+    size = int(args.upload_size * 1024 * 1024)
+
+    def upload(i):
+        user = users[i % len(users)]
+        data = os.urandom(size)
+        started = time.perf_counter()
+        response = user.session.post(f'{user.url}/upload', data={'room': ROOM},
+                                     files={'file': (f'bench_{i}.zip', data)})
+        if response.status_code != 200:
+            raise RuntimeError(response.text)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies, failed = [], 0
+    with ThreadPoolExecutor(args.upload_concurrency) as pool:
+        for future in [pool.submit(upload, i) for i in range(args.uploads)]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                failed += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'uploads': len(latencies),
+        'failed': failed,
+        'file_size': size,
+        'duration': round(elapsed, 3),
+        'megabytes_per_second': round(len(latencies) * size / elapsed / 1024 / 1024, 2),
+        'latency_ms': percentiles(latencies),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'未知的场景: {", ".join(sorted(unknown))}')
+
+    server = monitor = None
+    url = args.url
+    if not url:
+        server = ServerProcess(args.async_mode)
+        server.start()
+        url = server.url
+        monitor = ProcessMonitor(server.process.pid)
+
+    recorder = LatencyRecorder()
+    prefix = f'bench_{uuid.uuid4().hex[:6]}'
+    users = [BenchUser(url, f'{prefix}_{i}', 'bench-password', recorder) for i in range(args.users)]
+    result = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'async_mode': args.async_mode if server else None,
+            'url': url,
+            'users': args.users,
+            'args': vars(args),
+        },
+        'scenarios': {},
+    }
+    try:
+        with ThreadPoolExecutor(min(16, len(users))) as pool:
+            list(pool.map(BenchUser.login, users))
+        if 'connect_storm' not in scenarios:
+            with ThreadPoolExecutor(min(16, len(users))) as pool:
+                list(pool.map(BenchUser.connect, users))
+
+        for name in scenarios:
+            cpu_before = monitor.cpu_seconds() if monitor else None
+            started = time.perf_counter()
+            if name == 'connect_storm':
+                stats = run_connect_storm(users, args)
+            elif name == 'steady':
+                stats = run_steady(users, recorder, args)
+            elif name == 'burst':
+                stats = run_burst(users, recorder, args)
+            else:
+                stats = run_upload(users, args)
+            if monitor:
+                elapsed = time.perf_counter() - started
+                stats['server'] = {
+                    'cpu_percent': round((monitor.cpu_seconds() - cpu_before) / elapsed * 100, 1),
+                    'rss_mb': round(monitor.rss() / 1024 / 1024, 1),
+                }
+            result['scenarios'][name] = stats
+            print(f'{name}: {json.dumps(stats, ensure_ascii=False)}', file=sys.stderr)
+
+        if monitor:
+            result['server'] = {
+                'cpu_seconds': round(monitor.cpu_seconds(), 2),
+                'rss_peak_mb': round(monitor.rss_peak / 1024 / 1024, 1),
+            }
+    finally:
+        for user in users:
+            try:
+                user.disconnect()
+            except Exception:
+                pass
+        if monitor:
+            monitor.stop()
+        if server:
+            server.stop()
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """与基线比较主要指标，返回退步超过 tolerance（比例）的指标说明列表"""
+    regressions = []
+    for scenario, path, higher_is_better in COMPARED_METRICS:
+        current, previous = result['scenarios'].get(scenario), baseline.get('scenarios', {}).get(scenario)
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        name = f"{scenario}.{'.'.join(path)}"
+        print(f'{name}: {previous} -> {current} ({change:+.1%})', file=sys.stderr)
+        if worse > tolerance:
+            regressions.append(f'{name} 退步 {worse:.1%}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天服务压测')
+    parser.add_argument('--url', help='压测已在运行的服务，不指定时在临时目录中启动服务器')
+    parser.add_argument('--async-mode', default='threading', choices=('threading', 'gevent'),
+                        help='启动服务器时使用的并发模式')
+    parser.add_argument('--users', type=int, default=20, help='模拟用户数')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔的场景，按顺序执行')
+    parser.add_argument('--rate', type=float, default=1.0, help='steady 场景每个用户每秒发送的消息数')
+    parser.add_argument('--duration', type=float, default=10.0, help='steady 场景持续时间（秒）')
+    parser.add_argument('--burst-size', type=int, default=20, help='burst 场景每个用户发送的消息数')
+    parser.add_argument('--uploads', type=int, default=20, help='upload 场景上传的文件数')
+    parser.add_argument('--upload-size', type=float, default=1.0, help='上传文件大小（MB）')
+    parser.add_argument('--upload-concurrency', type=int, default=4, help='同时上传的文件数')
+    parser.add_argument('--drain-timeout', type=float, default=10.0, help='发送结束后等待消息送达的最长时间（秒）')
+    parser.add_argument('--output', help='结果 JSON 文件，不指定时输出到标准输出')
+    parser.add_argument('--baseline', help='与之前保存的结果 JSON 比较')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的退步比例')
+    args = parser.parse_args()
+
+    result = run(args)
+    body = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print('性能退步:\n' + '\n'.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,15 @@ sudo apt-get install -y python3 python3-pip python3-venv nginx
 
 # 创建项目目录
 PROJECT_DIR=/var/www/chat
+# 应用进程数，进程之间通过消息总线（chat_bus.db）共享广播和在线状态
+WORKERS=4
+PORTS=$(seq 5000 $((5000 + WORKERS - 1)))
 sudo mkdir -p $PROJECT_DIR
 sudo chown -R $USER:$USER $PROJECT_DIR
+# 服务器在线备份目录（每天一份，保留最近 7 份）
+BACKUP_DIR=/var/backups/chat/snapshots
+sudo mkdir -p $BACKUP_DIR
+sudo chown -R $USER:$USER $BACKUP_DIR
 
 # 创建并激活虚拟环境
 python3 -m venv $PROJECT_DIR/venv
@@ -16,10 +23,10 @@ source $PROJECT_DIR/venv/bin/activate
 # 安装项目依赖
 pip install -r requirements.txt
 
-# 创建 systemd 服务文件
-sudo tee /etc/systemd/system/chat.service << EOF
+# 创建 systemd 服务模板，实例名即监听端口（chat@5000、chat@5001 ...）
+sudo tee /etc/systemd/system/chat@.service << EOF
 [Unit]
-Description=Chat Application
+Description=Chat Application (port %i)
 After=network.target
 
 [Service]
@@ -27,21 +34,40 @@ User=$USER
 Group=$USER
 WorkingDirectory=$PROJECT_DIR
 Environment="PATH=$PROJECT_DIR/venv/bin"
-ExecStart=$PROJECT_DIR/venv/bin/python -m server.app
+Environment="CHAT_PORT=%i"
+Environment="CHAT_MESSAGE_BUS=sqlite"
+Environment="CHAT_ASYNC_MODE=gevent"
+Environment="CHAT_X_ACCEL_PREFIX=/_uploads/"
+Environment="CHAT_BACKUP_FOLDER=$BACKUP_DIR"
+Environment="CHAT_BACKUP_INTERVAL=86400"
+Environment="CHAT_ARCHIVE_AFTER_DAYS=90"
+LimitNOFILE=65536
+ExecStart=$PROJECT_DIR/venv/bin/python -m server
 Restart=always
 
 [Install]
 WantedBy=multi-user.target
 EOF
 
-# 配置 Nginx
+UPSTREAM_SERVERS=""
+for PORT in $PORTS; do
+    UPSTREAM_SERVERS="$UPSTREAM_SERVERS    server 127.0.0.1:$PORT;
+"
+done
+
+# 配置 Nginx（ip_hash 让同一客户端始终落到同一进程，Socket.IO 长轮询需要粘性会话）
 sudo tee /etc/nginx/sites-available/chat << EOF
+upstream chat_backend {
+    ip_hash;
+$UPSTREAM_SERVERS}
+
 server {
     listen 80;
     server_name your_domain.com;  # 替换为您的域名
+    client_max_body_size 100m;  # 与 MAX_CONTENT_LENGTH 一致
 
     location / {
-        proxy_pass http://127.0.0.1:5000;
+        proxy_pass http://chat_backend;
         proxy_http_version 1.1;
         proxy_set_header Upgrade \$http_upgrade;
         proxy_set_header Connection "upgrade";
@@ -49,9 +75,21 @@ server {
         proxy_set_header X-Real-IP \$remote_addr;
         proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
     }
+
+    # /files/<id> 鉴权后通过 X-Accel-Redirect 交给 Nginx 直接发送文件（支持 Range，零拷贝）
+    location /_uploads/ {
+        internal;
+        alias $PROJECT_DIR/static/uploads/;
+        sendfile on;
+        etag off;
+        add_header ETag \$upstream_http_etag;
+    }
 }
 EOF
 
+# 调高 Nginx 单进程连接数上限，以承载大量 WebSocket 长连接
+sudo sed -i 's/worker_connections [0-9]*;/worker_connections 20000;/' /etc/nginx/nginx.conf
+
 # 启用 Nginx 配置
 sudo ln -s /etc/nginx/sites-available/chat /etc/nginx/sites-enabled/
 sudo rm -f /etc/nginx/sites-enabled/default
@@ -60,8 +98,10 @@ sudo systemctl restart nginx
 
 # 启动服务
 sudo systemctl daemon-reload
-sudo systemctl enable chat
-sudo systemctl start chat
+for PORT in $PORTS; do
+    sudo systemctl enable chat@$PORT
+    sudo systemctl start chat@$PORT
+done
 
 # 显示状态
-sudo systemctl status chat
\ No newline at end of file
+sudo systemctl status "chat@*"
\ No newline at end of file
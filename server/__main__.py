@@ -0,0 +1,6 @@
+# 服务入口：python -m server
+# 缩略图进程池的子进程以 spawn 方式启动，会重新导入主模块；
+# 主模块是包的 __main__ 时 multiprocessing 不会重新执行它，子进程中不会再次初始化数据库、Socket.IO 等
+from server.app import main
+
+main()
@@ -1,12 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from server.engine import ASYNC_MODE  # 必须最先导入：gevent 模式需要在其他模块之前打补丁
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, abort
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from server.database import Database
 import json
 from server.chat import ChatManager
+from server.persistence import MessageWriter
+from server.cache import TTLCache
+from server.bus import SQLiteBusManager
+from server.uploads import UploadManager
+from server.storage import ContentStore
+from server.thumbnails import ThumbnailService
+from server.profiler import SamplingProfiler
+from server.ratelimit import RateLimiter
+from server.backup import BackupService
+from server.archive import MessageArchive
+from server import engine, metrics
 import os
+import atexit
+import hmac
+import mimetypes
 from werkzeug.utils import secure_filename
 from datetime import datetime
+from urllib.parse import quote
 
 app = Flask(__name__, 
     static_folder='../static',  # 指定静态文件夹的路径
@@ -14,13 +30,75 @@ app = Flask(__name__,
 )
 
 app.config['SECRET_KEY'] = 'your-secret-key'  # 请更改为随机字符串
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+
+# 多进程部署：CHAT_MESSAGE_BUS=sqlite 时各进程通过共享的总线数据库交换广播、在线状态和管理操作
+MESSAGE_BUS = os.environ.get('CHAT_MESSAGE_BUS', '')
+MESSAGE_BUS_FILE = os.environ.get('CHAT_MESSAGE_BUS_FILE', 'chat_bus.db')
+message_bus = SQLiteBusManager(MESSAGE_BUS_FILE) if MESSAGE_BUS == 'sqlite' else None
+
+socketio_options = {'client_manager': message_bus} if message_bus else {}
+# 并发模型由 CHAT_ASYNC_MODE 选择（见 server.engine），生产环境建议使用 'gevent'
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, **socketio_options)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-db = Database()
-chat_manager = ChatManager(socketio, db)
+# 消息持久化配置：'async' 为异步批量落盘，'sync' 为提交后再广播
+MESSAGE_DURABILITY = 'async'
+MESSAGE_BATCH_SIZE = 100
+MESSAGE_FLUSH_INTERVAL = 0.05  # 秒
+
+# 消息归档：早于 ARCHIVE_AFTER_DAYS 天的消息每隔 ARCHIVE_INTERVAL 秒移入 ARCHIVE_FOLDER 下按月分区的压缩分段文件，
+# 数据库只保留近期消息；历史记录和搜索会继续读取归档。0 为不归档
+ARCHIVE_FOLDER = os.environ.get('CHAT_ARCHIVE_FOLDER', 'archive')
+ARCHIVE_AFTER_DAYS = float(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', 0))
+ARCHIVE_INTERVAL = 3600  # 秒
+
+db = Database(archive=MessageArchive(ARCHIVE_FOLDER))
+if ARCHIVE_AFTER_DAYS > 0:
+    db.start_archiver(ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL)
+message_id_allocator = None
+if message_bus:
+    # 多进程时消息 ID 由总线数据库统一分配，保证全局递增
+    message_bus.seed_sequence('messages', db.get_last_message_id())
+    message_id_allocator = lambda: message_bus.next_value('messages')
+message_writer = MessageWriter(db, durability=MESSAGE_DURABILITY,
+                               batch_size=MESSAGE_BATCH_SIZE,
+                               flush_interval=MESSAGE_FLUSH_INTERVAL,
+                               id_allocator=message_id_allocator)
+atexit.register(message_writer.close)  # 退出前把队列中的消息写完
+# 批量广播：同一房间在 BROADCAST_BATCH_DELAY 秒内的消息合并为一个 messages 事件，0 表示逐条发送
+BROADCAST_BATCH_DELAY = 0.005
+BROADCAST_BATCH_SIZE = 50
+# 采样分析器：管理员通过 /profile 命令或 /profile 接口启停，结果写入 PROFILE_FOLDER
+PROFILE_FOLDER = 'profiles'
+PROFILE_INTERVAL = 0.01      # 采样间隔（秒）
+PROFILE_MAX_DURATION = 300   # 单次采样最长时间（秒），到期自动停止
+profiler = SamplingProfiler(PROFILE_FOLDER, interval=PROFILE_INTERVAL, max_duration=PROFILE_MAX_DURATION)
+if message_bus:
+    # 先记录总线位置再预热消息缓冲区：预热期间其他进程广播的消息在监听线程启动后补上
+    message_bus.mark_position()
+chat_manager = ChatManager(socketio, db, message_writer, bus=message_bus,
+                           batch_delay=BROADCAST_BATCH_DELAY, batch_size=BROADCAST_BATCH_SIZE,
+                           profiler=profiler)
+db.start_search_backfill()  # 为建立全文索引之前的历史消息补建索引
+
+# 已登录用户对象缓存，避免每个请求和每次 Socket.IO 连接都查询数据库
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300  # 秒
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+db.add_user_listener(user_cache.invalidate)  # 禁言、封禁状态变化时立即失效
+
+if message_bus:
+    # 用户状态变化同步到其他进程的禁言/封禁缓存和用户缓存
+    def _on_remote_user_changed(payload):
+        db.reload_user_moderation(payload['user_id'])
+        user_cache.invalidate(payload['user_id'])
+
+    db.add_user_listener(lambda user_id: message_bus.publish_event('user_changed', {'user_id': user_id}))
+    message_bus.subscribe('user_changed', _on_remote_user_changed)
+    message_bus.initialize()
+    atexit.register(message_bus.shutdown)
 
 # 修改文件上传配置
 UPLOAD_FOLDER = 'static/uploads'
@@ -30,6 +108,85 @@ MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB 最大限制
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH  # 设置 Flask 的最大文件大小限制
 
+# 分片断点续传：未完成的上传保存在临时目录（不对外提供访问）
+UPLOAD_TEMP_FOLDER = 'uploads_tmp'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+# 上传文件按内容哈希保存在 static/uploads/objects/ 下，相同内容只保存一份
+content_store = ContentStore(UPLOAD_FOLDER, UPLOAD_TEMP_FOLDER)
+upload_manager = UploadManager(UPLOAD_TEMP_FOLDER, MAX_CONTENT_LENGTH, UPLOAD_CHUNK_SIZE)
+
+# 图片缩略图在后台进程池中生成（需要安装 Pillow），缓存在 static/uploads/thumbs/ 下
+THUMBNAIL_WORKERS = 2
+thumbnail_service = ThumbnailService(UPLOAD_FOLDER, workers=THUMBNAIL_WORKERS)
+atexit.register(thumbnail_service.close)
+
+# 在线备份：数据库一致性快照和上传文件增量备份保存在 BACKUP_FOLDER 下，保留最近 BACKUP_KEEP 份
+# 每隔 BACKUP_INTERVAL 秒自动备份（0 为只通过 /backup 命令备份），多个进程共用备份目录时只有一个进程执行
+BACKUP_FOLDER = os.environ.get('CHAT_BACKUP_FOLDER', 'backups')
+BACKUP_INTERVAL = float(os.environ.get('CHAT_BACKUP_INTERVAL', 0))
+BACKUP_KEEP = 7
+backup_service = BackupService(db.db_file, UPLOAD_FOLDER, BACKUP_FOLDER, keep=BACKUP_KEEP, interval=BACKUP_INTERVAL,
+                               archive_root=ARCHIVE_FOLDER)
+backup_service.schedule()
+chat_manager.backup = backup_service
+
+# 上传限流（令牌桶，按用户）：(每秒次数, 最多连续次数)，分片上传只在 /upload/init 时计数
+UPLOAD_RATE = (0.2, 5)
+ADMIN_UPLOAD_RATE = (1, 20)
+upload_limiter = RateLimiter('upload_user')
+
+def allow_upload():
+    rate = ADMIN_UPLOAD_RATE if current_user.is_admin else UPLOAD_RATE
+    return upload_limiter.allow(current_user.id, *rate)
+
+# 文件下载：/files/<id> 对应的内容不会变化，可以长期缓存
+DOWNLOAD_MAX_AGE = 365 * 24 * 3600
+# 设置后由 Nginx 通过 X-Accel-Redirect 直接发送文件（零拷贝），值为 Nginx 中对应 UPLOAD_FOLDER 的 internal location
+X_ACCEL_PREFIX = os.environ.get('CHAT_X_ACCEL_PREFIX', '')
+INLINE_FILETYPES = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'txt'}  # 浏览器中直接打开，其他类型作为附件下载
+
+# 监控指标：/metrics 以 Prometheus 文本格式导出，管理员登录后访问，
+# 或者带上 Authorization: Bearer <CHAT_METRICS_TOKEN>（供 Prometheus 抓取）
+METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN', '')
+UPLOADS_TOTAL = metrics.counter('chat_uploads_total', '上传完成的文件数', ['deduplicated'])
+UPLOAD_BYTES_TOTAL = metrics.counter('chat_upload_bytes_total', '上传完成的文件字节数（包括去重的文件）')
+# 以下数值由各组件自己维护，导出时读取
+metrics.gauge_func('chat_connections', '当前 Socket.IO 连接数', lambda: len(chat_manager.active_users))
+metrics.gauge_func('chat_rooms', '聊天室数', lambda: len(chat_manager.chat_rooms))
+metrics.gauge_func('chat_outbound_queue_depth', '出站队列中待发送的事件数', lambda: chat_manager.fanout.stats(top=0)['depth'])
+metrics.gauge_func('chat_outbound_stalled', '因积压暂停发送的连接数', lambda: chat_manager.fanout.stats(top=0)['stalled'])
+metrics.counter_func('chat_outbound_events_total', '出站事件数', lambda: {
+    (key,): value for key, value in chat_manager.fanout.stats(top=0).items() if key in ('sent', 'dropped')
+}, ['result'])
+metrics.counter_func('chat_outbound_overflows_total', '因出站积压被断开的连接数', lambda: chat_manager.fanout.stats(top=0)['overflows'])
+metrics.gauge_func('chat_write_queue_depth', '等待写入数据库的消息数', lambda: message_writer.stats()['depth'])
+metrics.gauge_func('chat_broadcast_pending', '等待批量广播的消息数',
+                   lambda: chat_manager.batcher.stats()['pending'] if chat_manager.batcher else 0)
+metrics.gauge_func('chat_db_pool_connections', '数据库连接数', lambda: {
+    (state,): count for state, count in db.pool_stats().items() if state in ('in_use', 'idle')
+}, ['state'])
+metrics.counter_func('chat_user_cache_lookups_total', '用户缓存查询次数', lambda: {
+    (result,): count for result, count in user_cache.stats().items() if result in ('hits', 'misses')
+}, ['result'])
+metrics.gauge_func('chat_user_cache_size', '用户缓存中的用户数', lambda: user_cache.stats()['size'])
+metrics.gauge_func('chat_history_buffer_messages', '各房间消息缓冲区中的消息数', lambda: {
+    (room,): stats['count'] for room, stats in chat_manager.history_stats().items()
+}, ['room'])
+metrics.gauge_func('chat_history_buffer_bytes', '各房间消息缓冲区占用的内存估算值（字节）', lambda: {
+    (room,): stats['bytes'] for room, stats in chat_manager.history_stats().items()
+}, ['room'])
+metrics.gauge_func('chat_blocking_pending', '等待线程池执行的阻塞调用数', lambda: engine.stats().get('pending', 0))
+metrics.counter_func('chat_throttled_total', '被限流拒绝的请求数', lambda: {
+    (name,): stats['throttled'] for name, stats in dict(
+        chat_manager.rate_limit_stats(), upload_user=upload_limiter.stats()).items()
+}, ['limiter'])
+metrics.gauge_func('chat_backup_last_success_timestamp_seconds', '本进程最近一次备份成功的时间',
+                   lambda: backup_service.stats()['last_success'])
+metrics.counter_func('chat_backup_failures_total', '本进程备份失败次数', lambda: backup_service.stats()['failed'])
+metrics.gauge_func('chat_archived_messages', '已归档的消息数', lambda: db.archive.stats()['messages'])
+metrics.gauge_func('chat_archive_bytes', '归档分段文件的总字节数', lambda: db.archive.stats()['bytes'])
+metrics.gauge_func('chat_upload_sessions', '未完成的分片上传数', lambda: upload_manager.stats()['sessions'])
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -39,13 +196,16 @@ class User(UserMixin):
         self.username = user_data['username']
         self.is_admin = user_data.get('is_admin', False)
 
-@login_manager.user_loader
-def load_user(user_id):
-    user_data = db.get_user_by_id(int(user_id))
+def _load_user_from_db(user_id):
+    user_data = db.get_user_by_id(user_id)
     if user_data:
         return User(user_data)
     return None
 
+@login_manager.user_loader
+def load_user(user_id):
+    return user_cache.get_or_load(int(user_id), _load_user_from_db)
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -60,6 +220,7 @@ def login():
         success, result = db.verify_user(username, password)
         if success and isinstance(result, dict):  # 确保 result 是字典类型
             user = User(result)
+            user_cache.set(user.id, user)
             login_user(user)
             return redirect(url_for('chat'))
         flash(result if isinstance(result, str) else '登录失败')
@@ -90,22 +251,81 @@ def logout():
     logout_user()
     return redirect(url_for('login'))
 
-# WebSocket事件处理
+# WebSocket事件处理（每个事件的处理耗时记录在 chat_socketio_handler_seconds 中）
+SOCKETIO_HANDLER_SECONDS = metrics.histogram('chat_socketio_handler_seconds', 'Socket.IO 事件处理耗时（秒）', ['handler'])
+
+def timed_handler(name):
+    return SOCKETIO_HANDLER_SECONDS.labels(handler=name).time()
+
 @socketio.on('connect')
-def handle_connect():
-    chat_manager.handle_connect(request.sid)
+@timed_handler('connect')
+def handle_connect(auth=None):
+    return chat_manager.handle_connect(request.sid, auth)
 
 @socketio.on('disconnect')
+@timed_handler('disconnect')
 def handle_disconnect():
     chat_manager.handle_disconnect(request.sid)
 
 @socketio.on('message')
+@timed_handler('message')
 def handle_message(data):
     chat_manager.handle_message(request.sid, data)
 
+@socketio.on('history')
+@timed_handler('history')
+def handle_history(data):
+    chat_manager.handle_history(request.sid, data)
+
+@socketio.on('create_room')
+@timed_handler('create_room')
+def handle_create_room(data):
+    chat_manager.handle_create_room(request.sid, data)
+
+@socketio.on('join_room')
+@timed_handler('join_room')
+def handle_join_room(data):
+    chat_manager.handle_join_room(request.sid, data)
+
+@socketio.on('leave_room')
+@timed_handler('leave_room')
+def handle_leave_room(data):
+    chat_manager.handle_leave_room(request.sid, data)
+
+@app.route('/history')
+@login_required
+def history():
+    try:
+        body = chat_manager.get_history_json(
+            before_id=request.args.get('before_id', type=int),
+            after_id=request.args.get('after_id', type=int),
+            limit=request.args.get('limit', type=int),
+            room=request.args.get('room', ChatManager.DEFAULT_ROOM)
+        )
+    except ValueError:
+        return jsonify({'error': '无效的参数'}), 400
+    return app.response_class(body, mimetype='application/json')
+
+@app.route('/search')
+@login_required
+def search():
+    try:
+        result = chat_manager.search(
+            request.args.get('q', ''),
+            room=request.args.get('room'),
+            limit=request.args.get('limit', type=int),
+            offset=request.args.get('offset', 0, type=int),
+            order=request.args.get('order', 'rank')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result)
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
+    if not allow_upload():
+        return jsonify({'error': '上传过于频繁，请稍后再试'}), 429
     if 'file' not in request.files:
         return jsonify({'error': '没有文件'}), 400
     
@@ -116,61 +336,277 @@ def upload_file():
     # 检查文件名是否合法
     if '.' not in file.filename:
         return jsonify({'error': '无效的文件名'}), 400
+
+    room = request.form.get('room', ChatManager.DEFAULT_ROOM)
+    if room not in chat_manager.chat_rooms:
+        return jsonify({'error': '聊天室不存在'}), 400
     
     try:
         if file and allowed_file(file.filename):
             original_filename = secure_filename(file.filename)  # 保存原始文件名
-            # 使用时间戳创建存储文件名
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            name, ext = os.path.splitext(original_filename)
-            storage_filename = f"{timestamp}_{name}{ext}"  # 用于存储的文件名
-            
-            # 确保上传目录存在
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], storage_filename)
-            file.save(filepath)
-            
-            # 获取文件类型和大小
-            filetype = ext[1:].lower()  # 移除点号
-            filesize = os.path.getsize(filepath)
-            
-            # 保存文件记录
+            # 边接收边计算哈希，内容已存在时不再保存第二份
+            temp_path, sha256, filesize = content_store.write_temp(file.stream)
+            return _publish_file(original_filename, _store_file(temp_path, sha256, filesize, original_filename), room)
+        
+        return jsonify({'error': '不支持的文件类型'}), 400
+        
+    except Exception as e:
+        print(f"文件上传错误: {str(e)}")
+        return jsonify({'error': '文件上传失败'}), 500
+
+def _store_file(source, sha256, filesize, original_filename):
+    """把已计算哈希的文件移入内容存储并保存文件记录（增加内容引用计数），返回文件信息
+
+    两步在内容锁内完成，与删除最后一条引用时删除文件互斥。
+    """
+    filetype = os.path.splitext(original_filename)[1][1:].lower()  # 移除点号
+    user_id = current_user.id  # 线程池中没有请求上下文，先取出
+    
+    def store():
+        with content_store.lock():
+            path, created = content_store.put(source, sha256, filetype)
             file_id = db.save_file_record(
-                filename=storage_filename,
-                filepath=filepath,
+                filename=original_filename,
+                filepath=content_store.path(path),
                 filetype=filetype,
                 filesize=filesize,
-                user_id=current_user.id
+                user_id=user_id,
+                file_hash=sha256
             )
-            
-            # 发送文件消息
-            file_url = url_for('static', filename=f'uploads/{storage_filename}')
-            message = {
-                'type': 'file',
-                'filename': original_filename,  # 使用原始文件名显示
-                'storage_filename': storage_filename,  # 存储的文件名
-                'url': file_url,
-                'filetype': filetype,
-                'filesize': filesize,
-                'username': current_user.username,
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
-            
-            socketio.emit('message', message, room='chat_room')
-            
-            return jsonify({
-                'success': True,
-                'file_url': file_url,
-                'filename': original_filename,  # 返回原始文件名
-                'storage_filename': storage_filename
-            })
+        return {'path': path, 'created': created, 'file_id': file_id, 'filesize': filesize, 'sha256': sha256}
+    
+    return engine.run_blocking(store)
+
+def _publish_file(original_filename, stored, room):
+    """向聊天室发送文件消息，stored 为 _store_file 返回的文件信息"""
+    storage_filename, created, file_id = stored['path'], stored['created'], stored['file_id']
+    filesize, sha256 = stored['filesize'], stored['sha256']
+    filetype = os.path.splitext(original_filename)[1][1:].lower()  # 移除点号
+    
+    UPLOADS_TOTAL.labels(deduplicated=str(not created).lower()).inc()
+    UPLOAD_BYTES_TOTAL.inc(filesize)
+    
+    # 发送文件消息
+    if file_id:
+        file_url = url_for('download_file', file_id=file_id)
+    else:
+        file_url = url_for('static', filename=f'uploads/{storage_filename}')
+    message = {
+        'type': 'file',
+        'filename': original_filename,  # 使用原始文件名显示
+        'storage_filename': storage_filename,  # 存储的文件名
+        'url': file_url,
+        'filetype': filetype,
+        'filesize': filesize,
+        'text': original_filename,  # 保存到消息表，可按文件名搜索
+        'username': current_user.username,
+        'is_admin': current_user.is_admin,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    
+    pending_thumbnail = False
+    if thumbnail_service.supports(filetype):
+        # 缩略图地址由内容哈希决定，消息中始终带上，客户端不必下载原图
+        thumbnail_urls = {kind: url_for('static', filename=f'uploads/{path}')
+                          for kind, path in thumbnail_service.paths(sha256).items()}
+        message['thumbnail_url'] = thumbnail_urls['thumb']
+        message['preview_url'] = thumbnail_urls['preview']
+        pending_thumbnail = not thumbnail_service.cached(sha256)
+    
+    # 消息立即广播，不等待缩略图生成
+    chat_manager.broadcast_message(message, room)
+    
+    if pending_thumbnail:
+        # 生成完成（或失败）后通知客户端，加载缩略图失败的客户端据此重新加载或改为显示原图
+        def on_thumbnail(ok):
+            chat_manager.deliver(room, 'thumbnail', {
+                'room': room, 'url': file_url, 'thumbnail_url': thumbnail_urls['thumb'], 'ok': ok
+            }, ephemeral=True)
         
+        thumbnail_service.generate(content_store.path(storage_filename), sha256, on_thumbnail)
+    
+    result = {
+        'success': True,
+        'file_url': file_url,
+        'filename': original_filename,  # 返回原始文件名
+        'storage_filename': storage_filename,
+        'sha256': sha256,
+        'deduplicated': not created  # 内容已存在，没有写入新数据
+    }
+    return jsonify(result)
+
+# 分片上传：POST /upload/init 创建上传，PUT /upload/<id>?offset=N 上传分片，
+# GET /upload/<id> 查询已接收的字节数（断线后据此续传），POST /upload/<id>/finalize 完成上传
+@app.route('/upload/init', methods=['POST'])
+@login_required
+def upload_init():
+    if not allow_upload():
+        return jsonify({'error': '上传过于频繁，请稍后再试'}), 429
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    room = data.get('room', ChatManager.DEFAULT_ROOM)
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': '无效的文件大小'}), 400
+    if '.' not in filename or not allowed_file(filename):
         return jsonify({'error': '不支持的文件类型'}), 400
-        
+    if room not in chat_manager.chat_rooms:
+        return jsonify({'error': '聊天室不存在'}), 400
+    
+    # 不信任客户端提供的内容哈希：去重在 finalize 时按服务器计算的哈希进行
+    success, result = upload_manager.init(current_user.id, filename, size, room)
+    if not success:
+        return jsonify({'error': result}), 400
+    return jsonify({'upload_id': result.upload_id, 'chunk_size': upload_manager.chunk_size, 'offset': 0})
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    session = upload_manager.get(upload_id, current_user.id)
+    if session is None:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    return jsonify({'upload_id': upload_id, 'offset': session.received, 'size': session.size})
+
+@app.route('/upload/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    session = upload_manager.get(upload_id, current_user.id)
+    if session is None:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    offset = request.args.get('offset', type=int)
+    success, result = upload_manager.write_chunk(session, offset, request.stream, request.content_length)
+    if not success:
+        return jsonify({'error': result, 'offset': session.received}), 409
+    return jsonify({'offset': result})
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+@login_required
+def upload_finalize(upload_id):
+    session = upload_manager.get(upload_id, current_user.id)
+    if session is None:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    
+    try:
+        original_filename = secure_filename(session.filename)
+        success, result = upload_manager.finalize(
+            session, lambda source, sha256, filesize: _store_file(source, sha256, filesize, original_filename))
+        if not success:
+            return jsonify({'error': result, 'offset': session.received}), 409
+        return _publish_file(original_filename, result, session.room)
     except Exception as e:
         print(f"文件上传错误: {str(e)}")
         return jsonify({'error': '文件上传失败'}), 500
 
+@app.route('/files/<int:file_id>')
+@login_required
+def download_file(file_id):
+    """下载上传的文件：强 ETag + 长期缓存，支持 Range 断点续传"""
+    record = db.get_file_record(file_id)
+    if not record or not os.path.isfile(record['filepath']):
+        abort(404)
+    
+    # 按内容哈希保存的文件以哈希作为强 ETag，旧文件退回到文件 ID 和大小
+    etag = record['hash'] or f"{record['id']}-{record['filesize']}"
+    mimetype = mimetypes.guess_type(record['filename'])[0] or 'application/octet-stream'
+    as_attachment = record['filetype'] not in INLINE_FILETYPES
+    
+    if X_ACCEL_PREFIX:
+        response = app.response_class(mimetype=mimetype)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = DOWNLOAD_MAX_AGE
+        response.cache_control.immutable = True
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+        # 由 Nginx 处理 Range 并直接发送文件内容
+        relative_path = os.path.relpath(record['filepath'], UPLOAD_FOLDER).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + relative_path
+        disposition = 'attachment' if as_attachment else 'inline'
+        response.headers['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(record['filename'])}"
+        return response
+    
+    response = send_file(
+        os.path.abspath(record['filepath']),
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=record['filename'],
+        conditional=True,  # 处理 If-None-Match 和 Range 请求
+        etag=etag,
+        max_age=DOWNLOAD_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    # Werkzeug 只在响应 Range 请求时设置，完整下载时也告知客户端可以断点续传
+    response.accept_ranges = 'bytes'
+    return response
+
+@app.route('/files/<int:file_id>', methods=['DELETE'])
+@login_required
+def delete_file(file_id):
+    """删除文件记录（上传者或管理员），内容不再被任何记录引用时同时删除文件和缩略图"""
+    record = db.get_file_record(file_id)
+    if not record:
+        return jsonify({'error': '文件不存在'}), 404
+    if record['uploaded_by'] != current_user.id and not current_user.is_admin:
+        return jsonify({'error': '只能删除自己上传的文件'}), 403
+    
+    def delete():
+        # 在内容锁内删除：引用计数归零到删除文件之间，不会有新上传引用同一内容
+        with content_store.lock():
+            success, result = db.delete_file_record(file_id)
+            if success and result:
+                try:
+                    os.remove(result)
+                except OSError as e:
+                    print(f"删除文件失败: {e}")
+                thumbnail_service.remove(record['hash'])
+        return success, result
+    
+    success, result = engine.run_blocking(delete)
+    if not success:
+        return jsonify({'error': result}), 400
+    return jsonify({'success': True, 'removed': bool(result)})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    authorization = request.headers.get('Authorization', '')
+    if not (METRICS_TOKEN and hmac.compare_digest(authorization, f'Bearer {METRICS_TOKEN}')):
+        if not current_user.is_authenticated or not current_user.is_admin:
+            abort(403)
+    return app.response_class(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/profile', methods=['GET', 'POST'])
+@login_required
+def profile():
+    """POST action=start|stop（start 可带 seconds）启停采样；
+    GET 下载 collapsed stack 格式的结果（可生成火焰图），?format=summary 返回 JSON 摘要"""
+    if not current_user.is_admin:
+        abort(403)
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'start':
+            success, msg = profiler.start(request.form.get('seconds', type=float))
+        elif action == 'stop':
+            success, msg = profiler.stop()
+        else:
+            return jsonify({'error': 'action 只能为 start 或 stop'}), 400
+        if not success:
+            return jsonify({'error': msg}), 409
+        return jsonify(dict(profiler.summary(), message=msg))
+    if request.args.get('format') == 'summary':
+        return jsonify(profiler.summary(request.args.get('top', 15, type=int)))
+    response = app.response_class(profiler.collapsed(), mimetype='text/plain; charset=utf-8')
+    response.headers['Content-Disposition'] = f'attachment; filename=profile-{os.getpid()}.folded'
+    return response
+
+def main():
+    port = int(os.environ.get('CHAT_PORT', 5000))
+    if ASYNC_MODE == 'threading':
+        socketio.run(app, debug=True, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, host='0.0.0.0', port=port)
+
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True) 
\ No newline at end of file
+    main() 
\ No newline at end of file
@@ -0,0 +1,197 @@
+import functools
+import gzip
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 系统上不做进程间互斥
+    fcntl = None
+
+
+@functools.lru_cache(maxsize=64)
+def _read_block(path, offset, length):
+    """读取并解压一个数据块，返回消息元组；数据块写入后不会修改，可以缓存"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    return tuple(json.loads(line) for line in data.decode('utf-8').splitlines())
+
+
+class MessageArchive:
+    """已归档的历史消息：按月分区、只追加的压缩分段文件
+
+    每个分段保存一段连续 ID 的消息，文件为 <月份>/<首条ID>-<末条ID>.jsonl.gz，
+    由多个独立压缩的数据块（gzip member，每块 BLOCK_SIZE 条 JSON 行）拼接而成；
+    同名的 .idx.json 记录 ID 范围、时间范围、房间和每个数据块的偏移，读取时只解压需要的数据块。
+    索引文件最后写入，有索引的分段才是完整的。所有分段的 ID 都不大于 last_id，
+    数据库中只有 ID 大于 last_id 的消息参与查询。
+    """
+
+    SEGMENT_SIZE = 50000    # 每个分段最多保存的消息数
+    BLOCK_SIZE = 500        # 每个数据块的消息数
+    SEARCH_SCAN_LIMIT = 1000000  # 搜索时最多扫描的归档消息数
+    REFRESH_INTERVAL = 1    # 检查其他进程是否写入新分段的最小间隔（秒）
+
+    def __init__(self, root):
+        self.root = root
+        self._segments = []     # 分段索引，按 ID 从小到大
+        self._version = -1      # 上次加载时 .version 文件的修改时间，-1 为尚未加载
+        self._checked_at = 0    # 上次检查 .version 的时间（time.monotonic）
+        self.refresh(force=True)
+
+    @staticmethod
+    def partition(timestamp):
+        """消息所属的分区（按月）"""
+        return str(timestamp)[:7]
+
+    @property
+    def last_id(self):
+        self.refresh()
+        segments = self._segments
+        return segments[-1]['last_id'] if segments else 0
+
+    def refresh(self, force=False):
+        """其他进程写入新分段后重新加载索引
+
+        每 REFRESH_INTERVAL 秒最多检查一次 .version 的修改时间，有变化时才重新扫描索引文件；
+        force 为真时立即检查（本进程写入分段后）。
+        """
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.REFRESH_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            version = os.stat(os.path.join(self.root, '.version')).st_mtime_ns
+        except OSError:
+            version = None
+        if version == self._version:
+            return
+        segments = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.idx.json'):
+                    with open(os.path.join(dirpath, filename), encoding='utf-8') as f:
+                        index = json.load(f)
+                    index['path'] = os.path.join(dirpath, filename[:-len('.idx.json')] + '.jsonl.gz')
+                    segments.append(index)
+        segments.sort(key=lambda index: index['first_id'])
+        self._segments, self._version = segments, version
+
+    def lock(self):
+        """归档写入的进程间互斥，返回锁文件（关闭即释放），已被其他进程持有时返回 False"""
+        os.makedirs(self.root, exist_ok=True)
+        if fcntl is None:
+            return None
+        lock_file = open(os.path.join(self.root, '.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        return lock_file
+
+    def write_segment(self, messages):
+        """把按 ID 排序、属于同一分区的消息写成一个新分段，返回索引"""
+        first, last = messages[0], messages[-1]
+        folder = os.path.join(self.root, self.partition(first['timestamp']))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{first['id']:012d}-{last['id']:012d}.jsonl.gz")
+        blocks, rooms = [], set()
+        with open(path + '.tmp', 'wb') as f:
+            for start in range(0, len(messages), self.BLOCK_SIZE):
+                block = messages[start:start + self.BLOCK_SIZE]
+                data = ''.join(json.dumps(m, ensure_ascii=False, separators=(',', ':')) + '\n' for m in block)
+                offset = f.tell()
+                f.write(gzip.compress(data.encode('utf-8')))
+                block_rooms = sorted({m['room'] for m in block})
+                rooms.update(block_rooms)
+                blocks.append([block[0]['id'], block[-1]['id'], offset, f.tell() - offset, block_rooms])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        timestamps = [str(m['timestamp']) for m in messages]
+        index = {
+            'first_id': first['id'], 'last_id': last['id'], 'count': len(messages),
+            'first_timestamp': min(timestamps), 'last_timestamp': max(timestamps),
+            'rooms': sorted(rooms), 'bytes': os.path.getsize(path), 'blocks': blocks,
+        }
+        index_path = path[:-len('.jsonl.gz')] + '.idx.json'
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + '.tmp', index_path)
+        # 通知其他进程重新加载索引
+        with open(os.path.join(self.root, '.version'), 'w') as f:
+            f.write(str(last['id']))
+        self.refresh(force=True)
+        return index
+
+    def _blocks(self, room, newest_first):
+        """按顺序遍历可能包含 room 消息的数据块：(分段路径, 块首 ID, 块末 ID, 偏移, 长度)"""
+        segments = reversed(self._segments) if newest_first else self._segments
+        for segment in segments:
+            if room is not None and room not in segment['rooms']:
+                continue
+            blocks = reversed(segment['blocks']) if newest_first else segment['blocks']
+            for first_id, last_id, offset, length, rooms in blocks:
+                if room is None or room in rooms:
+                    yield segment['path'], first_id, last_id, offset, length
+
+    def read(self, before_id=None, after_id=None, limit=50, room=None):
+        """与 Database.get_messages 相同的分页方式读取归档消息，结果按时间正序排列"""
+        self.refresh()
+        result = []
+        if after_id is not None:
+            for path, first_id, last_id, offset, length in self._blocks(room, newest_first=False):
+                if last_id <= after_id:
+                    continue
+                for message in _read_block(path, offset, length):
+                    if message['id'] > after_id and (room is None or message['room'] == room):
+                        result.append(dict(message))
+                        if len(result) >= limit:
+                            return result
+            return result
+        for path, first_id, last_id, offset, length in self._blocks(room, newest_first=True):
+            if before_id is not None and first_id >= before_id:
+                continue
+            for message in reversed(_read_block(path, offset, length)):
+                if (before_id is None or message['id'] < before_id) and (room is None or message['room'] == room):
+                    result.append(dict(message))
+                    if len(result) >= limit:
+                        return result[::-1]
+        return result[::-1]
+
+    def search(self, terms, room=None, skip=0, limit=20):
+        """从新到旧查找同时包含所有关键词的消息（不区分大小写），跳过前 skip 条匹配"""
+        self.refresh()
+        terms = [term.lower() for term in terms]
+        result, scanned = [], 0
+        for path, _, _, offset, length in self._blocks(room, newest_first=True):
+            for message in reversed(_read_block(path, offset, length)):
+                scanned += 1
+                if room is not None and message['room'] != room:
+                    continue
+                text = message['text'].lower()
+                if all(term in text for term in terms):
+                    if skip > 0:
+                        skip -= 1
+                        continue
+                    result.append(dict(message))
+                    if len(result) >= limit:
+                        return result
+            if scanned >= self.SEARCH_SCAN_LIMIT:
+                break
+        return result
+
+    def stats(self):
+        self.refresh()
+        segments = self._segments
+        return {
+            'segments': len(segments),
+            'messages': sum(segment['count'] for segment in segments),
+            'bytes': sum(segment['bytes'] for segment in segments),
+            'last_id': segments[-1]['last_id'] if segments else 0,
+        }
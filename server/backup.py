@@ -0,0 +1,227 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from server.engine import native_sleep, start_native_thread
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 系统上只在进程内互斥
+    fcntl = None
+
+
+class BackupService:
+    """在线备份：数据库一致性快照 + 上传文件增量备份
+
+    每次备份是 backup_dir 下的一个目录（chat-<时间>/），包含 chat.db、uploads/ 和 archive/（消息归档），可以单独用于恢复。
+    数据库使用 SQLite 在线备份接口分批复制页面；复制期间备份连接保持一个读事务，
+    WAL 模式下写入不受影响，得到的是开始时刻的一致快照（不持有读事务时，其他连接的每次写入都会让备份从头开始）。
+    上传文件和归档分段写入后不会修改，与上一份备份中大小和修改时间相同的文件直接建立硬链接，只复制新文件。
+    备份先写入 .tmp 目录，完成后再改名，未完成的备份不会被当作上一份备份或计入保留份数。
+    """
+
+    PREFIX = 'chat-'
+
+    def __init__(self, db_file, upload_root, backup_dir, keep=7, interval=0, pages=256, step_delay=0.005,
+                 archive_root=None):
+        self.db_file = db_file
+        self.upload_root = upload_root
+        self.archive_root = archive_root
+        self.backup_dir = backup_dir
+        self.keep = keep                # 保留最近的备份份数
+        self.interval = interval        # 自动备份间隔（秒），0 为不自动备份
+        self.pages = pages              # 每步复制的数据库页数
+        self.step_delay = step_delay    # 每步之间暂停的时间（秒），降低对磁盘 IO 的占用
+        self._lock = threading.Lock()
+        self._running = False
+        self._last = None               # 最近一次备份的结果
+        self._stats = {'completed': 0, 'failed': 0, 'last_success': 0}
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """在后台线程中执行一次备份，返回 (True, 说明) 或 (False, 错误信息)"""
+        # 在当前线程取得锁再交给后台线程释放，同时发出的两个命令只有一个会开始备份
+        if not self._lock.acquire(blocking=False):
+            return False, '备份已在进行中'
+        self._running = True
+        try:
+            start_native_thread(self._run_locked)
+        except Exception as e:
+            self._running = False
+            self._lock.release()
+            return False, f'启动备份失败: {e}'
+        return True, f'开始备份到 {self.backup_dir}'
+
+    def schedule(self):
+        """按 interval 自动备份；多个进程共用 backup_dir 时，距上一份备份超过 interval 才会执行"""
+        if self.interval <= 0:
+            return
+        start_native_thread(self._schedule_loop)
+
+    def _schedule_loop(self):
+        while True:
+            native_sleep(min(self.interval, 60))
+            latest = self._snapshots()[-1:]
+            age = time.time() - os.path.getmtime(latest[0]) if latest else None
+            if age is None or age >= self.interval:
+                self.run()
+
+    def run(self):
+        """执行一次备份，返回 (True, 备份目录) 或 (False, 错误信息)"""
+        if not self._lock.acquire(blocking=False):
+            return False, '备份已在进行中'
+        self._running = True
+        return self._run_locked()
+
+    def _run_locked(self):
+        """已持有 self._lock 时执行备份，结束后释放锁"""
+        lock_file = None
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            lock_file = self._lock_other_processes()
+            if lock_file is False:
+                return False, '其他进程正在备份'
+            return self._backup()
+        except Exception as e:
+            self._stats['failed'] += 1
+            self._last = {'ok': False, 'error': str(e), 'finished_at': time.time()}
+            print(f"备份失败: {e}")
+            return False, f'备份失败: {e}'
+        finally:
+            if lock_file:
+                lock_file.close()
+            self._running = False
+            self._lock.release()
+
+    def _lock_other_processes(self):
+        """用文件锁与其他进程互斥，返回锁文件，已被其他进程持有时返回 False"""
+        if fcntl is None:
+            return None
+        lock_file = open(os.path.join(self.backup_dir, '.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        return lock_file
+
+    def _backup(self):
+        started = time.time()
+        snapshots = self._snapshots()
+        previous = snapshots[-1] if snapshots else None
+        name = f"{self.PREFIX}{datetime.now():%Y%m%d-%H%M%S}"
+        target = os.path.join(self.backup_dir, name)
+        temp = target + '.tmp'
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+
+        db_bytes = self._backup_database(os.path.join(temp, 'chat.db'))
+        copied = linked = upload_bytes = 0
+        for name, source_root in (('uploads', self.upload_root), ('archive', self.archive_root)):
+            if source_root:
+                counts = self._backup_files(source_root, os.path.join(temp, name),
+                                            previous and os.path.join(previous, name))
+                copied, linked, upload_bytes = copied + counts[0], linked + counts[1], upload_bytes + counts[2]
+        os.replace(temp, target)
+        removed = self._rotate()
+
+        self._stats['completed'] += 1
+        self._stats['last_success'] = time.time()
+        self._last = {
+            'ok': True, 'path': target, 'finished_at': time.time(),
+            'duration': round(time.time() - started, 2), 'db_bytes': db_bytes,
+            'files_copied': copied, 'files_linked': linked, 'copied_bytes': upload_bytes, 'removed': removed,
+        }
+        print(f"备份完成: {target}，复制 {copied} 个文件，链接 {linked} 个文件")
+        return True, target
+
+    def _backup_database(self, path):
+        source = sqlite3.connect(self.db_file, isolation_level=None)
+        target = sqlite3.connect(path)
+        try:
+            # 读事务固定快照，其他连接的写入不会使备份重新开始
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=self.pages, progress=lambda *_: native_sleep(self.step_delay))
+            source.execute('COMMIT')
+            # 快照中带有 WAL 标记，改回单文件模式，恢复时只需要这一个文件
+            target.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            target.close()
+            source.close()
+        return os.path.getsize(path)
+
+    def _backup_files(self, source_root, target_root, previous_root):
+        """复制目录中的文件，上一份备份中已有的文件建立硬链接，返回 (复制数, 链接数, 复制字节数)"""
+        copied = linked = copied_bytes = 0
+        if not os.path.isdir(source_root):
+            return copied, linked, copied_bytes
+        for dirpath, _, filenames in os.walk(source_root):
+            relative_dir = os.path.relpath(dirpath, source_root)
+            os.makedirs(os.path.join(target_root, relative_dir), exist_ok=True)
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue  # 正在写入的文件
+                source = os.path.join(dirpath, filename)
+                target = os.path.join(target_root, relative_dir, filename)
+                stat = os.stat(source)
+                if previous_root and self._same_file(os.path.join(previous_root, relative_dir, filename), stat):
+                    try:
+                        os.link(os.path.join(previous_root, relative_dir, filename), target)
+                        linked += 1
+                        continue
+                    except OSError:
+                        pass  # 文件系统不支持硬链接时复制
+                shutil.copy2(source, target)
+                copied += 1
+                copied_bytes += stat.st_size
+        return copied, linked, copied_bytes
+
+    @staticmethod
+    def _same_file(path, stat):
+        try:
+            previous = os.stat(path)
+        except OSError:
+            return False
+        return previous.st_size == stat.st_size and int(previous.st_mtime) == int(stat.st_mtime)
+
+    def _snapshots(self):
+        """已完成的备份目录，按时间从旧到新"""
+        try:
+            names = os.listdir(self.backup_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.backup_dir, name) for name in sorted(names)
+                if name.startswith(self.PREFIX) and not name.endswith('.tmp')]
+
+    def _rotate(self):
+        """删除超出保留份数的旧备份，返回删除的份数"""
+        old = self._snapshots()[:-self.keep] if self.keep > 0 else []
+        for path in old:
+            shutil.rmtree(path, ignore_errors=True)
+        return len(old)
+
+    def stats(self):
+        return dict(self._stats, running=self._running, snapshots=len(self._snapshots()))
+
+    def status(self):
+        """文本形式的备份状态，用于聊天命令的回复"""
+        lines = [f"{'备份中' if self._running else '空闲'}，已有 {len(self._snapshots())} 份备份，"
+                 f"自动备份间隔 {f'{self.interval:g} 秒' if self.interval > 0 else '未开启'}"]
+        last = self._last
+        if last is None:
+            lines.append('本进程尚未执行备份')
+        elif last['ok']:
+            lines.append(f"最近一次: {last['path']}，{datetime.fromtimestamp(last['finished_at']):%Y-%m-%d %H:%M:%S}，"
+                         f"耗时 {last['duration']} 秒，数据库 {last['db_bytes']} 字节，"
+                         f"复制 {last['files_copied']} 个文件（{last['copied_bytes']} 字节），"
+                         f"链接 {last['files_linked']} 个文件")
+        else:
+            lines.append(f"最近一次失败: {last['error']}")
+        return '\n'.join(lines)
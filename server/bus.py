@@ -0,0 +1,268 @@
+import pickle
+import threading
+import time
+
+from socketio import PubSubManager
+
+from server.database import ConnectionPool
+from server.engine import blocking
+
+
+class SQLiteBusManager(PubSubManager):
+    """基于共享 SQLite 文件的 Socket.IO 消息总线，无需外部服务即可运行多个进程
+
+    同一台机器上的各个进程通过同一个总线数据库文件交换 Socket.IO 广播、
+    断开连接请求以及应用层事件（房间创建、用户状态变化、新消息等），
+    并共享在线状态和全局递增的消息 ID。
+    """
+    name = 'sqlite'
+
+    HEARTBEAT_INTERVAL = 5      # 进程心跳间隔（秒）
+    HOST_TIMEOUT = 30           # 超过该时间没有心跳的进程视为已退出
+    RETENTION = 60              # 总线消息保留时间（秒）
+
+    def __init__(self, bus_file='chat_bus.db', channel='socketio', write_only=False,
+                 logger=None, poll_interval=0.02):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.bus_file = bus_file
+        self.poll_interval = poll_interval
+        self.pool = ConnectionPool(bus_file, max_size=4)
+        self._handlers = {}             # 应用层事件名 -> 回调列表
+        self._wakeup = threading.Event()
+        self._initialized = False
+        self._start_id = None           # 监听的起始位置（总线消息 ID）
+        self._init_tables()
+        self._heartbeat()
+
+    @blocking
+    def _init_tables(self):
+        with self.pool.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS bus_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS bus_hosts (
+                    host_id TEXT PRIMARY KEY,
+                    last_seen REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS bus_presence (
+                    host_id TEXT NOT NULL,
+                    room TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    is_admin BOOLEAN DEFAULT 0,
+                    connections INTEGER NOT NULL,
+                    PRIMARY KEY (host_id, room, user_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS bus_sequences (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            conn.commit()
+
+    def mark_position(self):
+        """记录监听的起始位置，之后发布的消息在监听线程启动后都会收到
+
+        应用在从数据库预热消息缓冲区之前调用，预热期间其他进程发布的消息不会遗漏。
+        """
+        if self._start_id is None:
+            self._start_id = self._last_id()
+
+    def initialize(self):
+        """启动监听线程；可以在第一个客户端连接之前由应用主动调用"""
+        if self._initialized:
+            return
+        self._initialized = True
+        self.mark_position()
+        super().initialize()
+
+    # ---- 应用层事件 ----
+
+    def subscribe(self, name, handler):
+        """订阅其他进程发布的应用层事件，handler(payload)"""
+        self._handlers.setdefault(name, []).append(handler)
+
+    def publish_event(self, name, payload):
+        """向其他进程发布应用层事件（本进程不会收到）"""
+        self._publish({'method': 'chat_event', 'name': name, 'payload': payload,
+                       'host_id': self.host_id})
+
+    def _dispatch_event(self, message):
+        if message.get('host_id') == self.host_id:
+            return
+        for handler in self._handlers.get(message.get('name'), ()):
+            try:
+                handler(message.get('payload'))
+            except Exception:
+                self._get_logger().exception('消息总线事件处理失败')
+
+    # ---- 全局消息 ID ----
+
+    @blocking
+    def seed_sequence(self, name, value):
+        """确保序列的当前值不小于 value"""
+        with self.pool.connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO bus_sequences (name, value) VALUES (?, ?)', (name, value))
+            conn.execute('UPDATE bus_sequences SET value = MAX(value, ?) WHERE name = ?', (value, name))
+            conn.commit()
+
+    @blocking
+    def next_value(self, name):
+        """从共享序列中取下一个值，所有进程之间严格递增"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                'UPDATE bus_sequences SET value = value + 1 WHERE name = ? RETURNING value', (name,)
+            ).fetchone()
+            conn.commit()
+            return row[0]
+
+    # ---- PubSubManager 接口 ----
+
+    def _publish(self, data):
+        self._insert(pickle.dumps(data))
+        self._wakeup.set()  # 本进程发布的消息立即投递，无需等待下一次轮询
+
+    @blocking
+    def _insert(self, payload):
+        with self.pool.connection() as conn:
+            conn.execute(
+                'INSERT INTO bus_messages (channel, payload, created_at) VALUES (?, ?, ?)',
+                (self.channel, payload, time.time())
+            )
+            conn.commit()
+
+    @blocking
+    def _last_id(self):
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT COALESCE(MAX(id), 0) FROM bus_messages').fetchone()[0]
+
+    @blocking
+    def _fetch(self, last_id):
+        with self.pool.connection() as conn:
+            return conn.execute(
+                'SELECT id, payload FROM bus_messages WHERE channel = ? AND id > ? ORDER BY id LIMIT 500',
+                (self.channel, last_id)
+            ).fetchall()
+
+    def _listen(self):
+        last_id = self._start_id
+        next_heartbeat = time.monotonic() + self.HEARTBEAT_INTERVAL
+        while True:
+            rows = self._fetch(last_id)
+            for message_id, payload in rows:
+                last_id = message_id
+                message = pickle.loads(payload)
+                if message.get('method') == 'chat_event':
+                    self._dispatch_event(message)
+                else:
+                    yield message
+            if time.monotonic() >= next_heartbeat:
+                self._heartbeat()
+                next_heartbeat = time.monotonic() + self.HEARTBEAT_INTERVAL
+            if not rows:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    @blocking
+    def _heartbeat(self):
+        """更新本进程心跳，并清理过期的总线消息和已退出进程的在线状态"""
+        now = time.time()
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('INSERT OR REPLACE INTO bus_hosts (host_id, last_seen) VALUES (?, ?)',
+                             (self.host_id, now))
+                conn.execute('DELETE FROM bus_messages WHERE created_at < ?', (now - self.RETENTION,))
+                conn.execute('''
+                    DELETE FROM bus_presence WHERE host_id IN (
+                        SELECT host_id FROM bus_hosts WHERE last_seen < ?
+                    )
+                ''', (now - self.HOST_TIMEOUT,))
+                conn.execute('DELETE FROM bus_hosts WHERE last_seen < ?', (now - self.HOST_TIMEOUT,))
+                conn.commit()
+        except Exception:
+            self._get_logger().exception('消息总线心跳失败')
+
+    @blocking
+    def shutdown(self):
+        """进程退出时移除本进程的在线状态"""
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM bus_presence WHERE host_id = ?', (self.host_id,))
+            conn.execute('DELETE FROM bus_hosts WHERE host_id = ?', (self.host_id,))
+            conn.commit()
+
+    def presence_store(self):
+        return SQLitePresenceStore(self)
+
+
+class SQLitePresenceStore:
+    """保存在总线数据库中的在线状态，所有进程共享"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.host_id = bus.host_id
+
+    def _total(self, conn, room, user_id):
+        return conn.execute('''
+            SELECT COALESCE(SUM(p.connections), 0)
+            FROM bus_presence p JOIN bus_hosts h ON h.host_id = p.host_id
+            WHERE p.room = ? AND p.user_id = ? AND h.last_seen > ?
+        ''', (room, user_id, time.time() - self.bus.HOST_TIMEOUT)).fetchone()[0]
+
+    @blocking
+    def add(self, room, user):
+        """增加一个连接，返回该用户是否刚刚在所有进程中上线"""
+        with self.bus.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            before = self._total(conn, room, user['user_id'])
+            conn.execute('''
+                INSERT INTO bus_presence (host_id, room, user_id, username, is_admin, connections)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (host_id, room, user_id) DO UPDATE SET connections = connections + 1
+            ''', (self.host_id, room, user['user_id'], user['username'], user['is_admin']))
+            conn.commit()
+            return before == 0
+
+    @blocking
+    def remove(self, room, user):
+        """减少一个连接，返回该用户是否已在所有进程中下线"""
+        with self.bus.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute('''
+                UPDATE bus_presence SET connections = connections - 1
+                WHERE host_id = ? AND room = ? AND user_id = ?
+            ''', (self.host_id, room, user['user_id']))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return False
+            conn.execute('DELETE FROM bus_presence WHERE connections <= 0')
+            after = self._total(conn, room, user['user_id'])
+            conn.commit()
+            return after == 0
+
+    @blocking
+    def snapshot(self, room):
+        with self.bus.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT p.user_id, p.username, p.is_admin
+                FROM bus_presence p JOIN bus_hosts h ON h.host_id = p.host_id
+                WHERE p.room = ? AND h.last_seen > ?
+                GROUP BY p.user_id
+                ORDER BY MIN(p.rowid)
+            ''', (room, time.time() - self.bus.HOST_TIMEOUT)).fetchall()
+        return [{'user_id': row[0], 'username': row[1], 'is_admin': bool(row[2])} for row in rows]
+
+    @blocking
+    def rooms(self):
+        with self.bus.pool.connection() as conn:
+            rows = conn.execute('SELECT room, COUNT(DISTINCT user_id) FROM bus_presence GROUP BY room').fetchall()
+        return dict(rows)
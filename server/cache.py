@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Loading:
+    """正在加载的键：其他线程等待 event，loaded 表示加载是否成功"""
+    __slots__ = ('event', 'loaded')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.loaded = False
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存，线程安全，并发未命中时同一个键只加载一次"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._loading = {}          # key -> 正在加载该键的 _Loading
+        self._version = 0           # 每次失效加一，避免加载期间失效的旧数据被写回
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            del self._data[key]
+        self._stats['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get_or_load(self, key, loader):
+        """缓存未命中时调用 loader(key) 加载；loader 返回 None 时不缓存"""
+        while True:
+            with self._lock:
+                value = self._get(key)
+                if value is not None:
+                    return value
+                waiter = self._loading.get(key)
+                if waiter is None:
+                    waiter = self._loading[key] = _Loading()
+                    version = self._version
+                    break
+            # 其他线程正在加载同一个键，等待其完成后重新读取
+            waiter.event.wait()
+            with self._lock:
+                value = self._data.get(key)
+                if value is not None:
+                    return value[1]
+            if not waiter.loaded:
+                return None
+
+        try:
+            value = loader(key)
+            if value is not None:
+                with self._lock:
+                    if version == self._version:
+                        self._put(key, value)
+                waiter.loaded = True
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            waiter.event.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            if self._data.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(self._stats, size=len(self._data), maxsize=self.maxsize,
+                        hit_rate=self._stats['hits'] / lookups if lookups else 0.0)
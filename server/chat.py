@@ -2,66 +2,273 @@ from datetime import datetime
 from flask_socketio import emit, join_room, leave_room
 from flask_login import current_user
 import json
+import re
+import threading
+from collections import deque
+from server.persistence import MessageWriter
+from server.history import MessageRecord, MessageRing
+from server.rooms import RoomIndex
+from server.presence import PresenceTracker
+from server.fanout import Fanout, MessageBatcher, SocketIOTransport
+from server.profiler import SamplingProfiler
+from server.ratelimit import RateLimiter
+from server import metrics
+
+ROOM_NAME_PATTERN = re.compile(r'[\w-]{1,32}')
+
+MESSAGES_TOTAL = metrics.counter('chat_messages_total', '已发送的聊天消息数')
+MESSAGE_BYTES_TOTAL = metrics.counter('chat_message_bytes_total', '已发送的聊天消息正文字节数（UTF-8）')
 
 class ChatManager:
-    def __init__(self, socketio, db):
+    DEFAULT_ROOM = 'chat_room'  # 默认聊天室，所有用户连接后自动加入
+    HISTORY_REPLAY_SIZE = 50    # 加入聊天室时回放的最近消息数
+    HISTORY_PAGE_SIZE = 50      # 历史消息默认每页条数
+    HISTORY_MAX_PAGE_SIZE = 200
+    HISTORY_BUFFER_SIZE = 1000  # 每个房间在内存中保留的最近消息数
+    CATCHUP_LIMIT = 200         # 重连时最多补发的消息数（不超过 HISTORY_MAX_PAGE_SIZE），缺口更大时重新加载最近一页
+    PRESENCE_WINDOW = 0.5       # 在线状态变化的合并窗口（秒）
+    PRESENCE_STATUS_LIMIT = 3   # 一个窗口内变化超过该人数时只发一条汇总状态消息
+    FANOUT_WORKERS = 2          # 出站消息发送线程数
+    OUTBOUND_QUEUE_SIZE = 500   # 每个连接的出站队列上限
+    OUTBOUND_MAX_LAG = 30       # 出站消息积压超过该时间（秒）的连接会被断开
+    BROADCAST_BATCH_SIZE = 50   # 批量广播时一批最多包含的消息数
+    SEARCH_PAGE_SIZE = 20       # 搜索结果默认每页条数
+    SEARCH_MAX_PAGE_SIZE = 100
+    PROFILE_DURATION = 30       # /profile start 默认采样时间（秒）
+    # 发送消息限流（令牌桶）：(每秒条数, 最多连续条数)，分别限制单个连接和同一用户的所有连接
+    MESSAGE_RATE = (5, 10)
+    MESSAGE_USER_RATE = (10, 20)
+    ADMIN_MESSAGE_RATE = (20, 50)
+    ADMIN_MESSAGE_USER_RATE = (40, 100)
+    THROTTLE_NOTICE_INTERVAL = 1  # 被限流时最多每隔该秒数提示一次，避免提示本身造成大量流量
+
+    def __init__(self, socketio, db, writer=None, history_buffer_size=None, bus=None,
+                 batch_delay=0, batch_size=None, profiler=None, backup=None):
         self.socketio = socketio
         self.db = db
+        self.bus = bus  # 多进程消息总线，单进程运行时为 None
+        self.writer = writer or MessageWriter(db)  # 消息异步批量落盘
         self.active_users = {}  # 存储活跃用户
-        self.chat_rooms = {}    # 存储聊天室信息
+        self.chat_rooms = {room['name']: room for room in db.get_rooms()}  # 存储聊天室信息
+        self.room_index = RoomIndex()  # 房间成员索引
+        self.presence = PresenceTracker(self.publish_presence, self.PRESENCE_WINDOW,
+                                        bus.presence_store() if bus else None)
+        self.history_buffer_size = history_buffer_size or self.HISTORY_BUFFER_SIZE
+        self.history_buffers = {}  # 房间 -> 最近消息环形缓冲区
+        self._history_lock = threading.Lock()
+        self._publish_lock = threading.Lock()  # 保证消息 ID 顺序与缓冲区顺序一致
+        # 已分配 ID、等待确认写入的消息，按 ID 顺序广播：先确认的消息要等更早的消息确认后才广播
+        self._unpublished = deque()
+        self._delivery_lock = threading.Lock()
+        # 广播先进入每个连接的出站队列，由发送线程异步发送
+        self.fanout = Fanout(SocketIOTransport(socketio.server), workers=self.FANOUT_WORKERS,
+                             max_depth=self.OUTBOUND_QUEUE_SIZE, max_lag=self.OUTBOUND_MAX_LAG,
+                             on_overflow=self._disconnect_slow)
+        # 批量广播：batch_delay（秒）大于 0 时，同一房间短时间内的消息合并为一个 messages 事件
+        self.batcher = None
+        self.profiler = profiler or SamplingProfiler()  # /profile 命令使用的采样分析器（只采样本进程）
+        self.backup = backup  # /backup 命令使用的备份服务，未配置时为 None
+        self.connection_limiter = RateLimiter('message_connection')
+        self.user_limiter = RateLimiter('message_user')
+        self._notice_limiter = RateLimiter('throttle_notice')
+        if batch_delay:
+            self.batcher = MessageBatcher(self._deliver_batch, batch_delay,
+                                          batch_size or self.BROADCAST_BATCH_SIZE)
+        self.warm_history(self.DEFAULT_ROOM)
+        if bus:
+            bus.subscribe('deliver', self._on_remote_deliver)
+            bus.subscribe('room_created', self._on_remote_room_created)
+            bus.subscribe('disconnect_user', lambda payload: self._disconnect_local(payload['username']))
+
+    @staticmethod
+    def room_key(room):
+        """聊天室对应的 Socket.IO 房间名，加前缀避免与连接 sid 冲突"""
+        return f'room:{room}'
 
-    def handle_connect(self, sid):
-        """处理用户连接"""
+    def handle_connect(self, sid, auth=None):
+        """处理用户连接
+
+        重连时客户端在 auth 中带上 last_ids（房间 -> 已收到的最新消息 ID），
+        服务器重新加入这些聊天室并只补发断线期间的消息。
+        """
         if current_user.is_authenticated:
+            if self.db.is_user_banned(current_user.id):
+                return False  # 拒绝已封禁用户的连接
             self.active_users[sid] = {
                 'user_id': current_user.id,
                 'username': current_user.username,
                 'is_admin': current_user.is_admin
             }
-            join_room('chat_room', sid)
-            self.broadcast_status(f'{current_user.username} 加入了汇生金融聊天室')
-            # 发送在线用户列表
-            self.broadcast_user_list()
+            self.fanout.open(sid)
+            emit('room_list', {'rooms': list(self.chat_rooms)}, room=sid)
+            last_ids = self._parse_last_ids(auth)
+            self.enter_room(sid, self.DEFAULT_ROOM, last_ids.pop(self.DEFAULT_ROOM, None))
+            for room, last_id in last_ids.items():
+                if room in self.chat_rooms:
+                    self.enter_room(sid, room, last_id)
+
+    @staticmethod
+    def _parse_last_ids(auth):
+        """从连接参数中读取各聊天室已收到的最新消息 ID，忽略无效的值"""
+        last_ids = (auth or {}).get('last_ids') if isinstance(auth, dict) else None
+        if not isinstance(last_ids, dict):
+            return {}
+        return {room: last_id for room, last_id in last_ids.items()
+                if isinstance(room, str) and isinstance(last_id, int) and last_id >= 0}
 
     def handle_disconnect(self, sid):
         """处理用户断开连接"""
+        self.fanout.close(sid)
+        self.connection_limiter.discard(sid)
+        self._notice_limiter.discard(sid)
         if sid in self.active_users:
-            username = self.active_users[sid]['username']
-            del self.active_users[sid]
-            leave_room('chat_room', sid)
-            self.broadcast_status(f'{username} 离开了汇生金融聊天室')
-            # 更新在线用户列表
-            self.broadcast_user_list()
+            user = self.active_users.pop(sid)
+            for room in self.room_index.leave_all(sid):
+                leave_room(self.room_key(room), sid)
+                # 在线状态变化会在合并窗口结束后批量广播
+                self.presence.leave(room, user)
+
+    def enter_room(self, sid, room, last_id=None):
+        """把连接加入聊天室：回放历史，只向该连接发送完整在线列表
+
+        指定 last_id（重连）时只补发 ID 大于它的消息：最近的消息来自内存缓冲区，
+        更早的按 (room, id) 索引从数据库读取；缺失超过 CATCHUP_LIMIT 条时改为回放最近的消息并带上 gap 标记。
+        """
+        user = self.active_users[sid]
+        if not self.room_index.join(sid, room):
+            return
+        # 先加入房间再读取缺失的消息，期间广播的消息客户端可能收到两次，按 ID 去重
+        join_room(self.room_key(room), sid)
+        if last_id is not None:
+            delta = self.get_history(after_id=last_id, limit=self.CATCHUP_LIMIT, room=room)
+            if not delta['has_more']:
+                emit('history', dict(delta, room=room, catchup=True), room=sid)
+            else:
+                history = self.get_history(limit=self.HISTORY_REPLAY_SIZE, room=room)
+                emit('history', dict(history, room=room, replay=True, gap=True), room=sid)
+        else:
+            # 回放最近的聊天记录
+            history = self.get_history(limit=self.HISTORY_REPLAY_SIZE, room=room)
+            emit('history', dict(history, room=room, replay=True), room=sid)
+        self.presence.join(room, user)
+        # 发送在线用户列表快照，其他用户只会收到增量
+        self.send_user_list(sid, room)
+
+    def exit_room(self, sid, room):
+        """把连接移出聊天室"""
+        user = self.active_users[sid]
+        if not self.room_index.leave(sid, room):
+            return
+        leave_room(self.room_key(room), sid)
+        self.presence.leave(room, user)
+
+    def publish_presence(self, room, joined, left):
+        """广播合并后的在线状态增量；变化人数较多时（如重启后集中重连）只发一条汇总状态"""
+        self.deliver(room, 'presence', {'room': room, 'joined': joined, 'left': left}, ephemeral=True)
+        title = self.room_title(room)
+        if len(joined) + len(left) > self.PRESENCE_STATUS_LIMIT:
+            parts = []
+            if joined:
+                parts.append(f'{len(joined)} 位用户加入了{title}')
+            if left:
+                parts.append(f'{len(left)} 位用户离开了{title}')
+            self.broadcast_status('，'.join(parts), room)
+            return
+        for user in joined:
+            self.broadcast_status(f"{user['username']} 加入了{title}", room)
+        for user in left:
+            self.broadcast_status(f"{user['username']} 离开了{title}", room)
+
+    def room_title(self, room):
+        """状态消息中显示的聊天室名称"""
+        return '汇生金融聊天室' if room == self.DEFAULT_ROOM else f'聊天室 {room}'
+
+    def handle_create_room(self, sid, data):
+        """创建聊天室并加入"""
+        if sid not in self.active_users:
+            return
+        name = str((data or {}).get('name', '')).strip()
+        if not ROOM_NAME_PATTERN.fullmatch(name):
+            emit('error', {'message': '聊天室名称只能包含字母、数字、汉字、下划线和减号，最长32个字符'}, room=sid)
+            return
+        success, msg = self.db.create_room(name, self.active_users[sid]['user_id'])
+        if not success:
+            emit('error', {'message': msg}, room=sid)
+            return
+        self.chat_rooms[name] = {'name': name, 'created_by': self.active_users[sid]['user_id']}
+        if self.bus:
+            self.bus.publish_event('room_created', self.chat_rooms[name])
+        self.socketio.emit('room_created', {'room': name})
+        self.enter_room(sid, name)
+
+    def handle_join_room(self, sid, data):
+        """加入已有的聊天室"""
+        if sid not in self.active_users:
+            return
+        room = (data or {}).get('room')
+        if not isinstance(room, str) or room not in self.chat_rooms:
+            emit('error', {'message': '聊天室不存在'}, room=sid)
+            return
+        self.enter_room(sid, room)
+
+    def handle_leave_room(self, sid, data):
+        """离开聊天室（默认聊天室不能离开）"""
+        if sid not in self.active_users:
+            return
+        room = (data or {}).get('room')
+        if not isinstance(room, str):
+            return
+        if room == self.DEFAULT_ROOM:
+            emit('error', {'message': '不能离开默认聊天室'}, room=sid)
+            return
+        self.exit_room(sid, room)
 
     def handle_message(self, sid, data):
         """处理聊天消息"""
         if sid not in self.active_users:
             return
         
-        user = self.active_users[sid]
-        text = data.get('text', '').strip()
+        data = data if isinstance(data, dict) else {}
+        text = data.get('text', '')
+        room = data.get('room', self.DEFAULT_ROOM)
+        if not isinstance(text, str) or not isinstance(room, str):
+            emit('error', {'message': '无效的消息'}, room=sid)
+            return
         
+        user = self.active_users[sid]
+        # 先限流，超出的消息不做任何数据库操作和广播
+        if not self.allow_message(sid, user):
+            if self._notice_limiter.allow(sid, 1 / self.THROTTLE_NOTICE_INTERVAL, 1):
+                emit('error', {'message': '发送消息过于频繁，请稍后再试'}, room=sid)
+            return
+
+        text = text.strip()
         if not text:
             return
 
+        if not self.room_index.is_member(sid, room):
+            emit('error', {'message': '你不在该聊天室中'}, room=sid)
+            return
+
+        # 搜索命令所有用户都可以使用
+        if text.split(maxsplit=1)[0].lower() == '/search':
+            self.handle_search_command(sid, text, room)
+            return
+
         # 处理管理员命令
         if text.startswith('/') and user['is_admin']:
-            self.handle_admin_command(sid, text)
-            return
-
-        # 检查用户是否被禁言
-        if self.db.is_user_muted(user['user_id']):
-            mute_info = self.db.get_mute_info(user['user_id'])
-            if mute_info:
-                until_time = datetime.strptime(mute_info['muted_until'], '%Y-%m-%d %H:%M:%S')
-                remaining = until_time - datetime.now()
-                minutes = int(remaining.total_seconds() / 60)
-                error_msg = f"你已被禁言，剩余 {minutes} 分钟"
-                if mute_info['reason']:
-                    error_msg += f"，原因：{mute_info['reason']}"
-                emit('error', {'message': error_msg}, room=sid)
-            else:
-                emit('error', {'message': '你已被禁言'}, room=sid)
+            self.handle_admin_command(sid, text, room)
+            return
+
+        # 检查用户是否被禁言（内存缓存，无需查询数据库）
+        mute_info = self.db.get_mute_info(user['user_id'])
+        if mute_info:
+            remaining = mute_info['muted_until'] - datetime.now()
+            minutes = int(remaining.total_seconds() / 60)
+            error_msg = f"你已被禁言，剩余 {minutes} 分钟"
+            if mute_info['reason']:
+                error_msg += f"，原因：{mute_info['reason']}"
+            emit('error', {'message': error_msg}, room=sid)
             return
 
         # 创建消息数据
@@ -69,17 +276,182 @@ class ChatManager:
             'username': user['username'],
             'text': text,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'is_admin': user['is_admin']
+            'is_admin': user['is_admin'],
+            'room': room
         }
 
-        # 保存消息到数据库
-        if self.db.save_message(message):
-            # 广播消息给所有用户
-            emit('message', message, room='chat_room')
+        if self.post_message(room, message, sid):
+            MESSAGES_TOTAL.inc()
+            MESSAGE_BYTES_TOTAL.inc(len(text.encode()))
         else:
             emit('error', {'message': '消息发送失败'}, room=sid)
 
-    def handle_admin_command(self, sid, command):
+    def allow_message(self, sid, user):
+        """按连接和用户两级令牌桶检查是否允许发送，管理员使用单独的限额"""
+        if user['is_admin']:
+            connection_rate, user_rate = self.ADMIN_MESSAGE_RATE, self.ADMIN_MESSAGE_USER_RATE
+        else:
+            connection_rate, user_rate = self.MESSAGE_RATE, self.MESSAGE_USER_RATE
+        return (self.connection_limiter.allow(sid, *connection_rate)
+                and self.user_limiter.allow(user['user_id'], *user_rate))
+
+    def rate_limit_stats(self):
+        """各限流器的放行和拒绝次数"""
+        return {limiter.name: limiter.stats() for limiter in (self.connection_limiter, self.user_limiter)}
+
+    def post_message(self, room, message, sid=None):
+        """分配消息 ID、写入数据库和内存缓冲区并广播，返回是否成功
+
+        sid 为发送者的连接，异步模式下写入失败时单独通知。
+        """
+        ring = self.get_history_buffer(room)
+
+        def on_error(failed):
+            ring.discard(failed['id'])
+            if sid is not None:
+                self.socketio.emit('error', {'message': '消息保存失败'}, room=sid)
+
+        with self._publish_lock:
+            pending = self.writer.submit(message, on_error=on_error)
+            if pending is None:
+                return False
+            ring.append(message)
+            entry = [room, message, None]  # 第三项为确认结果，None 表示尚未确认
+            self._unpublished.append(entry)
+
+        ok = False
+        try:
+            ok = self.writer.confirm(pending)
+        finally:
+            if not ok:
+                ring.discard(message['id'])
+            entry[2] = ok
+            self._publish_confirmed()
+        return ok
+
+    def _publish_confirmed(self):
+        """按 ID 顺序广播已确认的消息，遇到尚未确认的消息即停止（由确认它的线程继续广播）
+
+        乱序广播会让客户端先收到较大的 ID，重连时按 last_id 补发就会永久跳过较小的那条。
+        """
+        with self._delivery_lock:
+            while self._unpublished and self._unpublished[0][2] is not None:
+                room, message, ok = self._unpublished.popleft()
+                if ok:
+                    # 广播消息给聊天室内的用户
+                    self.publish_message(room, message)
+
+    def handle_history(self, sid, data):
+        """处理客户端的历史消息请求"""
+        if sid not in self.active_users:
+            return
+        data = data if isinstance(data, dict) else {}
+        room = data.get('room', self.DEFAULT_ROOM)
+        if not isinstance(room, str) or not self.room_index.is_member(sid, room):
+            emit('error', {'message': '你不在该聊天室中'}, room=sid)
+            return
+        try:
+            history = self.get_history(data.get('before_id'), data.get('after_id'),
+                                       data.get('limit', self.HISTORY_PAGE_SIZE), room)
+        except (TypeError, ValueError):
+            emit('error', {'message': '无效的历史消息请求'}, room=sid)
+            return
+        emit('history', dict(history, room=room), room=sid)
+
+    def get_history(self, before_id=None, after_id=None, limit=None, room=DEFAULT_ROOM):
+        """按消息 ID 分页获取历史消息，返回 {'messages': [...], 'has_more': bool}"""
+        records, has_more = self._history_page(before_id, after_id, limit, room)
+        return {'messages': [r.message for r in records], 'has_more': has_more}
+
+    def get_history_json(self, before_id=None, after_id=None, limit=None, room=DEFAULT_ROOM):
+        """与 get_history 相同，但直接拼接预先序列化好的 JSON"""
+        records, has_more = self._history_page(before_id, after_id, limit, room)
+        return '{"messages": [%s], "has_more": %s}' % (
+            ', '.join(r.json for r in records), 'true' if has_more else 'false')
+
+    def _history_page(self, before_id, after_id, limit, room):
+        if room not in self.chat_rooms:
+            raise ValueError("聊天室不存在")
+        limit = min(int(limit or self.HISTORY_PAGE_SIZE), self.HISTORY_MAX_PAGE_SIZE)
+        before_id = int(before_id) if before_id is not None else None
+        after_id = int(after_id) if after_id is not None else None
+        if limit <= 0:
+            raise ValueError("limit 必须大于 0")
+
+        # 优先从内存缓冲区读取
+        page = self.get_history_buffer(room).page(before_id, after_id, limit)
+        if page is not None:
+            return page
+
+        # 确保已广播但还在写入队列中的消息对历史查询可见
+        self.writer.flush(timeout=1)
+        # 多取一条用于判断是否还有更多
+        messages = self.db.get_messages(before_id, after_id, limit + 1, room=room)
+        has_more = len(messages) > limit
+        if has_more:
+            messages = messages[:limit] if after_id is not None else messages[1:]
+        return [MessageRecord(m) for m in messages], has_more
+
+    def search(self, query, room=None, limit=None, offset=0, order='rank'):
+        """全文搜索消息，返回 {'messages': [...], 'has_more': bool}；room 为 None 时搜索所有聊天室"""
+        query = (query or '').strip()
+        if not query:
+            raise ValueError("搜索关键词不能为空")
+        if room is not None and room not in self.chat_rooms:
+            raise ValueError("聊天室不存在")
+        if order not in ('rank', 'recent'):
+            raise ValueError("order 只能为 rank 或 recent")
+        limit = min(int(limit or self.SEARCH_PAGE_SIZE), self.SEARCH_MAX_PAGE_SIZE)
+        offset = int(offset or 0)
+        if limit <= 0 or offset < 0:
+            raise ValueError("无效的分页参数")
+        # 确保刚发送还在写入队列中的消息也能被搜索到
+        self.writer.flush(timeout=1)
+        messages, has_more = self.db.search_messages(query, room, limit, offset, order)
+        return {'messages': messages, 'has_more': has_more}
+
+    def handle_search_command(self, sid, command, room):
+        """/search 关键词：在当前聊天室中搜索，结果按相关度排列"""
+        parts = command.split(maxsplit=1)
+        if len(parts) < 2:
+            emit('error', {'message': '使用方法: /search 关键词 [关键词...]'}, room=sid)
+            return
+        try:
+            result = self.search(parts[1], room)
+        except ValueError as e:
+            emit('error', {'message': str(e)}, room=sid)
+            return
+        if not result['messages']:
+            emit('system', {'message': f'没有找到包含 "{parts[1]}" 的消息'}, room=sid)
+            return
+        title = f'搜索 "{parts[1]}" 的结果'
+        if result['has_more']:
+            title += f"（仅显示前 {len(result['messages'])} 条）"
+        lines = [title + ':']
+        lines.extend(f"[{m['timestamp']}] {m['username']}: {m['text']}" for m in result['messages'])
+        emit('system', {'message': '\n'.join(lines)}, room=sid)
+
+    def get_history_buffer(self, room):
+        """获取房间的消息缓冲区，首次访问时从数据库预热"""
+        ring = self.history_buffers.get(room)
+        if ring is None:
+            with self._history_lock:
+                ring = self.history_buffers.get(room) or self.warm_history(room)
+        return ring
+
+    def warm_history(self, room):
+        """从数据库加载最近的消息到房间的内存缓冲区"""
+        ring = MessageRing(self.history_buffer_size)
+        messages = self.db.get_messages(limit=self.history_buffer_size + 1, room=room)
+        ring.warm(messages, complete=len(messages) <= self.history_buffer_size)
+        self.history_buffers[room] = ring
+        return ring
+
+    def history_stats(self):
+        """各房间消息缓冲区的条数和内存占用"""
+        return {room: ring.stats() for room, ring in list(self.history_buffers.items())}
+
+    def handle_admin_command(self, sid, command, room=DEFAULT_ROOM):
         """处理管理员命令"""
         parts = command.split()
         cmd = parts[0].lower()
@@ -100,7 +472,7 @@ class ChatManager:
 
                 success, msg = self.db.mute_user(target['id'], user['user_id'], duration, reason)
                 if success:
-                    self.broadcast_status(f'系统: {username} 已被禁言 {duration} 分钟')
+                    self.broadcast_status(f'系统: {username} 已被禁言 {duration} 分钟', room)
                 else:
                     emit('error', {'message': msg}, room=sid)
 
@@ -115,7 +487,7 @@ class ChatManager:
 
                 success, msg = self.db.unmute_user(target['id'])
                 if success:
-                    self.broadcast_status(f'系统: {username} 的禁言已被解除')
+                    self.broadcast_status(f'系统: {username} 的禁言已被解除', room)
                 else:
                     emit('error', {'message': msg}, room=sid)
 
@@ -130,44 +502,158 @@ class ChatManager:
 
                 success, msg = self.db.ban_user(target['id'])
                 if success:
-                    self.broadcast_status(f'系统: {username} 已被封禁')
+                    self.broadcast_status(f'系统: {username} 已被封禁', room)
                     # 断开被封禁用户的连接
                     self.disconnect_user(username)
                 else:
                     emit('error', {'message': msg}, room=sid)
 
+            elif cmd == '/unban':
+                if len(parts) < 2:
+                    raise ValueError("使用方法: /unban username")
+                username = parts[1]
+                target = self.db.get_user_by_username(username)
+                if not target:
+                    emit('error', {'message': '找不到指定用户'}, room=sid)
+                    return
+
+                success, msg = self.db.unban_user(target['id'])
+                if success:
+                    self.broadcast_status(f'系统: {username} 的封禁已被解除', room)
+                else:
+                    emit('error', {'message': msg}, room=sid)
+
             elif cmd == '/help':
                 help_text = """可用的管理员命令:
 /mute username duration [reason] - 禁言用户
 /unmute username - 解除用户禁言
 /ban username - 封禁用户
 /unban username - 解除用户封禁
-/users - 显示在线用户列表
+/users - 显示当前聊天室的在线用户
+/queues - 显示出站队列积压最严重的连接
+/search keyword - 在当前聊天室中搜索消息
+/profile start [seconds]|stop|dump - 采样分析本进程的耗时分布
+/backup [status] - 立即在后台备份数据库和上传文件，或查看备份状态
 /help - 显示此帮助信息"""
                 emit('system', {'message': help_text}, room=sid)
 
             elif cmd == '/users':
                 users_list = [f"{user['username']}{'(管理员)' if user['is_admin'] else ''}" 
-                            for user in self.active_users.values()]
+                            for user in self.presence.snapshot(room)]
                 emit('system', {'message': f"在线用户:\n{chr(10).join(users_list)}"}, room=sid)
 
+            elif cmd == '/queues':
+                stats = self.fanout.stats(top=5)
+                lines = [f"连接 {stats['connections']}，积压 {stats['depth']}，"
+                         f"丢弃 {stats['dropped']}，因积压断开 {stats['overflows']}"]
+                for queue in stats['slowest']:
+                    username = self.active_users.get(queue['sid'], {}).get('username', queue['sid'])
+                    lines.append(f"{username}: 队列 {queue['depth']}，延迟 {queue['lag']} 秒，丢弃 {queue['dropped']}")
+                emit('system', {'message': '\n'.join(lines)}, room=sid)
+
+            elif cmd == '/profile':
+                action = parts[1].lower() if len(parts) > 1 else ''
+                if action == 'start':
+                    duration = float(parts[2]) if len(parts) > 2 else self.PROFILE_DURATION
+                    success, msg = self.profiler.start(duration)
+                elif action == 'stop':
+                    success, path = self.profiler.stop()
+                    msg = f"{self.profiler.format_summary()}\n结果文件: {path}" if success else path
+                elif action == 'dump':
+                    success = self.profiler.started
+                    if success:
+                        path = self.profiler.save()
+                        msg = f"{self.profiler.format_summary()}\n结果文件: {path}"
+                    else:
+                        msg = '尚未进行采样'
+                else:
+                    raise ValueError("使用方法: /profile start [seconds]|stop|dump")
+                emit('system' if success else 'error', {'message': msg}, room=sid)
+
+            elif cmd == '/backup':
+                action = parts[1].lower() if len(parts) > 1 else ''
+                if self.backup is None:
+                    success, msg = False, '未配置备份'
+                elif action == 'status':
+                    success, msg = True, self.backup.status()
+                elif not action:
+                    success, msg = self.backup.start()
+                else:
+                    raise ValueError("使用方法: /backup [status]")
+                emit('system' if success else 'error', {'message': msg}, room=sid)
+
         except Exception as e:
             emit('error', {'message': f'命令执行失败: {str(e)}'}, room=sid)
 
-    def broadcast_status(self, message):
-        """广播状态消息"""
-        emit('status', {'message': message}, room='chat_room')
+    def broadcast_status(self, message, room=DEFAULT_ROOM):
+        """向聊天室广播状态消息"""
+        self.deliver(room, 'status', {'message': message, 'room': room}, ephemeral=True)
 
-    def broadcast_user_list(self):
-        """广播在线用户列表"""
-        users = [{
-            'username': user['username'],
-            'is_admin': user['is_admin']
-        } for user in self.active_users.values()]
-        emit('user_list', {'users': users}, room='chat_room')
+    def broadcast_message(self, message, room=DEFAULT_ROOM):
+        """保存并广播一条消息（例如文件消息），与聊天消息一样分配 ID，重连补发和历史记录中都能看到"""
+        return self.post_message(room, dict(message, room=room))
+
+    def publish_message(self, room, message):
+        """广播一条聊天消息，开启批量广播时先合并再发送"""
+        if self.batcher:
+            self.batcher.add(room, message)
+        else:
+            self.deliver(room, 'message', message)
+
+    def _deliver_batch(self, room, messages):
+        self.deliver(room, 'messages', {'room': room, 'messages': messages})
+
+    def deliver(self, room, event, data, ephemeral=False):
+        """通过出站队列把事件发给聊天室内的连接，并转发给其他进程
+
+        ephemeral 表示临时事件（在线状态、系统提示），连接积压时可以丢弃。
+        """
+        self.fanout.enqueue(self.room_index.members(room), event, data, ephemeral)
+        if self.bus:
+            self.bus.publish_event('deliver', {'room': room, 'event': event, 'data': data,
+                                               'ephemeral': ephemeral})
+
+    def outbound_stats(self):
+        """出站队列统计，包括积压最严重的连接"""
+        stats = self.fanout.stats()
+        if self.batcher:
+            stats['batching'] = self.batcher.stats()
+        return stats
+
+    def send_user_list(self, sid, room=DEFAULT_ROOM):
+        """向单个连接发送聊天室的完整在线用户列表"""
+        self.socketio.emit('user_list', {'users': self.presence.snapshot(room), 'room': room}, room=sid)
+
+    def _on_remote_deliver(self, payload):
+        """其他进程发出的事件投递给本进程的连接，聊天消息同时写入历史缓冲区
+
+        房间还没有缓冲区时先预热：跳过这条消息的话，数据库尚未写入它时预热的缓冲区会永久缺少它。
+        """
+        room, data = payload['room'], payload['data']
+        if payload['event'] in ('message', 'messages'):
+            ring = self.get_history_buffer(room)
+            messages = data['messages'] if payload['event'] == 'messages' else [data]
+            for message in messages:
+                if 'id' in message:
+                    ring.append(message)
+        self.fanout.enqueue(self.room_index.members(room), payload['event'], data, payload['ephemeral'])
+
+    def _on_remote_room_created(self, room):
+        self.chat_rooms[room['name']] = room
 
     def disconnect_user(self, username):
-        """断开指定用户的连接"""
+        """断开指定用户的连接（包括其他进程上的连接）"""
+        self._disconnect_local(username)
+        if self.bus:
+            self.bus.publish_event('disconnect_user', {'username': username})
+
+    def _disconnect_slow(self, sid):
+        """出站队列溢出的连接直接断开，重连后客户端会重新获取历史"""
+        username = self.active_users.get(sid, {}).get('username', sid)
+        print(f"连接 {username} 出站消息积压过多，已断开")
+        self.socketio.server.disconnect(sid)
+
+    def _disconnect_local(self, username):
         for sid, user in list(self.active_users.items()):
             if user['username'] == username:
-                self.socketio.disconnect(sid) 
\ No newline at end of file
+                self.socketio.server.disconnect(sid) 
\ No newline at end of file
@@ -1,78 +1,216 @@
 import sqlite3
 import hashlib
+import json
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from server.engine import blocking, is_blocking, native_sleep
+from server.moderation import ModerationCache
+from server import metrics, migrations
 
+# Database 访问 SQLite 的方法（@blocking）的耗时，协程模式下包括在线程池中排队的时间
+DB_METHOD_SECONDS = metrics.histogram('chat_db_method_seconds', 'Database 方法耗时（秒）', ['method'])
+
+class ConnectionPool:
+    """SQLite 连接池：长连接按线程复用，连接总数有上限"""
+
+    # 每个新连接建立后执行一次的 PRAGMA
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',      # 写不阻塞读
+        'PRAGMA synchronous=NORMAL',    # WAL 下提交无需每次 fsync
+        'PRAGMA busy_timeout=5000',     # 写锁冲突时等待而不是立即报错
+        'PRAGMA cache_size=-8000',      # 每个连接约 8MB 页缓存
+        'PRAGMA temp_store=MEMORY',
+    )
+
+    def __init__(self, db_file, max_size=8, timeout=30):
+        self.db_file = db_file
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []                 # 空闲连接（后进先出）
+        self._open = 0                  # 已建立的连接数
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._stats = {'checkouts': 0, 'waits': 0, 'created': 0}
+
+    def _create(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        self._stats['created'] += 1
+        return conn
+
+    def _acquire(self):
+        """取出一个连接：优先复用本线程上次使用的连接"""
+        preferred = getattr(self._local, 'last', None)
+        with self._cond:
+            self._stats['checkouts'] += 1
+            waited = False
+            while True:
+                if preferred is not None and preferred in self._idle:
+                    self._idle.remove(preferred)
+                    return preferred
+                if self._idle:
+                    return self._idle.pop()
+                if self._open < self.max_size:
+                    self._open += 1
+                    break
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                if not self._cond.wait(self.timeout):
+                    raise sqlite3.OperationalError("数据库连接池已耗尽")
+        try:
+            return self._create()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """借出连接；同一线程内嵌套调用复用同一个连接，最外层退出时提交或回滚"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn, self._local.depth = conn, 1
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._local.last = conn
+            self._release(conn)
+
+    def stats(self):
+        """连接池统计信息"""
+        with self._cond:
+            return dict(self._stats,
+                        open=self._open,
+                        idle=len(self._idle),
+                        in_use=self._open - len(self._idle),
+                        max_size=self.max_size)
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+                self._open -= 1
+
+
+@metrics.instrument_methods(DB_METHOD_SECONDS, 'method', include=is_blocking)
 class Database:
-    def __init__(self, db_file="chat.db"):
+    # 访问 SQLite 的方法都标记为 @blocking，协程模式下在线程池中执行，不会阻塞事件循环
+    DEFAULT_ROOM = 'chat_room'  # 默认聊天室
+    MESSAGE_FIELDS = ('id', 'username', 'text', 'timestamp', 'is_admin', 'room')  # 其余字段保存在 attachment 中
+    SEARCH_MIN_TERM = 3             # trigram 索引只能匹配至少 3 个字符的关键词
+    SEARCH_SCAN_ROWS = 1000000      # 只有短关键词时用 LIKE 扫描最近的消息条数上限
+    SEARCH_BACKFILL_BATCH = 5000    # 补建全文索引时每批处理的消息数
+    ARCHIVE_DELETE_BATCH = 5000     # 归档后每个事务从数据库删除的消息数
+
+    def __init__(self, db_file="chat.db", pool_size=8, archive=None):
         self.db_file = db_file
+        self.pool = ConnectionPool(db_file, max_size=pool_size)
+        self.archive = archive  # MessageArchive，ID 不大于 archive.last_id 的消息从归档中读取
+        self.moderation = ModerationCache()  # 禁言/封禁状态的内存缓存
+        self.search_enabled = False          # SQLite 支持 FTS5 trigram 时为 True
+        self._user_listeners = []            # 用户状态变化回调，参数为 user_id
         self.init_database()
+        self.load_moderation()
+
+    def add_user_listener(self, callback):
+        """注册用户状态（禁言、封禁）变化的回调"""
+        self._user_listeners.append(callback)
+
+    def _notify_user_changed(self, user_id):
+        for callback in self._user_listeners:
+            try:
+                callback(user_id)
+            except Exception as e:
+                print(f"用户状态变化回调失败: {e}")
 
+    def pool_stats(self):
+        """获取连接池统计信息"""
+        return self.pool.stats()
+
+    def close(self):
+        """关闭数据库连接池"""
+        self.pool.close_all()
+
+    @blocking
     def init_database(self):
-        """初始化数据库，创建用户表和管理员表"""
-        with sqlite3.connect(self.db_file) as conn:
+        """检查数据库版本，需要时升级到最新结构（见 server/migrations.py）"""
+        with self.pool.connection() as conn:
+            migrations.migrate(conn, self)
+            cursor = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+            self.search_enabled = cursor.fetchone() is not None
+
+    @blocking
+    def load_moderation(self):
+        """从数据库加载当前生效的禁言和封禁状态到内存缓存"""
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
-            # 修改用户表，添加 is_admin 字段
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    email TEXT UNIQUE,
-                    is_admin BOOLEAN DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_login TIMESTAMP,
-                    status TEXT DEFAULT 'active'
-                )
-            ''')
-            
-            # 创建禁言表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS mutes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    muted_by INTEGER,
-                    muted_until TIMESTAMP,
-                    reason TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id),
-                    FOREIGN KEY (muted_by) REFERENCES users(id)
-                )
-            ''')
-            
-            # 创建文件表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS files (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    filename TEXT NOT NULL,
-                    filepath TEXT NOT NULL,
-                    filetype TEXT NOT NULL,
-                    filesize INTEGER NOT NULL,
-                    uploaded_by INTEGER,
-                    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (uploaded_by) REFERENCES users(id)
-                )
-            ''')
-            conn.commit()
-            
-            # 确保至少有一个管理员账户
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = 1')
-            if cursor.fetchone()[0] == 0:
-                admin_password = self.hash_password("admin123")
-                cursor.execute(
-                    'INSERT OR IGNORE INTO users (username, password, is_admin) VALUES (?, ?, ?)',
-                    ("admin", admin_password, True)
-                )
-                conn.commit()
+            now = datetime.now()
+            cursor.execute(
+                'SELECT user_id, muted_until, reason FROM mutes WHERE muted_until > ? ORDER BY id',
+                (now,)
+            )
+            mutes = [(user_id, datetime.fromisoformat(until), reason)
+                     for user_id, until, reason in cursor.fetchall()]
+            cursor.execute("SELECT id FROM users WHERE status = 'banned'")
+            banned_ids = [row[0] for row in cursor.fetchall()]
+        self.moderation.load(mutes, banned_ids)
+
+    @blocking
+    def reload_user_moderation(self, user_id):
+        """重新从数据库读取单个用户的禁言和封禁状态（其他进程修改后调用）"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT muted_until, reason FROM mutes WHERE user_id = ? AND muted_until > ? ORDER BY id DESC LIMIT 1',
+                (user_id, datetime.now())
+            )
+            mute = cursor.fetchone()
+            cursor.execute('SELECT status FROM users WHERE id = ?', (user_id,))
+            user = cursor.fetchone()
+        if mute:
+            self.moderation.set_mute(user_id, datetime.fromisoformat(mute[0]), mute[1])
+        else:
+            self.moderation.clear_mute(user_id)
+        self.moderation.set_banned(user_id, bool(user and user[0] == 'banned'))
 
     def hash_password(self, password):
         """对密码进行哈希处理"""
         return hashlib.sha256(password.encode()).hexdigest()
 
+    @blocking
     def register_user(self, username, password, email=None):
         """注册新用户"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 hashed_password = self.hash_password(password)
                 cursor.execute(
@@ -86,10 +224,11 @@ class Database:
         except Exception as e:
             return False, f"注册失败: {str(e)}"
 
+    @blocking
     def verify_user(self, username, password):
         """验证用户登录并返回用户信息"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     'SELECT id, password, is_admin, status FROM users WHERE username = ?',
@@ -106,11 +245,7 @@ class Database:
                 
                 if stored_password == self.hash_password(password):
                     # 检查是否被禁言
-                    cursor.execute(
-                        'SELECT muted_until, reason FROM mutes WHERE user_id = ? AND muted_until > ? ORDER BY id DESC LIMIT 1',
-                        (user_id, datetime.now())
-                    )
-                    mute_info = cursor.fetchone()
+                    mute_info = self.moderation.get_mute(user_id)
                     
                     # 更新最后登录时间
                     cursor.execute(
@@ -130,10 +265,11 @@ class Database:
         except Exception as e:
             return False, f"验证失败: {str(e)}"
 
+    @blocking
     def mute_user(self, user_id, admin_id, duration_minutes, reason=None):
         """禁言用户"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 muted_until = datetime.now() + timedelta(minutes=duration_minutes)
                 cursor.execute(
@@ -141,55 +277,67 @@ class Database:
                     (user_id, admin_id, muted_until, reason)
                 )
                 conn.commit()
+                self.moderation.set_mute(user_id, muted_until, reason)
+                self._notify_user_changed(user_id)
                 return True, "禁言成功"
         except Exception as e:
             return False, f"禁言失败: {str(e)}"
 
+    @blocking
     def unmute_user(self, user_id):
         """解除用户禁言"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     'UPDATE mutes SET muted_until = ? WHERE user_id = ? AND muted_until > ?',
                     (datetime.now(), user_id, datetime.now())
                 )
                 conn.commit()
+                self.moderation.clear_mute(user_id)
+                self._notify_user_changed(user_id)
                 return True, "已解除禁言"
         except Exception as e:
             return False, f"解除禁言失败: {str(e)}"
 
+    @blocking
     def ban_user(self, user_id):
         """封禁用户"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     'UPDATE users SET status = "banned" WHERE id = ?',
                     (user_id,)
                 )
                 conn.commit()
+                self.moderation.set_banned(user_id, True)
+                self._notify_user_changed(user_id)
                 return True, "封禁成功"
         except Exception as e:
             return False, f"封禁失败: {str(e)}"
 
+    @blocking
     def unban_user(self, user_id):
         """解除用户封禁"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     'UPDATE users SET status = "active" WHERE id = ?',
                     (user_id,)
                 )
                 conn.commit()
+                self.moderation.set_banned(user_id, False)
+                self._notify_user_changed(user_id)
                 return True, "解除封禁成功"
         except Exception as e:
             return False, f"解除封禁失败: {str(e)}"
 
+    @blocking
     def get_user_by_username(self, username):
         """根据用户名获取用户信息"""
-        with sqlite3.connect(self.db_file) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 'SELECT id, username, is_admin, status FROM users WHERE username = ?',
@@ -205,10 +353,11 @@ class Database:
                 }
             return None 
 
+    @blocking
     def get_user_by_id(self, user_id):
         """根据ID获取用户信息"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     'SELECT id, username, is_admin, status FROM users WHERE id = ?',
@@ -228,109 +377,425 @@ class Database:
             return None 
 
     def is_user_muted(self, user_id):
-        """检查用户是否被禁言"""
-        try:
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    'SELECT 1 FROM mutes WHERE user_id = ? AND muted_until > ?',
-                    (user_id, datetime.now())
-                )
-                return cursor.fetchone() is not None
-        except Exception as e:
-            print(f"检查禁言状态失败: {e}")
-            return False
+        """检查用户是否被禁言（读内存缓存）"""
+        return self.moderation.get_mute(user_id) is not None
+
+    def is_user_banned(self, user_id):
+        """检查用户是否被封禁（读内存缓存）"""
+        return self.moderation.is_banned(user_id)
 
     def get_mute_info(self, user_id):
-        """获取用户的禁言信息"""
-        try:
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    '''
-                    SELECT muted_until, reason 
-                    FROM mutes 
-                    WHERE user_id = ? AND muted_until > ? 
-                    ORDER BY id DESC LIMIT 1
-                    ''',
-                    (user_id, datetime.now())
-                )
-                result = cursor.fetchone()
-                if result:
-                    return {
-                        'muted_until': result[0],
-                        'reason': result[1]
-                    }
-                return None
-        except Exception as e:
-            print(f"获取禁言信息失败: {e}")
-            return None 
+        """获取用户的禁言信息（读内存缓存）"""
+        mute = self.moderation.get_mute(user_id)
+        if mute:
+            return {
+                'muted_until': mute[0],
+                'reason': mute[1]
+            }
+        return None
 
     def save_message(self, message_data):
         """保存聊天消息到数据库"""
+        return self.save_messages([message_data])
+
+    @blocking
+    def save_messages(self, messages):
+        """在同一个事务中批量保存聊天消息"""
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
-                # 首先创建消息表（如果不存在）
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS messages (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT NOT NULL,
-                        text TEXT NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        is_admin BOOLEAN DEFAULT 0
-                    )
-                ''')
-                
-                # 插入消息
-                cursor.execute('''
-                    INSERT INTO messages (username, text, timestamp, is_admin)
-                    VALUES (?, ?, ?, ?)
-                ''', (
+                cursor.executemany('''
+                    INSERT INTO messages (id, username, text, timestamp, is_admin, room, attachment)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(
+                    message_data.get('id'),
                     message_data['username'],
                     message_data['text'],
                     message_data['timestamp'],
-                    message_data.get('is_admin', False)
-                ))
+                    message_data.get('is_admin', False),
+                    message_data.get('room', self.DEFAULT_ROOM),
+                    self._attachment(message_data)
+                ) for message_data in messages])
                 conn.commit()
                 return True
         except Exception as e:
             print(f"保存消息失败: {e}")
             return False
 
-    def get_recent_messages(self, limit=50):
+    def _attachment(self, message):
+        """消息中基本字段以外的内容（如文件信息），没有时返回 None"""
+        extra = {k: v for k, v in message.items() if k not in self.MESSAGE_FIELDS}
+        return json.dumps(extra, ensure_ascii=False) if extra else None
+
+    @staticmethod
+    def _message_from_row(row):
+        """(id, username, text, timestamp, is_admin, room, attachment) 转换为消息字典"""
+        message = {
+            'id': row[0],
+            'username': row[1],
+            'text': row[2],
+            'timestamp': row[3],
+            'is_admin': bool(row[4]),
+            'room': row[5]
+        }
+        if row[6]:
+            message.update(json.loads(row[6]))
+        return message
+
+    @blocking
+    def get_last_message_id(self):
+        """获取已分配过的最大消息 ID（包括已删除的消息）"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")
+            row = cursor.fetchone()
+            cursor.execute('SELECT MAX(id) FROM messages')
+            return max(row[0] if row else 0, cursor.fetchone()[0] or 0)
+
+    def _archived_through(self):
+        """已归档的最大消息 ID，没有归档时为 0"""
+        return self.archive.last_id if self.archive else 0
+
+    def get_recent_messages(self, limit=50, room=None):
         """获取最近的消息"""
+        return self.get_messages(limit=limit, room=room)
+
+    @blocking
+    def get_messages(self, before_id=None, after_id=None, limit=50, room=None):
+        """按消息 ID 分页（keyset）获取消息，结果按时间正序排列
+
+        before_id: 返回 ID 小于它的最近 limit 条消息（向前翻页）
+        after_id: 返回 ID 大于它的最早 limit 条消息（追赶新消息）
+        都不传时返回最新的 limit 条消息；room 为 None 时不区分房间
+        数据库中不够 limit 条时继续从归档中读取更早的消息
+        """
+        archived = self._archived_through()
+        older = []
+        if after_id is not None and after_id < archived:
+            # 追赶的起点已经归档：先读归档，不够再读数据库
+            older = self.archive.read(after_id=after_id, limit=limit, room=room)
+            if len(older) >= limit:
+                return older
+            after_id, limit = archived, limit - len(older)
+        conditions, params = [], []
+        if archived:
+            # 已归档但尚未从数据库删除的消息不参与查询，避免重复
+            conditions.append('id > ?')
+            params.append(archived)
+        if room is not None:
+            conditions.append('room = ?')
+            params.append(room)
+        if after_id is not None:
+            conditions.append('id > ?')
+            params.append(after_id)
+        elif before_id is not None:
+            conditions.append('id < ?')
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'ASC' if after_id is not None else 'DESC'
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT username, text, timestamp, is_admin
+                # 基于 (room, id) 索引的范围扫描，翻页代价与表大小无关
+                cursor.execute(f'''
+                    SELECT id, username, text, timestamp, is_admin, room, attachment
                     FROM messages
-                    ORDER BY timestamp DESC
+                    {where}
+                    ORDER BY id {order}
                     LIMIT ?
-                ''', (limit,))
+                ''', params + [limit])
                 messages = cursor.fetchall()
-                return [{
-                    'username': msg[0],
-                    'text': msg[1],
-                    'timestamp': msg[2],
-                    'is_admin': bool(msg[3])
-                } for msg in messages][::-1]  # 反转列表以获得正确的时间顺序
         except Exception as e:
             print(f"获取消息历史失败: {e}")
-            return [] 
+            return older
+        if order == 'DESC':
+            messages.reverse()  # 反转列表以获得正确的时间顺序
+        messages = [self._message_from_row(msg) for msg in messages]
+        if order == 'DESC' and archived and len(messages) < limit:
+            before = min(before_id or archived + 1, archived + 1)
+            older = self.archive.read(before_id=before, limit=limit - len(messages), room=room)
+        return older + messages
+
+    @blocking
+    def backfill_search_index(self, batch_size=None):
+        """为建立全文索引之前的消息补建一批索引（从新到旧），返回是否还有未建索引的消息
+
+        每批与进度更新在同一个写事务中完成，多个进程同时执行也不会重复建立索引。
+        """
+        if not self.search_enabled:
+            return False
+        batch_size = batch_size or self.SEARCH_BACKFILL_BATCH
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute('SELECT backfill_before FROM search_index_state')
+            before = cursor.fetchone()[0]
+            if before <= 0:
+                return False
+            cursor.execute(
+                'SELECT id FROM messages WHERE id < ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                (before, batch_size - 1)
+            )
+            row = cursor.fetchone()
+            start = row[0] if row else 0
+            cursor.execute('''
+                INSERT INTO messages_fts (rowid, text)
+                SELECT id, text FROM messages WHERE id >= ? AND id < ?
+            ''', (start, before))
+            cursor.execute('UPDATE search_index_state SET backfill_before = ?', (start,))
+            conn.commit()
+            return start > 0
+
+    def start_search_backfill(self, interval=0.1):
+        """在后台线程中补建全文索引，批次之间暂停 interval 秒，避免长时间占用写锁"""
+        def run():
+            try:
+                while self.backfill_search_index():
+                    time.sleep(interval)
+            except Exception as e:
+                print(f"补建全文索引失败: {e}")
+
+        threading.Thread(target=run, name='search-backfill', daemon=True).start()
+
+    @blocking
+    def search_messages(self, query, room=None, limit=20, offset=0, order='rank'):
+        """全文搜索消息，返回 (消息列表, 是否还有更多)
+
+        多个关键词以空格分隔，须同时出现；order 为 'rank'（按相关度）或 'recent'（新消息在前）。
+        至少 3 个字符的关键词走 trigram 索引，更短的关键词在索引结果上再用 LIKE 过滤；
+        只有短关键词（或索引不可用）时按时间倒序扫描最近 SEARCH_SCAN_ROWS 条消息。
+        数据库中的结果之后接着是归档中的结果（从新到旧）。
+        """
+        terms = query.split()
+        if not terms:
+            return [], False
+        indexed = [t for t in terms if len(t) >= self.SEARCH_MIN_TERM] if self.search_enabled else []
+        archived = self._archived_through()
+        conditions, params = [], []
+        if archived:
+            conditions.append('m.id > ?')
+            params.append(archived)
+        if indexed:
+            # 每个关键词作为一个短语，避免用户输入被解析为 FTS5 查询语法
+            conditions.append('messages_fts MATCH ?')
+            params.append(' '.join('"%s"' % t.replace('"', '""') for t in indexed))
+            source = 'messages_fts JOIN messages m ON m.id = messages_fts.rowid'
+            order_by = 'messages_fts.rank' if order == 'rank' else 'messages_fts.rowid DESC'
+        else:
+            conditions.append('m.id > (SELECT COALESCE(MAX(id), 0) FROM messages) - ?')
+            params.append(self.SEARCH_SCAN_ROWS)
+            source = 'messages m'
+            order_by = 'm.id DESC'
+        for term in terms:
+            if term not in indexed:
+                conditions.append("m.text LIKE ? ESCAPE '\\'")
+                escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params.append(f'%{escaped}%')
+        if room is not None:
+            conditions.append('m.room = ?')
+            params.append(room)
+        where = ' AND '.join(conditions)
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT m.id, m.username, m.text, m.timestamp, m.is_admin, m.room, m.attachment
+                    FROM {source}
+                    WHERE {where}
+                    ORDER BY {order_by}
+                    LIMIT ? OFFSET ?
+                ''', params + [limit + 1, offset])
+                rows = cursor.fetchall()
+                if archived and not rows and offset:
+                    # 这一页已经超出数据库中的结果，需要知道数据库中共有多少条才能确定归档中跳过的条数
+                    cursor.execute(f'SELECT COUNT(*) FROM {source} WHERE {where}', params)
+                    matched = cursor.fetchone()[0]
+                else:
+                    matched = offset + len(rows)
+        except Exception as e:
+            print(f"搜索消息失败: {e}")
+            return [], False
+        messages = [self._message_from_row(row) for row in rows]
+        if archived and len(messages) <= limit:
+            messages += self.archive.search(terms, room, skip=max(0, offset - matched),
+                                            limit=limit + 1 - len(messages))
+        return messages[:limit], len(messages) > limit
 
-    def save_file_record(self, filename, filepath, filetype, filesize, user_id):
-        """保存文件记录到数据库"""
+    @blocking
+    def archive_messages(self, max_age_days):
+        """把早于 max_age_days 天的消息移入归档，返回归档的消息数
+
+        每次从最小 ID 开始，归档到第一条未过期的消息之前，保证归档和数据库以 last_id 为界；
+        每个分段写完（包括索引）后才从数据库删除，中途退出时下次会先删除已归档的消息。
+        多个进程同时调用时只有一个进程执行。
+        """
+        if self.archive is None:
+            return 0
+        lock = self.archive.lock()
+        if lock is False:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        archived = 0
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            while True:
+                last_id = self.archive.last_id
+                self._delete_archived(last_id)
+                with self.pool.connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT MIN(id) FROM messages WHERE timestamp >= ?', (cutoff,))
+                    boundary = cursor.fetchone()[0]
+                    # 没有未过期的消息时全部归档
+                    cursor.execute(f'''
+                        SELECT id, username, text, timestamp, is_admin, room, attachment
+                        FROM messages
+                        WHERE id > ? {'AND id < ?' if boundary is not None else ''}
+                        ORDER BY id
+                        LIMIT ?
+                    ''', [last_id] + ([boundary] if boundary is not None else []) + [self.archive.SEGMENT_SIZE])
+                    rows = cursor.fetchall()
+                if not rows:
+                    return archived
+                messages = [self._message_from_row(row) for row in rows]
+                # 每个分段只包含同一个月的消息
+                partition = self.archive.partition(messages[0]['timestamp'])
+                for i, message in enumerate(messages):
+                    if self.archive.partition(message['timestamp']) != partition:
+                        messages = messages[:i]
+                        break
+                self.archive.write_segment(messages)
+                # 等其他进程重新加载归档索引（最多间隔 REFRESH_INTERVAL 秒）后再删除，查询不会漏掉这些消息
+                native_sleep(self.archive.REFRESH_INTERVAL)
+                self._delete_archived(messages[-1]['id'])
+                archived += len(messages)
+        finally:
+            if lock:
+                lock.close()
+
+    def _delete_archived(self, last_id, interval=0.05):
+        """分批删除 ID 不大于 last_id 的消息，批次之间暂停，避免长时间占用写锁"""
+        while last_id:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE id <= ? ORDER BY id LIMIT ?)',
+                    (last_id, self.ARCHIVE_DELETE_BATCH)
+                )
+                conn.commit()
+                if cursor.rowcount < self.ARCHIVE_DELETE_BATCH:
+                    return
+            native_sleep(interval)
+
+    def start_archiver(self, max_age_days, interval=3600):
+        """在后台线程中每隔 interval 秒归档一次过期消息"""
+        def run():
+            while True:
+                try:
+                    count = self.archive_messages(max_age_days)
+                    if count:
+                        print(f"已归档 {count} 条消息")
+                except Exception as e:
+                    print(f"归档消息失败: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name='message-archiver', daemon=True).start()
+
+    @blocking
+    def create_room(self, name, user_id):
+        """创建聊天室"""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'INSERT INTO rooms (name, created_by) VALUES (?, ?)',
+                    (name, user_id)
+                )
+                conn.commit()
+                return True, "聊天室创建成功"
+        except sqlite3.IntegrityError:
+            return False, "聊天室已存在"
+        except Exception as e:
+            return False, f"创建聊天室失败: {str(e)}"
+
+    @blocking
+    def get_rooms(self):
+        """获取所有聊天室"""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT name, created_by, created_at FROM rooms ORDER BY id')
+                return [{
+                    'name': row[0],
+                    'created_by': row[1],
+                    'created_at': row[2]
+                } for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"获取聊天室列表失败: {e}")
+            return []
+
+    @blocking
+    def save_file_record(self, filename, filepath, filetype, filesize, user_id, file_hash=None):
+        """保存文件记录到数据库；指定 file_hash 时同时增加该内容的引用计数"""
+        try:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT INTO files (filename, filepath, filetype, filesize, uploaded_by)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (filename, filepath, filetype, filesize, user_id))
+                    INSERT INTO files (filename, filepath, filetype, filesize, uploaded_by, hash)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (filename, filepath, filetype, filesize, user_id, file_hash))
+                file_id = cursor.lastrowid
+                if file_hash:
+                    cursor.execute('''
+                        INSERT INTO file_blobs (hash, filepath, filesize, ref_count) VALUES (?, ?, ?, 1)
+                        ON CONFLICT (hash) DO UPDATE SET ref_count = ref_count + 1
+                    ''', (file_hash, filepath, filesize))
                 conn.commit()
-                return cursor.lastrowid
+                return file_id
         except Exception as e:
             print(f"保存文件记录失败: {e}")
-            return None 
\ No newline at end of file
+            return None
+
+    @blocking
+    def get_file_record(self, file_id):
+        """获取文件记录，不存在时返回 None"""
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT id, filename, filepath, filetype, filesize, hash, uploaded_at, uploaded_by
+                FROM files WHERE id = ?
+            ''', (file_id,)).fetchone()
+        if row:
+            return {
+                'id': row[0],
+                'filename': row[1],
+                'filepath': row[2],
+                'filetype': row[3],
+                'filesize': row[4],
+                'hash': row[5],
+                'uploaded_at': row[6],
+                'uploaded_by': row[7]
+            }
+        return None
+
+    @blocking
+    def delete_file_record(self, file_id):
+        """删除文件记录并减少引用计数，返回 (True, 引用归零后可以删除的文件路径或 None) 或 (False, 错误信息)"""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT hash FROM files WHERE id = ?', (file_id,))
+                row = cursor.fetchone()
+                if not row:
+                    return False, "文件不存在"
+                cursor.execute('DELETE FROM files WHERE id = ?', (file_id,))
+                unreferenced = None
+                if row[0]:
+                    cursor.execute('UPDATE file_blobs SET ref_count = ref_count - 1 WHERE hash = ?', (row[0],))
+                    cursor.execute('SELECT filepath FROM file_blobs WHERE hash = ? AND ref_count <= 0', (row[0],))
+                    blob = cursor.fetchone()
+                    if blob:
+                        cursor.execute('DELETE FROM file_blobs WHERE hash = ?', (row[0],))
+                        unreferenced = blob[0]
+                conn.commit()
+                return True, unreferenced
+        except Exception as e:
+            print(f"删除文件记录失败: {e}")
+            return False, str(e) 
\ No newline at end of file
@@ -0,0 +1,81 @@
+import _thread
+import functools
+import os
+import time
+
+# 服务器并发模型：
+# - 'threading'：Werkzeug 开发服务器，每个连接占用一个系统线程
+# - 'gevent'   ：gevent 协程服务器，每个连接只占用一个协程，适合大量空闲长连接
+ASYNC_MODES = ('threading', 'gevent')
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"未知的并发模式: {ASYNC_MODE}")
+
+# 协程模式下执行阻塞调用（SQLite）的系统线程数
+BLOCKING_THREADS = int(os.environ.get('CHAT_BLOCKING_THREADS', 8))
+
+_threadpool = None
+_start_native_thread = _thread.start_new_thread
+_native_sleep = time.sleep
+
+if ASYNC_MODE == 'gevent':
+    # 必须在导入 threading、socket 等模块的其他代码之前打补丁，因此本模块要最先导入
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError("CHAT_ASYNC_MODE=gevent 需要安装 gevent：pip install -r requirements.txt")
+    monkey.patch_all()
+    _start_native_thread = monkey.get_original('_thread', 'start_new_thread')
+    _native_sleep = monkey.get_original('time', 'sleep')
+
+    from gevent.threadpool import ThreadPool
+    _threadpool = ThreadPool(BLOCKING_THREADS)
+
+
+def run_blocking(func, *args, **kwargs):
+    """执行阻塞调用：协程模式下交给线程池执行，等待期间事件循环继续处理其他连接
+
+    在线程池内部再次调用时直接执行，不会重复派发。
+    """
+    if _threadpool is None:
+        return func(*args, **kwargs)
+    return _threadpool.apply(func, args, kwargs)
+
+
+def blocking(func):
+    """把方法标记为阻塞调用，执行方式见 run_blocking"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_blocking(func, *args, **kwargs)
+    wrapper.blocking = True
+    return wrapper
+
+
+def is_blocking(func):
+    """是否为 @blocking 标记的方法"""
+    return getattr(func, 'blocking', False)
+
+
+def start_native_thread(func, *args):
+    """启动一个系统线程，返回线程 ID
+
+    协程模式下 threading 创建的是协程，只有事件循环空闲时才会运行；
+    需要与事件循环并行运行的任务（如采样分析器）使用系统线程，其中只能使用 native_sleep 等待。
+    """
+    return _start_native_thread(func, args)
+
+
+def native_sleep(seconds):
+    _native_sleep(seconds)
+
+
+def stats():
+    """线程池使用情况"""
+    if _threadpool is None:
+        return {'async_mode': ASYNC_MODE}
+    return {
+        'async_mode': ASYNC_MODE,
+        'threads': _threadpool.size,
+        'max_threads': _threadpool.maxsize,
+        'pending': _threadpool.task_queue.qsize(),
+    }
@@ -0,0 +1,266 @@
+import threading
+import time
+from collections import deque
+
+from engineio import packet as eio_packet
+from socketio import packet as sio_packet
+
+
+class SocketIOTransport:
+    """把事件编码为 Engine.IO 数据包并直接发给本进程的连接（不经过消息总线）"""
+
+    def __init__(self, server, namespace='/'):
+        self.server = server
+        self.namespace = namespace
+
+    def encode(self, event, data):
+        """事件只编码一次，所有接收者共用同一组数据包"""
+        pkt = self.server.packet_class(sio_packet.EVENT, namespace=self.namespace, data=[event, data])
+        encoded = pkt.encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+    def _eio_sid(self, sid):
+        return self.server.manager.eio_sid_from_sid(sid, self.namespace)
+
+    def backlog(self, sid):
+        """连接在 Engine.IO 层尚未发出的数据包数"""
+        socket = self.server.eio.sockets.get(self._eio_sid(sid))
+        return socket.queue.qsize() if socket is not None else 0
+
+    def send(self, sid, packets):
+        eio_sid = self._eio_sid(sid)
+        if eio_sid is None:
+            return
+        for p in packets:
+            self.server._send_eio_packet(eio_sid, p)  # 与 socketio 自带的房间广播走同一发送路径
+
+
+class ClientQueue:
+    """单个连接的出站队列"""
+    __slots__ = ('sid', 'items', 'scheduled', 'sent', 'dropped')
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.items = deque()    # (入队时间, 是否临时事件, 数据包)
+        self.scheduled = False  # 是否已在待发送队列中
+        self.sent = 0
+        self.dropped = 0
+
+    def lag(self, now):
+        """最早一条未发送事件已等待的时间（秒）"""
+        return now - self.items[0][0] if self.items else 0.0
+
+
+class Fanout:
+    """出站消息扇出：每个连接一个有界队列，由发送线程异步发送，慢连接不会拖慢广播
+
+    溢出策略：队列满时先丢弃临时事件（在线状态、系统提示等），仍放不下或
+    积压时间超过 max_lag 时调用 on_overflow（断开连接，客户端重连后按历史补齐）。
+    """
+
+    def __init__(self, transport, workers=2, max_depth=500, max_lag=30,
+                 high_water=64, batch_size=32, retry_interval=0.05, on_overflow=None):
+        self.transport = transport
+        self.max_depth = max_depth
+        self.max_lag = max_lag
+        self.high_water = high_water            # Engine.IO 层积压超过该值时暂停向该连接发送
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.on_overflow = on_overflow          # on_overflow(sid)
+        self._queues = {}                       # sid -> ClientQueue
+        self._ready = deque()                   # 有待发送事件的连接
+        self._stalled = []                      # 因积压暂停发送的连接，定期重试
+        self._retry_at = 0
+        self._cond = threading.Condition()
+        self._stats = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'overflows': 0}
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'fanout-{i}', daemon=True).start()
+
+    def open(self, sid):
+        with self._cond:
+            self._queues.setdefault(sid, ClientQueue(sid))
+
+    def close(self, sid):
+        """连接断开时丢弃其队列"""
+        with self._cond:
+            self._queues.pop(sid, None)
+
+    def enqueue(self, sids, event, data, ephemeral=False):
+        """把事件放入多个连接的出站队列，立即返回"""
+        packets = self.transport.encode(event, data)
+        item = (time.monotonic(), ephemeral, packets)
+        overflowed = []
+        with self._cond:
+            for sid in sids:
+                queue = self._queues.get(sid)
+                if queue is None:
+                    continue
+                if not self._push(queue, item):
+                    overflowed.append(sid)
+                    continue
+                if not queue.scheduled and queue.items:
+                    queue.scheduled = True
+                    self._ready.append(queue)
+            self._cond.notify_all()
+        for sid in overflowed:
+            self._overflow(sid)
+
+    def _push(self, queue, item):
+        """放入队列，返回 False 表示非临时事件放不下"""
+        if len(queue.items) < self.max_depth:
+            queue.items.append(item)
+            self._stats['enqueued'] += 1
+            return True
+        if item[1]:
+            queue.dropped += 1
+            self._stats['dropped'] += 1
+            return True
+        # 丢弃最早的一条临时事件腾出空间
+        for i, queued in enumerate(queue.items):
+            if queued[1]:
+                del queue.items[i]
+                queue.dropped += 1
+                self._stats['dropped'] += 1
+                queue.items.append(item)
+                self._stats['enqueued'] += 1
+                return True
+        return False
+
+    def _overflow(self, sid):
+        with self._cond:
+            if self._queues.pop(sid, None) is None:
+                return
+            self._stats['overflows'] += 1
+        if self.on_overflow:
+            try:
+                self.on_overflow(sid)
+            except Exception as e:
+                print(f"断开慢连接失败: {e}")
+
+    def _next_queue(self):
+        with self._cond:
+            while True:
+                if self._stalled and time.monotonic() >= self._retry_at:
+                    self._ready.extend(self._stalled)
+                    self._stalled.clear()
+                if self._ready:
+                    return self._ready.popleft()
+                self._cond.wait(self.retry_interval)
+
+    def _run(self):
+        while True:
+            queue = self._next_queue()
+            try:
+                self._drain(queue)
+            except Exception as e:
+                print(f"发送出站消息失败: {e}")
+
+    def _drain(self, queue):
+        while True:
+            with self._cond:
+                if self._queues.get(queue.sid) is not queue:
+                    return
+                if not queue.items:
+                    queue.scheduled = False
+                    return
+                if self.transport.backlog(queue.sid) >= self.high_water:
+                    if queue.lag(time.monotonic()) > self.max_lag:
+                        overflow = True
+                    else:
+                        if not self._stalled:
+                            self._retry_at = time.monotonic() + self.retry_interval
+                        self._stalled.append(queue)
+                        return
+                else:
+                    overflow = False
+                    count = min(self.batch_size, len(queue.items))
+                    batch = [queue.items.popleft()[2] for _ in range(count)]
+                    queue.sent += count
+                    self._stats['sent'] += count
+            if overflow:
+                self._overflow(queue.sid)
+                return
+            for packets in batch:
+                self.transport.send(queue.sid, packets)
+
+    def stats(self, top=10):
+        """总计数据，以及积压最严重的 top 个连接的队列深度和延迟"""
+        now = time.monotonic()
+        with self._cond:
+            queues = [{
+                'sid': q.sid,
+                'depth': len(q.items),
+                'lag': round(q.lag(now), 3),
+                'sent': q.sent,
+                'dropped': q.dropped,
+            } for q in self._queues.values()]
+            stats = dict(self._stats, connections=len(self._queues),
+                         depth=sum(q['depth'] for q in queues), stalled=len(self._stalled))
+        queues.sort(key=lambda q: (q['lag'], q['depth']), reverse=True)
+        stats['slowest'] = queues[:top]
+        return stats
+
+
+class MessageBatcher:
+    """把同一房间短时间内的多条消息合并为一次广播，减少数据包数量
+
+    一批消息中第一条最多等待 max_delay 秒，攒满 max_size 条时立即发送，
+    因此批量带来的额外延迟有上限。
+    """
+
+    def __init__(self, flush, max_delay=0.005, max_size=50):
+        self.flush = flush                      # flush(room, messages)
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self._pending = {}                      # room -> (截止时间, 消息列表)
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()      # 保证同一房间的批次按顺序发出
+        self._stats = {'messages': 0, 'batches': 0}
+        threading.Thread(target=self._run, name='message-batcher', daemon=True).start()
+
+    def add(self, room, message):
+        with self._cond:
+            self._stats['messages'] += 1
+            entry = self._pending.get(room)
+            if entry is None:
+                entry = self._pending[room] = (time.monotonic() + self.max_delay, [])
+                self._cond.notify()
+            entry[1].append(message)
+            full = len(entry[1]) >= self.max_size
+        if full:
+            self._send(lambda room_, entry_: room_ == room and len(entry_[1]) >= self.max_size)
+
+    def _send(self, predicate):
+        """取出满足条件的批次并发送"""
+        with self._send_lock:
+            with self._cond:
+                batches = [(room, entry[1]) for room, entry in self._pending.items() if predicate(room, entry)]
+                for room, _ in batches:
+                    del self._pending[room]
+                self._stats['batches'] += len(batches)
+            for room, messages in batches:
+                try:
+                    self.flush(room, messages)
+                except Exception as e:
+                    print(f"批量广播消息失败: {e}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    remaining = min(entry[0] for entry in self._pending.values()) - now
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self._send(lambda room, entry: entry[0] <= now)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=sum(len(entry[1]) for entry in self._pending.values()),
+                        max_delay=self.max_delay, max_size=self.max_size)
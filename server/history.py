@@ -0,0 +1,115 @@
+import json
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+
+class MessageRecord:
+    """环形缓冲区中的一条消息，JSON 只在写入时序列化一次"""
+    __slots__ = ('id', 'message', 'json', 'size')
+
+    def __init__(self, message):
+        self.id = message['id']
+        self.message = message
+        self.json = json.dumps(message, ensure_ascii=False)
+        self.size = (sys.getsizeof(self) + sys.getsizeof(message) + sys.getsizeof(self.json)
+                     + sum(sys.getsizeof(v) for v in message.values()))
+
+
+class MessageRing:
+    """单个房间最近消息的定长环形缓冲区，窗口内的历史查询无需访问数据库"""
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._records = deque(maxlen=capacity)
+        self._ids = deque(maxlen=capacity)  # 与 _records 一一对应，用于二分查找
+        self._floor = 0     # 缓冲区保证包含所有 ID 大于 floor 的消息
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def warm(self, messages, complete):
+        """用数据库中最近的消息预热；complete 表示 messages 已是该房间的全部历史"""
+        with self._lock:
+            self._records.clear()
+            self._ids.clear()
+            self._bytes = 0
+            for message in messages[-self.capacity:]:
+                self._push(MessageRecord(message))
+            if complete and len(messages) <= self.capacity:
+                self._floor = 0
+            elif self._ids:
+                self._floor = self._ids[0] - 1
+
+    def append(self, message):
+        with self._lock:
+            record = MessageRecord(message)
+            if not self._ids or record.id > self._ids[-1]:
+                self._push(record)
+            elif record.id > self._floor:
+                self._insert(record)
+
+    def _insert(self, record):
+        """按 ID 顺序插入（其他进程的消息可能晚于本进程更新的消息到达）"""
+        index = bisect_left(self._ids, record.id)
+        if index < len(self._ids) and self._ids[index] == record.id:
+            return
+        if len(self._records) == self.capacity:
+            if index == 0:
+                self._floor = record.id  # 放不下的旧消息只能交给数据库查询
+                return
+            evicted = self._records.popleft()
+            self._ids.popleft()
+            self._bytes -= evicted.size
+            self._floor = evicted.id
+            index -= 1
+        self._records.insert(index, record)
+        self._ids.insert(index, record.id)
+        self._bytes += record.size
+
+    def _push(self, record):
+        if len(self._records) == self.capacity:
+            evicted = self._records[0]
+            self._bytes -= evicted.size
+            self._floor = evicted.id
+        self._records.append(record)
+        self._ids.append(record.id)
+        self._bytes += record.size
+
+    def discard(self, message_id):
+        """移除一条消息（例如写入数据库失败）"""
+        with self._lock:
+            index = bisect_left(self._ids, message_id)
+            if index < len(self._ids) and self._ids[index] == message_id:
+                self._bytes -= self._records[index].size
+                del self._records[index]
+                del self._ids[index]
+
+    def page(self, before_id=None, after_id=None, limit=50):
+        """从缓冲区取一页消息，返回 (records, has_more)；窗口无法覆盖时返回 None"""
+        with self._lock:
+            if after_id is not None:
+                if after_id < self._floor:
+                    return None
+                start = bisect_right(self._ids, after_id)
+                records = [self._records[i] for i in range(start, min(start + limit + 1, len(self._records)))]
+                return records[:limit], len(records) > limit
+
+            end = len(self._ids) if before_id is None else bisect_left(self._ids, before_id)
+            if end > limit:
+                return [self._records[i] for i in range(end - limit, end)], True
+            if end == limit and self._floor > 0:
+                return [self._records[i] for i in range(end)], True
+            if self._floor == 0:
+                return [self._records[i] for i in range(end)], False
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'count': len(self._records),
+                'capacity': self.capacity,
+                'bytes': self._bytes,
+                'oldest_id': self._ids[0] if self._ids else None,
+                'newest_id': self._ids[-1] if self._ids else None,
+            }
@@ -0,0 +1,259 @@
+import bisect
+import functools
+import math
+import threading
+import time
+import types
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """指标基类：按标签值保存多个子指标"""
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}     # 标签值元组 -> 子指标
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, **labels):
+        """获取指定标签值的子指标；热点路径上应预先取出并保存，避免每次查找"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """返回 [(指标名, [(标签名, 标签值)], 数值)]"""
+        result = []
+        for key, child in list(self._children.items()):
+            for suffix, extra, value in child.samples():
+                result.append((self.name + suffix, list(zip(self.labelnames, key)) + extra, value))
+        return result
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', [], self.value)]
+
+
+class Counter(Metric):
+    """只增不减的计数，名称按 Prometheus 惯例以 _total 结尾"""
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [('', [], self.value)]
+
+
+class Gauge(Metric):
+    """可增可减的当前值"""
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """装饰器：记录函数耗时（秒）"""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start)
+            return wrapper
+        return decorate
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        result, cumulative = [], 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            result.append(('_bucket', [('le', _format_value(float(bound)))], cumulative))
+        result.append(('_sum', [], total))
+        result.append(('_count', [], cumulative))
+        return result
+
+
+class Histogram(Metric):
+    """分桶统计的耗时分布"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class _Callback:
+    """在导出时才计算数值的指标（连接数、队列深度等已经由其他组件维护的数据）"""
+
+    def __init__(self, name, documentation, type, func, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.func = func    # 无标签时返回数值，有标签时返回 {标签值元组: 数值}
+
+    def samples(self):
+        value = self.func()
+        if not self.labelnames:
+            return [(self.name, [], value)]
+        return [(self.name, list(zip(self.labelnames, key)), v) for key, v in value.items()]
+
+
+class Registry:
+    """指标注册表，导出为 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已存在: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"导出指标 {metric.name} 失败: {e}")
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge_func(name, documentation, func, labelnames=()):
+    """导出时调用 func() 取值的 gauge"""
+    return REGISTRY.register(_Callback(name, documentation, 'gauge', func, labelnames))
+
+
+def counter_func(name, documentation, func, labelnames=()):
+    """导出时调用 func() 取值的 counter（例如各组件 stats() 中已有的累计数）"""
+    return REGISTRY.register(_Callback(name, documentation, 'counter', func, labelnames))
+
+
+def instrument_methods(histogram, label, include=None):
+    """类装饰器：记录类中公开方法的耗时，方法名作为 label 标签的值；include(func) 为真的方法才记录"""
+    def decorate(cls):
+        for name, func in list(vars(cls).items()):
+            if name.startswith('_') or not isinstance(func, types.FunctionType):
+                continue
+            if include is not None and not include(func):
+                continue
+            setattr(cls, name, histogram.labels(**{label: name}).time()(func))
+        return cls
+    return decorate
@@ -0,0 +1,221 @@
+import sqlite3
+
+# 数据库结构升级：版本号保存在 PRAGMA user_version 中，第 N 个升级步骤把版本从 N-1 升到 N。
+# 每个步骤在独立的事务中执行并同时更新版本号，中途失败不会留下半升级的状态。
+# 引入版本号之前创建的数据库版本为 0，各步骤都可以在已有部分表和字段的数据库上重复执行。
+# 新增结构时只能在末尾追加步骤，不要修改已发布的步骤。
+MIGRATIONS = []
+
+
+def migration(func):
+    """注册升级步骤，步骤的版本号为注册顺序；函数的文档字符串作为升级说明"""
+    MIGRATIONS.append(func)
+    return func
+
+
+def _columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+@migration
+def create_base_tables(cursor, db):
+    """创建用户、禁言、文件、消息和聊天室表"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT UNIQUE,
+            is_admin BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            status TEXT DEFAULT 'active'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mutes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            muted_by INTEGER,
+            muted_until TIMESTAMP,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (muted_by) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            filetype TEXT NOT NULL,
+            filesize INTEGER NOT NULL,
+            uploaded_by INTEGER,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (uploaded_by) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            text TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_admin BOOLEAN DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO rooms (name) VALUES (?)', (db.DEFAULT_ROOM,))
+
+    # 确保至少有一个管理员账户
+    cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = 1')
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(
+            'INSERT OR IGNORE INTO users (username, password, is_admin) VALUES (?, ?, ?)',
+            ("admin", db.hash_password("admin123"), True)
+        )
+
+
+@migration
+def add_message_rooms(cursor, db):
+    """消息表添加房间字段和按房间、ID、时间查询的索引"""
+    # 旧数据库的消息全部归入默认房间
+    if 'room' not in _columns(cursor, 'messages'):
+        cursor.execute(f"ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{db.DEFAULT_ROOM}'")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+
+
+@migration
+def add_file_hashes(cursor, db):
+    """文件表添加内容哈希字段，创建按内容哈希存储的文件表"""
+    # 相同内容的文件共用一份存储
+    if 'hash' not in _columns(cursor, 'files'):
+        cursor.execute('ALTER TABLE files ADD COLUMN hash TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_hash ON files(hash)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_blobs (
+            hash TEXT PRIMARY KEY,
+            filepath TEXT NOT NULL,
+            filesize INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+@migration
+def add_message_attachments(cursor, db):
+    """消息表添加附件字段"""
+    # 文件消息的文件名、地址等以 JSON 保存，text 为文件名
+    if 'attachment' not in _columns(cursor, 'messages'):
+        cursor.execute('ALTER TABLE messages ADD COLUMN attachment TEXT')
+
+
+@migration
+def create_search_index(cursor, db):
+    """创建消息全文索引
+
+    messages_fts 是 messages 的 FTS5 外部内容表（只保存索引，不重复保存消息内容），
+    使用 trigram 分词，中文等不以空格分词的文字也能按子串搜索。新消息由触发器同步写入索引；
+    建索引前已有的消息由 Database.backfill_search_index 从新到旧分批补建，
+    ID 小于 search_index_state.backfill_before 的消息尚未建立索引。
+    SQLite 不支持时跳过，搜索使用 LIKE。
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    if cursor.fetchone() is None:
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE messages_fts USING fts5(
+                    text, content='messages', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            # SQLite 未编译 FTS5 或低于 3.34（不支持 trigram）
+            print(f"创建全文索引失败，搜索将使用 LIKE: {e}")
+            return
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_index_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                backfill_before INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            INSERT OR REPLACE INTO search_index_state (id, backfill_before)
+            SELECT 1, COALESCE(MAX(id), 0) + 1 FROM messages
+        ''')
+    # 尚未补建索引的消息由补建任务处理，触发器跳过，保证每条消息只索引一次
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        WHEN new.id >= (SELECT backfill_before FROM search_index_state) BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        WHEN old.id >= (SELECT backfill_before FROM search_index_state) BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages
+        WHEN old.id >= (SELECT backfill_before FROM search_index_state) BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+
+
+@migration
+def add_lookup_indexes(cursor, db):
+    """添加禁言查询和按上传者查询文件的索引"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mutes_user_until ON mutes(user_id, muted_until)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_uploaded_by ON files(uploaded_by)')
+
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, db):
+    """把数据库升级到最新版本，返回 (升级前版本, 当前版本)
+
+    已是最新版本时只读取一次版本号。多个进程同时启动时，每一步都在写事务中重新检查版本，
+    已由其他进程完成的步骤会被跳过。升级在 WAL 模式下进行，期间其他连接仍可读取。
+    """
+    start = schema_version(conn)
+    if start > LATEST_VERSION:
+        print(f"数据库版本 {start} 高于程序支持的版本 {LATEST_VERSION}，请升级程序")
+        return start, start
+    if start == LATEST_VERSION:
+        return start, start
+
+    for version, step in enumerate(MIGRATIONS, 1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(conn.cursor(), db)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"数据库已升级到版本 {version}: {step.__doc__.splitlines()[0]}")
+    # 新建的索引需要统计信息，查询规划器才会使用
+    conn.execute('PRAGMA optimize')
+    return start, LATEST_VERSION
@@ -0,0 +1,75 @@
+import heapq
+import threading
+from datetime import datetime
+
+
+class ModerationCache:
+    """内存中的禁言/封禁状态，由 Database 写穿更新，过期禁言由定时堆清理"""
+
+    def __init__(self):
+        self._mutes = {}        # user_id -> (muted_until, reason)
+        self._banned = set()    # 被封禁的 user_id
+        self._heap = []         # (muted_until, user_id) 过期时间堆
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._expire_loop, name='mute-expiry', daemon=True)
+        self._thread.start()
+
+    def load(self, mutes, banned_ids):
+        """启动时从数据库加载：mutes 为按时间先后排列的 (user_id, muted_until, reason)"""
+        with self._cond:
+            self._mutes.clear()
+            self._banned = set(banned_ids)
+            self._heap = []
+            for user_id, muted_until, reason in mutes:
+                self._mutes[user_id] = (muted_until, reason)
+            for user_id, (muted_until, _) in self._mutes.items():
+                heapq.heappush(self._heap, (muted_until, user_id))
+            self._cond.notify()
+
+    def set_mute(self, user_id, muted_until, reason=None):
+        with self._cond:
+            self._mutes[user_id] = (muted_until, reason)
+            heapq.heappush(self._heap, (muted_until, user_id))
+            self._cond.notify()
+
+    def clear_mute(self, user_id):
+        with self._cond:
+            self._mutes.pop(user_id, None)
+
+    def get_mute(self, user_id):
+        """返回 (muted_until, reason)，未被禁言时返回 None"""
+        entry = self._mutes.get(user_id)
+        if entry and entry[0] > datetime.now():
+            return entry
+        return None
+
+    def set_banned(self, user_id, banned):
+        with self._cond:
+            if banned:
+                self._banned.add(user_id)
+            else:
+                self._banned.discard(user_id)
+
+    def is_banned(self, user_id):
+        return user_id in self._banned
+
+    def stats(self):
+        with self._cond:
+            return {'muted': len(self._mutes), 'banned': len(self._banned), 'timers': len(self._heap)}
+
+    def _expire_loop(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                muted_until, user_id = self._heap[0]
+                delay = (muted_until - datetime.now()).total_seconds()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                # 只有当前生效的禁言到期时才移除，被覆盖的旧定时器直接丢弃
+                entry = self._mutes.get(user_id)
+                if entry and entry[0] == muted_until:
+                    del self._mutes[user_id]
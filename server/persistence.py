@@ -0,0 +1,174 @@
+import threading
+import time
+
+
+class PendingWrite:
+    """一条等待落盘的消息"""
+    __slots__ = ('message', 'on_error', 'done', 'ok', 'queued_at')
+
+    def __init__(self, message, on_error=None):
+        self.message = message
+        self.on_error = on_error
+        self.done = threading.Event()
+        self.ok = False
+        self.queued_at = time.monotonic()
+
+    def wait(self, timeout=None):
+        """等待写入完成，返回是否成功；超时返回 None，表示结果未知（消息之后仍可能写入成功）"""
+        if not self.done.wait(timeout):
+            return None
+        return self.ok
+
+
+class MessageWriter:
+    """消息异步落盘：消息先进入内存队列，由后台线程批量提交（group commit）
+
+    消息 ID 在入队时按顺序分配，广播前即可确定。
+
+    durability 取值：
+    - 'sync'  ：等待消息所在批次提交后才返回，调用方据此决定是否广播；
+                提交较慢时只记录日志，不会在结果未知时返回失败
+    - 'async' ：入队即返回，写入失败时通过 on_error 回调通知发送者
+    """
+
+    MODES = ('sync', 'async')
+
+    def __init__(self, db, durability='async', batch_size=100, flush_interval=0.05,
+                 max_queue=10000, slow_write_warning=5, id_allocator=None):
+        if durability not in self.MODES:
+            raise ValueError(f"未知的持久化模式: {durability}")
+        self.db = db
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.slow_write_warning = slow_write_warning  # 'sync' 模式等待超过该时间（秒）时记录日志
+        self._queue = []
+        self._flush_requested = False   # flush() 要求立即提交队列中的消息
+        self._flushing = 0              # 正在提交的消息数
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {'queued': 0, 'written': 0, 'failed': 0, 'batches': 0}
+        # 默认在进程内分配消息 ID；多进程部署时传入共享的分配函数
+        self._id_allocator = id_allocator
+        self._next_id = db.get_last_message_id() + 1
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, message, on_error=None):
+        """提交一条消息，返回 False 表示消息未能进入队列或同步写入失败"""
+        pending = self.submit(message, on_error)
+        return pending is not None and self.confirm(pending)
+
+    def submit(self, message, on_error=None):
+        """为消息分配 ID 并放入写入队列；队列已满时阻塞等待，写入器已关闭时返回 None
+
+        on_error 只在 'async' 模式下调用，'sync' 模式的失败由 confirm() 的返回值体现。
+        """
+        pending = PendingWrite(message, on_error if self.durability == 'async' else None)
+        with self._cond:
+            while not self._closed and len(self._queue) >= self.max_queue:
+                self._cond.wait()
+            if self._closed:
+                return None
+            if self._id_allocator is not None:
+                message['id'] = self._id_allocator()
+            else:
+                message['id'] = self._next_id
+                self._next_id += 1
+            self._queue.append(pending)
+            self._stats['queued'] += 1
+            self._cond.notify_all()
+        return pending
+
+    def confirm(self, pending):
+        """按持久化模式确认写入：'sync' 等待提交结果，'async' 直接返回 True"""
+        if self.durability == 'sync':
+            ok = pending.wait(self.slow_write_warning)
+            if ok is None:
+                # 超时后消息仍可能提交成功，当作失败处理会让已保存的消息不被广播，因此继续等待
+                print(f"消息 {pending.message['id']} 写入超过 {self.slow_write_warning} 秒仍未完成")
+                ok = pending.wait()
+            return ok
+        return True
+
+    def flush(self, timeout=None):
+        """等待当前已入队的消息全部提交"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._queue:
+                self._flush_requested = True    # 让写入线程立即提交
+            self._cond.notify_all()
+            while self._queue or self._flushing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=10):
+        """停止接收新消息，并把队列中剩余消息全部写完"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """写入队列统计信息"""
+        with self._cond:
+            return dict(self._stats, depth=len(self._queue), durability=self.durability)
+
+    def _next_batch(self):
+        """阻塞直到凑满一批或等待超时，返回待提交的批次"""
+        with self._cond:
+            while True:
+                if self._queue:
+                    if self._closed or self._flush_requested or len(self._queue) >= self.batch_size:
+                        break
+                    # 按队列中最早一条消息的入队时间计算，上一批次提交后剩下的消息不会多等一个间隔
+                    remaining = self._queue[0].queued_at + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+            batch = self._queue[:self.batch_size]
+            del self._queue[:self.batch_size]
+            if not self._queue:
+                self._flush_requested = False
+            self._flushing = len(batch)
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._write(batch)
+            with self._cond:
+                self._flushing = 0
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        if self.db.save_messages([p.message for p in batch]):
+            results = [(p, True) for p in batch]
+        else:
+            # 整批失败时逐条重试，找出真正写入失败的消息
+            results = [(p, self.db.save_message(p.message)) for p in batch]
+
+        with self._cond:
+            self._stats['batches'] += 1
+            for _, ok in results:
+                self._stats['written' if ok else 'failed'] += 1
+
+        for pending, ok in results:
+            pending.ok = ok
+            pending.done.set()
+            if not ok and pending.on_error:
+                try:
+                    pending.on_error(pending.message)
+                except Exception as e:
+                    print(f"消息写入失败回调出错: {e}")
@@ -0,0 +1,119 @@
+import threading
+
+
+class LocalPresenceStore:
+    """单进程内存中的在线状态：房间 -> 用户 -> 连接数"""
+
+    def __init__(self):
+        self._online = {}           # room -> {user_id: [user, 连接数]}
+
+    def add(self, room, user):
+        """增加一个连接，返回该用户是否刚刚上线"""
+        users = self._online.setdefault(room, {})
+        entry = users.get(user['user_id'])
+        if entry:
+            entry[1] += 1
+            return False
+        users[user['user_id']] = [user, 1]
+        return True
+
+    def remove(self, room, user):
+        """减少一个连接，返回该用户是否已经下线"""
+        users = self._online.get(room, {})
+        entry = users.get(user['user_id'])
+        if not entry:
+            return False
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        del users[user['user_id']]
+        if not users:
+            del self._online[room]
+        return True
+
+    def snapshot(self, room):
+        return [entry[0] for entry in self._online.get(room, {}).values()]
+
+    def rooms(self):
+        return {room: len(users) for room, users in self._online.items()}
+
+
+class PresenceTracker:
+    """房间在线状态：按用户计数（同一用户多个标签页只算一次），变化在防抖窗口内合并后批量发布
+
+    store 默认保存在本进程内存中，多进程部署时可替换为共享存储（见 server.bus）。
+    """
+
+    def __init__(self, publish, window=0.5, store=None):
+        self.publish = publish      # publish(room, joined, left)，joined/left 为用户信息列表
+        self.window = window
+        self.store = store or LocalPresenceStore()
+        self._pending = {}          # room -> {user_id: (user, 'join' | 'leave')}
+        self._timers = {}           # room -> 等待发布的 Timer
+        self._lock = threading.Lock()
+        self._stats = {'deltas': 0, 'coalesced': 0}
+
+    def join(self, room, user):
+        """用户的一个连接进入房间，返回是否为该用户在房间中的第一个连接"""
+        with self._lock:
+            if not self.store.add(room, user):
+                return False
+            self._record(room, user, 'join')
+            return True
+
+    def leave(self, room, user):
+        """用户的一个连接离开房间，返回是否为该用户在房间中的最后一个连接"""
+        with self._lock:
+            if not self.store.remove(room, user):
+                return False
+            self._record(room, user, 'leave')
+            return True
+
+    def snapshot(self, room):
+        """房间当前在线用户的完整列表"""
+        with self._lock:
+            return [self._public(user) for user in self.store.snapshot(room)]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats,
+                        rooms=self.store.rooms(),
+                        pending=sum(len(changes) for changes in self._pending.values()))
+
+    @staticmethod
+    def _public(user):
+        return {'username': user['username'], 'is_admin': user['is_admin']}
+
+    def _record(self, room, user, action):
+        changes = self._pending.setdefault(room, {})
+        previous = changes.get(user['user_id'])
+        if previous and previous[1] != action:
+            # 窗口内先加入再离开（或反之）相互抵消
+            del changes[user['user_id']]
+            self._stats['coalesced'] += 1
+        else:
+            changes[user['user_id']] = (user, action)
+        if room not in self._timers:
+            timer = threading.Timer(self.window, self._flush, args=(room,))
+            timer.daemon = True
+            self._timers[room] = timer
+            timer.start()
+
+    def _flush(self, room):
+        with self._lock:
+            self._timers.pop(room, None)
+            changes = self._pending.pop(room, {})
+        joined = [self._public(user) for user, action in changes.values() if action == 'join']
+        left = [self._public(user) for user, action in changes.values() if action == 'leave']
+        if joined or left:
+            self._stats['deltas'] += 1
+            self.publish(room, joined, left)
+
+    def flush_all(self):
+        """立即发布所有房间待发布的变化"""
+        with self._lock:
+            rooms = list(self._timers)
+            for room in rooms:
+                self._timers.pop(room).cancel()
+        for room in rooms:
+            self._flush(room)
@@ -0,0 +1,192 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from server.engine import native_sleep, start_native_thread
+
+# 叶子帧为这些函数时视为线程在等待（锁、条件变量、队列、网络 IO），默认不计入统计
+IDLE_FUNCTIONS = {
+    'wait', '_wait_for_tstate_lock', 'acquire', 'acquire_with_timeout', 'get', 'join', 'sleep', 'select', 'poll',
+    'accept', 'recv', 'recv_into', 'readinto', 'readline', 'switch', 'run',
+}
+IDLE_MODULES = ('threading.py', '_threading.py', 'queue.py', 'selectors.py', 'socket.py', 'ssl.py', 'hub.py',
+                'threadpool.py', 'simple_websocket/ws.py', 'wsproto', 'serving.py', 'socketserver.py')
+
+# 摘要中按调用栈归类统计的耗时来源：(名称, 帧标签中包含的路径片段)
+CATEGORIES = (
+    ('sqlite', ('server/database.py', 'server/bus.py', 'sqlite3/')),
+    ('json', ('json/',)),
+    ('emit', ('server/fanout.py', 'socketio/', 'engineio/', 'simple_websocket/', 'geventwebsocket/')),
+)
+
+
+def _frame_label(code):
+    """函数标签：函数名 (上级目录/文件名:定义行号)，按函数而不是按行聚合"""
+    filename = code.co_filename.replace('\\', '/')
+    short = '/'.join(filename.rsplit('/', 2)[-2:])
+    return f'{code.co_name} ({short}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """采样分析器：在独立的系统线程中定期读取所有线程的调用栈，按调用栈计数
+
+    协程模式下正在运行的协程位于主线程的调用栈中，同样可以采样到。
+    结果为 collapsed stack 格式（每行 "线程;外层函数;...;内层函数 次数"），
+    可以直接交给 flamegraph.pl 或 speedscope 生成火焰图。
+    """
+
+    def __init__(self, output_folder='profiles', interval=0.01, max_duration=300):
+        self.output_folder = output_folder
+        self.interval = interval            # 采样间隔（秒）
+        self.max_duration = max_duration    # 单次采样的最长时间，到期自动停止
+        self._stacks = Counter()
+        self._idle = 0
+        self._samples = 0
+        self._running = False
+        self._sampler_alive = False         # 采样线程是否仍在运行（stop 之后最多再运行一个采样间隔）
+        self._started_at = None
+        self._stopped_at = None
+        self._deadline = None
+        self.last_path = None               # 最近一次写出的结果文件
+        self._lock = threading.Lock()       # 只保护 start/stop 状态，采样线程本身不加锁
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def started(self):
+        """是否进行过采样"""
+        return self._started_at is not None
+
+    def start(self, duration=None):
+        """开始采样，duration 秒后自动停止，返回 (True, 说明) 或 (False, 错误信息)"""
+        duration = min(duration or self.max_duration, self.max_duration)
+        with self._lock:
+            if self._running:
+                return False, '采样已在进行中'
+            # 等上一次的采样线程退出，否则它醒来后看到 _running 又变为 True，会与新线程同时采样
+            if not self._wait_sampler_exit():
+                return False, '上一次采样尚未结束，请稍后再试'
+            self._stacks = Counter()
+            self._idle = self._samples = 0
+            self._started_at, self._stopped_at = time.time(), None
+            self._deadline = time.monotonic() + duration
+            self._running = True
+            self._sampler_alive = True
+            start_native_thread(self._run)
+        return True, f'开始采样，{duration:g} 秒后自动停止'
+
+    def stop(self):
+        """停止采样并写出结果文件，返回 (True, 文件路径) 或 (False, 错误信息)"""
+        with self._lock:
+            if not self._running:
+                return False, '采样未在进行'
+            self._running = False
+            self._stopped_at = time.time()
+        return True, self.save()
+
+    def _wait_sampler_exit(self, timeout=1):
+        deadline = time.monotonic() + timeout
+        while self._sampler_alive and time.monotonic() < deadline:
+            time.sleep(self.interval)
+        return not self._sampler_alive
+
+    def _run(self):
+        try:
+            self._sample_loop()
+        finally:
+            self._sampler_alive = False
+
+    def _sample_loop(self):
+        names = {}
+        while self._running:
+            if time.monotonic() >= self._deadline:
+                # 到期自动停止并写出结果
+                self._running = False
+                self._stopped_at = time.time()
+                self.save()
+                break
+            if len(names) != threading.active_count():
+                # 协程模式下 threading 中的是协程，线程池中的系统线程不在其中，按 ID 命名
+                names = {t.ident: t.name for t in threading.enumerate()}
+            own = sys._getframe()
+            for ident, frame in sys._current_frames().items():
+                if frame is not own:
+                    self._sample(names.get(ident, f'thread-{ident}'), frame)
+            self._samples += 1
+            native_sleep(self.interval)
+
+    def _sample(self, thread_name, frame):
+        leaf = frame.f_code
+        if leaf.co_name in IDLE_FUNCTIONS and leaf.co_filename.replace('\\', '/').endswith(IDLE_MODULES):
+            self._idle += 1
+            return
+        labels = []
+        while frame is not None:
+            labels.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        labels.append(thread_name)
+        labels.reverse()
+        self._stacks[';'.join(labels)] += 1
+
+    def collapsed(self):
+        """collapsed stack 格式的采样结果"""
+        stacks = dict(self._stacks)  # 复制后再遍历，采样线程可能仍在写入
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+
+    def save(self):
+        """把当前结果写入 output_folder，返回文件路径"""
+        os.makedirs(self.output_folder, exist_ok=True)
+        started = datetime.fromtimestamp(self._started_at or time.time())
+        path = os.path.join(self.output_folder, f"profile-{started:%Y%m%d-%H%M%S}-{os.getpid()}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+        self.last_path = path
+        return path
+
+    def summary(self, top=15):
+        """耗时最多的函数（self 为函数本身，total 包括其调用的函数）和各类来源的占比"""
+        stacks = dict(self._stacks)
+        busy = sum(stacks.values())
+        self_counts, total_counts, categories = Counter(), Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')[1:]
+            if frames:
+                self_counts[frames[-1]] += count
+            for label in set(frames):
+                total_counts[label] += count
+            for name, patterns in CATEGORIES:
+                if any(p in stack for p in patterns):
+                    categories[name] += count
+
+        def percent(count):
+            return round(count * 100 / busy, 1) if busy else 0.0
+
+        end = self._stopped_at or time.time()
+        return {
+            'running': self._running,
+            'duration': round(end - self._started_at, 1) if self._started_at else 0,
+            'samples': self._samples,
+            'busy_samples': busy,
+            'idle_samples': self._idle,
+            'categories': {name: percent(categories[name]) for name, _ in CATEGORIES},
+            'top_self': [{'function': label, 'samples': count, 'percent': percent(count)}
+                         for label, count in self_counts.most_common(top)],
+            'top_total': [{'function': label, 'samples': count, 'percent': percent(count)}
+                          for label, count in total_counts.most_common(top)],
+        }
+
+    def format_summary(self, top=10):
+        """文本形式的摘要，用于聊天命令的回复"""
+        summary = self.summary(top)
+        state = '采样中' if summary['running'] else '已停止'
+        lines = [f"{state}，{summary['duration']} 秒，{summary['samples']} 次采样，"
+                 f"忙碌 {summary['busy_samples']}，等待 {summary['idle_samples']}",
+                 '来源: ' + '，'.join(f'{name} {pct}%' for name, pct in summary['categories'].items()),
+                 '自身耗时最多的函数:']
+        lines.extend(f"{item['percent']}% {item['function']}" for item in summary['top_self'])
+        return '\n'.join(lines)
@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """令牌桶限流：每个键（连接 sid、用户 ID）一个桶，桶容量为 burst，每秒补充 rate 个令牌
+
+    限额在每次调用时传入，同一个限流器可以对管理员和普通用户使用不同的限额。
+    桶按键的哈希分散到多个分段，每个分段一把锁，临界区只有几次算术运算，锁竞争很小。
+    """
+
+    STRIPES = 16
+
+    def __init__(self, name, idle_ttl=600):
+        self.name = name
+        self.idle_ttl = idle_ttl    # 超过该时间（秒）未使用的桶会被清理，清理后等同于满桶
+        self._stripes = [({}, threading.Lock()) for _ in range(self.STRIPES)]
+        self._swept_at = time.monotonic()
+        self._stats = {'allowed': 0, 'throttled': 0}
+
+    def allow(self, key, rate, burst, cost=1):
+        """尝试从 key 的桶中取出 cost 个令牌，返回是否允许"""
+        now = time.monotonic()
+        buckets, lock = self._stripes[hash(key) % self.STRIPES]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = burst
+                bucket = buckets[key] = [tokens, now]
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            allowed = tokens >= cost
+            bucket[0] = tokens - cost if allowed else tokens
+        # 计数不要求精确，不加锁
+        self._stats['allowed' if allowed else 'throttled'] += 1
+        if now - self._swept_at > self.idle_ttl:
+            self._sweep(now)
+        return allowed
+
+    def discard(self, key):
+        """删除 key 的桶（例如连接断开时）"""
+        buckets, lock = self._stripes[hash(key) % self.STRIPES]
+        with lock:
+            buckets.pop(key, None)
+
+    def _sweep(self, now):
+        self._swept_at = now
+        for buckets, lock in self._stripes:
+            with lock:
+                for key in [k for k, bucket in buckets.items() if now - bucket[1] > self.idle_ttl]:
+                    del buckets[key]
+
+    def stats(self):
+        keys = 0
+        for buckets, lock in self._stripes:
+            with lock:
+                keys += len(buckets)
+        return dict(self._stats, keys=keys)
@@ -0,0 +1,66 @@
+import threading
+
+
+class RoomIndex:
+    """房间成员双向索引：房间 -> 连接集合，连接 -> 房间集合"""
+
+    def __init__(self):
+        self._members = {}  # room -> set(sid)
+        self._rooms = {}    # sid -> set(room)
+        self._lock = threading.Lock()
+
+    def join(self, sid, room):
+        """加入房间，返回是否为新加入"""
+        with self._lock:
+            members = self._members.setdefault(room, set())
+            if sid in members:
+                return False
+            members.add(sid)
+            self._rooms.setdefault(sid, set()).add(room)
+            return True
+
+    def leave(self, sid, room):
+        """离开房间，返回之前是否在房间中"""
+        with self._lock:
+            members = self._members.get(room)
+            if not members or sid not in members:
+                return False
+            members.discard(sid)
+            if not members:
+                del self._members[room]
+            rooms = self._rooms.get(sid)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self._rooms[sid]
+            return True
+
+    def leave_all(self, sid):
+        """连接断开时离开所有房间，返回离开的房间列表"""
+        with self._lock:
+            rooms = self._rooms.pop(sid, set())
+            for room in rooms:
+                members = self._members.get(room)
+                if members is not None:
+                    members.discard(sid)
+                    if not members:
+                        del self._members[room]
+            return list(rooms)
+
+    def members(self, room):
+        with self._lock:
+            return list(self._members.get(room, ()))
+
+    def rooms_of(self, sid):
+        with self._lock:
+            return list(self._rooms.get(sid, ()))
+
+    def is_member(self, sid, room):
+        return sid in self._members.get(room, ())
+
+    def size(self, room):
+        return len(self._members.get(room, ()))
+
+    def stats(self):
+        with self._lock:
+            return {room: len(members) for room, members in self._members.items()}
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 系统上只在进程内互斥
+    fcntl = None
+
+SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class ContentStore:
+    """按内容哈希保存上传文件：相同内容只保存一份
+
+    文件保存在 objects/<哈希前两位>/<哈希第三、四位>/<哈希>.<扩展名>，
+    按前缀分两级目录，避免单个目录下文件过多。返回的路径都相对于 root。
+    """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, root, temp_folder):
+        self.root = root
+        self.temp_folder = temp_folder  # 需要与 root 在同一文件系统，以便直接移动文件
+        os.makedirs(temp_folder, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self):
+        """内容引用的互斥（多进程部署时使用文件锁）
+
+        移入文件与保存引用它的记录、删除最后一条引用与删除文件，都要在锁内完成，
+        否则删除可能移除刚被新上传引用的文件。锁会阻塞等待，协程模式下需在线程池中调用。
+        """
+        if fcntl is None:
+            with self._lock:
+                yield
+            return
+        with open(os.path.join(self.temp_folder, '.content.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # 每次单独打开，同一进程的不同线程之间也互斥
+            yield
+
+    @staticmethod
+    def _relative_dir(sha256):
+        return f'objects/{sha256[:2]}/{sha256[2:4]}'  # 相对路径同时用作 URL，统一使用 /
+
+    def path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    def find(self, sha256):
+        """查找已保存的相同内容，返回相对路径或 None"""
+        relative_dir = self._relative_dir(sha256)
+        try:
+            names = os.listdir(os.path.join(self.root, relative_dir))
+        except OSError:
+            return None
+        for name in names:
+            if name.split('.', 1)[0] == sha256:
+                return f'{relative_dir}/{name}'
+        return None
+
+    def put(self, source, sha256, ext):
+        """把已计算好哈希的文件移入存储，返回 (相对路径, 是否新写入)
+
+        内容已存在时直接删除 source，不再写入任何数据。需要在 lock() 内调用。
+        """
+        existing = self.find(sha256)
+        if existing:
+            os.remove(source)
+            return existing, False
+        relative_dir = self._relative_dir(sha256)
+        os.makedirs(os.path.join(self.root, relative_dir), exist_ok=True)
+        relative_path = f'{relative_dir}/{sha256}.{ext}' if ext else f'{relative_dir}/{sha256}'
+        os.replace(source, self.path(relative_path))
+        return relative_path, True
+
+    def write_temp(self, stream):
+        """边写临时文件边计算哈希，返回 (临时文件路径, sha256, 文件大小)，之后用 put 移入存储"""
+        temp_path = os.path.join(self.temp_folder, uuid.uuid4().hex)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for block in iter(lambda: stream.read(self.READ_SIZE), b''):
+                    f.write(block)
+                    sha256.update(block)
+                    size += len(block)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return temp_path, sha256.hexdigest(), size
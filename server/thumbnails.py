@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 为可选依赖，未安装时不生成缩略图
+    Image = None
+
+IMAGE_FILETYPES = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+def _render(source, targets):
+    """在子进程中执行：按 targets [(最长边像素, 输出路径)] 生成缩略图"""
+    with Image.open(source) as image:
+        largest = max(max_side for max_side, _ in targets)
+        image.draft('RGB', (largest, largest))  # JPEG 解码时直接按比例缩小，减少内存和 CPU
+        image.seek(0)  # GIF 动图只取第一帧
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        for max_side, target in targets:
+            if os.path.exists(target):
+                continue
+            copy = image.copy()
+            copy.thumbnail((max_side, max_side))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            temp = f'{target}.{os.getpid()}.tmp'
+            copy.save(temp, 'WEBP', quality=80)
+            os.replace(temp, target)
+
+
+class ThumbnailService:
+    """图片缩略图生成：在进程池中缩放，结果按内容哈希缓存在磁盘上
+
+    thumb 用于聊天窗口中显示，preview 为极小的占位图；相同内容的图片只生成一次。
+    """
+
+    SIZES = {'thumb': 320, 'preview': 32}
+
+    def __init__(self, root, workers=2):
+        self.root = root            # 与 ContentStore 相同的根目录，缩略图保存在 thumbs/ 下
+        self.enabled = Image is not None
+        # 子进程用 spawn 启动：服务进程中有线程（gevent 模式下还打了补丁），fork 出的子进程可能继承被持有的锁。
+        # spawn 的子进程会重新导入主模块，所以服务以 python -m server 启动（见 server/__main__.py）
+        self._pool = (ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                      if self.enabled else None)
+        self._stats = {'submitted': 0, 'cached': 0, 'failed': 0}
+
+    @staticmethod
+    def relative_path(sha256, kind):
+        return f'thumbs/{sha256[:2]}/{sha256}_{kind}.webp'
+
+    def paths(self, sha256):
+        """各尺寸缩略图的相对路径"""
+        return {kind: self.relative_path(sha256, kind) for kind in self.SIZES}
+
+    def supports(self, filetype):
+        return self.enabled and filetype in IMAGE_FILETYPES
+
+    def _targets(self, sha256):
+        return [(max_side, os.path.join(self.root, self.relative_path(sha256, kind)))
+                for kind, max_side in self.SIZES.items()]
+
+    def cached(self, sha256):
+        """各尺寸的缩略图是否都已生成"""
+        return all(os.path.exists(target) for _, target in self._targets(sha256))
+
+    def generate(self, source, sha256, callback):
+        """异步生成缩略图，完成后调用 callback(ok)；已缓存时立即回调"""
+        if self.cached(sha256):
+            self._stats['cached'] += 1
+            self._callback(callback, True)
+            return
+        self._stats['submitted'] += 1
+        try:
+            future = self._pool.submit(_render, source, self._targets(sha256))
+        except Exception as e:  # 进程池已关闭或子进程异常退出（BrokenProcessPool）
+            self._stats['failed'] += 1
+            print(f"提交缩略图任务失败: {e}")
+            self._callback(callback, False)
+            return
+
+        def done(f):
+            if f.cancelled():  # 进程池关闭时取消的任务
+                ok = False
+            else:
+                ok = f.exception() is None
+                if not ok:
+                    print(f"生成缩略图失败: {f.exception()}")
+            if not ok:
+                self._stats['failed'] += 1
+            self._callback(callback, ok)
+
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _callback(callback, ok):
+        try:
+            callback(ok)
+        except Exception as e:
+            print(f"缩略图回调出错: {e}")
+
+    def remove(self, sha256):
+        """删除内容对应的缩略图（内容文件已删除时调用）"""
+        for relative_path in self.paths(sha256).values():
+            try:
+                os.remove(os.path.join(self.root, relative_path))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return dict(self._stats, enabled=self.enabled)
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
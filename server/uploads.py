@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.exceptions import ClientDisconnected
+
+
+class UploadSession:
+    """一次分片上传的状态"""
+
+    def __init__(self, upload_id, user_id, filename, size, room, created_at=None, received=0):
+        self.upload_id = upload_id
+        self.user_id = user_id
+        self.filename = filename
+        self.size = size
+        self.room = room
+        self.created_at = created_at or time.time()
+        self.received = received
+        self.sha256 = None          # 增量哈希，进程重启后按已接收的数据重建
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'user_id': self.user_id,
+            'filename': self.filename,
+            'size': self.size,
+            'room': self.room,
+            'created_at': self.created_at,
+        }
+
+
+class UploadManager:
+    """分片断点续传：init 创建会话，按偏移量逐片写入磁盘并增量计算 SHA-256，finalize 后才算上传完成
+
+    会话元数据保存在临时目录中的 JSON 文件里，已接收字节数以 .part 文件大小为准，
+    因此连接断开、进程重启或换到其他进程后都可以继续上传。
+    """
+
+    READ_SIZE = 64 * 1024           # 从请求流中每次读取的字节数
+
+    def __init__(self, temp_folder, max_size, chunk_size=1024 * 1024, expire=24 * 3600):
+        self.temp_folder = temp_folder
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.expire = expire        # 超过该时间（秒）未完成的上传会被清理
+        self._sessions = {}
+        self._lock = threading.Lock()
+        os.makedirs(temp_folder, exist_ok=True)
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.temp_folder, f'{upload_id}.part')
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.temp_folder, f'{upload_id}.json')
+
+    def init(self, user_id, filename, size, room):
+        """创建上传会话，返回 (True, session) 或 (False, 错误信息)"""
+        if size < 0 or size > self.max_size:
+            return False, f'文件大小不能超过 {self.max_size // (1024 * 1024)}MB'
+        self.cleanup()
+        session = UploadSession(uuid.uuid4().hex, user_id, filename, size, room)
+        session.sha256 = hashlib.sha256()
+        open(self._part_path(session.upload_id), 'wb').close()
+        with open(self._meta_path(session.upload_id), 'w') as f:
+            json.dump(session.to_dict(), f)
+        with self._lock:
+            self._sessions[session.upload_id] = session
+        return True, session
+
+    def get(self, upload_id, user_id):
+        """获取当前用户的上传会话，不存在时返回 None"""
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if session is None:
+                session = self._load(upload_id)
+                if session is not None:
+                    self._sessions[upload_id] = session
+        if session is None or session.user_id != user_id:
+            return None
+        return session
+
+    def _load(self, upload_id):
+        """从磁盘恢复其他进程或重启前创建的会话"""
+        if not all(c in '0123456789abcdef' for c in upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+            received = os.path.getsize(self._part_path(upload_id))
+        except (OSError, ValueError):
+            return None
+        return UploadSession(received=received, **meta)
+
+    def _ensure_hash(self, session):
+        """会话从磁盘恢复时，按已接收的数据重建增量哈希"""
+        if session.sha256 is not None:
+            return
+        sha256 = hashlib.sha256()
+        with open(self._part_path(session.upload_id), 'rb') as f:
+            for block in iter(lambda: f.read(self.READ_SIZE), b''):
+                sha256.update(block)
+        session.sha256 = sha256
+
+    def write_chunk(self, session, offset, stream, length):
+        """把一个分片直接从请求流写入磁盘，返回 (True, 已接收字节数) 或 (False, 错误信息)
+
+        offset 必须等于服务器已接收的字节数，否则客户端应先查询进度再从正确位置续传。
+        """
+        with session.lock:
+            if offset != session.received:
+                return False, f'偏移量不匹配，服务器已接收 {session.received} 字节'
+            if length is None or length > self.chunk_size or offset + length > session.size:
+                return False, '分片大小无效'
+            self._ensure_hash(session)
+            try:
+                written = self._write_part(session, offset, stream, length)
+            except Exception:
+                # 写入磁盘等失败时无法确定增量哈希是否与文件一致，已接收的字节数和哈希以 .part 文件为准重建
+                session.sha256 = None
+                session.received = os.path.getsize(self._part_path(session.upload_id))
+                raise
+            session.received += written
+            if written < length:
+                # 连接中途断开：已写入的部分保留，客户端按查询到的进度续传
+                return False, f'分片不完整，服务器已接收 {session.received} 字节'
+            return True, session.received
+
+    def _write_part(self, session, offset, stream, length):
+        """从 stream 读取最多 length 字节写到 offset 处，返回写入的字节数；连接断开时返回已写入的部分"""
+        written = 0
+        with open(self._part_path(session.upload_id), 'r+b') as f:
+            f.seek(offset)
+            try:
+                while written < length:
+                    block = stream.read(min(self.READ_SIZE, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    session.sha256.update(block)  # 写入后才计入哈希，读取失败的数据块不会被计入
+                    written += len(block)
+            except (ClientDisconnected, OSError):
+                pass  # 客户端断开（Werkzeug 读取不足 Content-Length 时抛出 ClientDisconnected）
+            f.truncate(offset + written)
+        return written
+
+    def finalize(self, session, store):
+        """确认所有数据已接收，调用 store(文件路径, sha256, 文件大小) 把文件移入内容存储
+
+        返回 (True, store 的返回值) 或 (False, 错误信息)；store 出错时保留会话，客户端可以重试。
+        """
+        with session.lock:
+            if session.received != session.size:
+                return False, f'文件未上传完成，已接收 {session.received}/{session.size} 字节'
+            self._ensure_hash(session)
+            sha256 = session.sha256.hexdigest()
+            result = store(self._part_path(session.upload_id), sha256, session.size)
+            self._discard(session.upload_id)
+            return True, result
+
+    def _discard(self, upload_id):
+        with self._lock:
+            self._sessions.pop(upload_id, None)
+        for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        """本进程中未完成的上传会话数"""
+        with self._lock:
+            return {'sessions': len(self._sessions)}
+
+    def cleanup(self):
+        """清理过期未完成的上传"""
+        deadline = time.time() - self.expire
+        try:
+            names = os.listdir(self.temp_folder)
+        except OSError:
+            return
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.temp_folder, name)) < deadline:
+                    self._discard(upload_id)
+            except OSError:
+                pass
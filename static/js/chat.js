@@ -1,8 +1,33 @@
-const socket = io();
+// 重连时带上各聊天室已收到的最新消息 ID，服务器只补发断线期间的消息
+const socket = io({
+    auth: (cb) => cb({ last_ids: lastSeenIds() })
+});
 const messagesDiv = document.getElementById('messages');
 const messageInput = document.getElementById('message-input');
 const onlineUsersDiv = document.getElementById('online-users');
 const onlineCountSpan = document.getElementById('online-count');
+const roomListDiv = document.getElementById('room-list');
+
+// 聊天室状态
+const DEFAULT_ROOM = 'chat_room';
+let currentRoom = DEFAULT_ROOM;
+let allRooms = [DEFAULT_ROOM];
+const joinedRooms = new Set();
+const roomUsers = {};     // 房间 -> Map(用户名 -> 用户)
+const unreadCounts = {};  // 房间 -> 未读消息数
+const lastMessageIds = {}; // 房间 -> 已收到的最新消息 ID
+
+function lastSeenIds() {
+    const ids = {};
+    joinedRooms.forEach(room => { ids[room] = lastMessageIds[room] || 0; });
+    return ids;
+}
+
+function noteMessageIds(room, messages) {
+    messages.forEach(msg => {
+        if (msg.id > (lastMessageIds[room] || 0)) lastMessageIds[room] = msg.id;
+    });
+}
 
 // 连接状态处理
 socket.on('connect', () => {
@@ -11,20 +36,54 @@ socket.on('connect', () => {
 });
 
 socket.on('disconnect', () => {
+    // 客户端会自动重连，重连后服务器按 lastMessageIds 补发缺失的消息
     console.log('Disconnected from server');
-    showNotification('与服务器断开连接', 'error');
+    showNotification('与服务器断开连接，正在重连', 'error');
 });
 
 // 消息处理
 socket.on('message', (data) => {
-    if (data.type === 'file') {
-        appendFileMessage(data);
-    } else {
-        appendMessage(data);
+    receiveMessages(data.room, [data]);
+});
+
+// 服务器开启批量广播时，短时间内的多条消息合并为一个 messages 事件
+socket.on('messages', (data) => {
+    receiveMessages(data.room, data.messages);
+});
+
+function receiveMessages(room, messages) {
+    noteMessageIds(room || DEFAULT_ROOM, messages);
+    if (room && room !== currentRoom) {
+        unreadCounts[room] = (unreadCounts[room] || 0) + messages.length;
+        renderRoomList();
+        return;
     }
+    // 一批消息只插入和滚动一次
+    const fragment = document.createDocumentFragment();
+    messages.forEach(msg => fragment.appendChild(renderMessage(msg)));
+    messagesDiv.appendChild(fragment);
+    scrollToBottom();
+}
+
+// 缩略图生成完成：等待中的图片重新加载缩略图，生成失败时显示原图
+socket.on('thumbnail', (data) => {
+    const waiting = pendingThumbnails.get(data.thumbnail_url);
+    if (!waiting) return;
+    pendingThumbnails.delete(data.thumbnail_url);
+    const imgs = [...waiting];
+    waiting.clear();  // 取消这些图片的超时处理
+    imgs.forEach(img => {
+        if (data.ok) {
+            img.dataset.thumbnail = 'ready';
+            img.src = `${data.thumbnail_url}?ready`;  // 与加载失败的地址区分，避免使用缓存的错误响应
+        } else {
+            showOriginalImage(img, data.url);
+        }
+    });
 });
 
 socket.on('status', (data) => {
+    if (data.room && data.room !== currentRoom) return;
     appendStatus(data.message);
 });
 
@@ -36,16 +95,165 @@ socket.on('system', (data) => {
     appendStatus(data.message);
 });
 
+// 历史消息处理
+let oldestMessageId = null;   // 已加载的最早一条消息 ID
+let hasMoreHistory = false;
+let loadingHistory = false;
+
+socket.on('history', (data) => {
+    if (data.room) joinedRooms.add(data.room);
+    if (data.catchup) {
+        // 重连后补发的消息，可能已经通过实时广播收到过其中几条，先移除再按顺序追加
+        data.messages.forEach(msg => {
+            const existing = messagesDiv.querySelector(`[data-message-id="${msg.id}"]`);
+            if (existing && data.room === currentRoom) existing.remove();
+        });
+        if (data.messages.length > 0) receiveMessages(data.room, data.messages);
+        return;
+    }
+    noteMessageIds(data.room || DEFAULT_ROOM, data.messages);
+    if (data.room && data.room !== currentRoom) {
+        renderRoomList();
+        return;
+    }
+    loadingHistory = false;
+    hasMoreHistory = data.has_more;
+    if (data.replay) {
+        // 加入聊天室时回放最近的消息；gap 表示断线期间消息太多，不再逐条补发
+        if (data.gap) showNotification('断线期间消息较多，已重新加载最近的消息');
+        // 回放与实时广播分别发送，读取历史之后广播的消息可能先到达，保留比回放更新的消息
+        const lastReplayedId = data.messages.length > 0 ? data.messages[data.messages.length - 1].id : 0;
+        const newer = [...messagesDiv.querySelectorAll('[data-message-id]')]
+            .filter(element => Number(element.dataset.messageId) > lastReplayedId);
+        messagesDiv.innerHTML = '';
+        data.messages.forEach(appendMessage);
+        newer.forEach(element => messagesDiv.appendChild(element));
+        scrollToBottom();
+    } else {
+        prependMessages(data.messages);
+    }
+    if (data.messages.length > 0) {
+        oldestMessageId = data.messages[0].id;
+    }
+});
+
+// 滚动到顶部时加载更早的消息
+messagesDiv.addEventListener('scroll', () => {
+    if (messagesDiv.scrollTop === 0 && hasMoreHistory && !loadingHistory && oldestMessageId !== null) {
+        loadingHistory = true;
+        socket.emit('history', { before_id: oldestMessageId, room: currentRoom });
+    }
+});
+
 // 在线用户列表处理
+// user_list 为加入聊天室时收到的完整快照，之后只接收 presence 增量
 socket.on('user_list', (data) => {
-    updateOnlineUsers(data.users);
+    const room = data.room || DEFAULT_ROOM;
+    roomUsers[room] = new Map(data.users.map(user => [user.username, user]));
+    if (room === currentRoom) {
+        updateOnlineUsers(data.users);
+    }
+});
+
+socket.on('presence', (data) => {
+    const users = roomUsers[data.room];
+    if (!users) return;
+    data.joined.forEach(user => users.set(user.username, user));
+    data.left.forEach(user => users.delete(user.username));
+    if (data.room === currentRoom) {
+        updateOnlineUsers(Array.from(users.values()));
+    }
+});
+
+// 聊天室列表处理
+socket.on('room_list', (data) => {
+    allRooms = data.rooms;
+    renderRoomList();
+});
+
+socket.on('room_created', (data) => {
+    if (!allRooms.includes(data.room)) {
+        allRooms.push(data.room);
+        renderRoomList();
+    }
+});
+
+// 渲染聊天室列表
+function renderRoomList() {
+    roomListDiv.innerHTML = '';
+    allRooms.forEach(room => {
+        const div = document.createElement('div');
+        div.className = `room-item ${room === currentRoom ? 'active' : ''}`;
+
+        const name = document.createElement('span');
+        name.className = 'room-name';
+        name.textContent = room === DEFAULT_ROOM ? '汇生金融' : `# ${room}`;
+        div.appendChild(name);
+
+        if (unreadCounts[room]) {
+            const badge = document.createElement('span');
+            badge.className = 'room-unread';
+            badge.textContent = unreadCounts[room];
+            div.appendChild(badge);
+        }
+
+        if (joinedRooms.has(room) && room !== DEFAULT_ROOM) {
+            const leave = document.createElement('i');
+            leave.className = 'fas fa-times room-leave';
+            leave.title = '离开聊天室';
+            leave.addEventListener('click', (e) => {
+                e.stopPropagation();
+                leaveRoom(room);
+            });
+            div.appendChild(leave);
+        }
+
+        div.addEventListener('click', () => switchRoom(room));
+        roomListDiv.appendChild(div);
+    });
+}
+
+// 切换当前聊天室
+function switchRoom(room) {
+    if (room === currentRoom) return;
+    currentRoom = room;
+    unreadCounts[room] = 0;
+    messagesDiv.innerHTML = '';
+    oldestMessageId = null;
+    hasMoreHistory = false;
+    loadingHistory = false;
+    updateOnlineUsers(roomUsers[room] ? Array.from(roomUsers[room].values()) : []);
+    if (joinedRooms.has(room)) {
+        socket.emit('history', { room: room });
+    } else {
+        socket.emit('join_room', { room: room });
+    }
+    renderRoomList();
+}
+
+function leaveRoom(room) {
+    socket.emit('leave_room', { room: room });
+    joinedRooms.delete(room);
+    delete roomUsers[room];
+    if (room === currentRoom) {
+        switchRoom(DEFAULT_ROOM);
+    } else {
+        renderRoomList();
+    }
+}
+
+document.getElementById('create-room-btn').addEventListener('click', () => {
+    const name = prompt('请输入聊天室名称');
+    if (name && name.trim()) {
+        socket.emit('create_room', { name: name.trim() });
+    }
 });
 
 // 发送消息
 function sendMessage() {
     const text = messageInput.value.trim();
     if (text) {
-        socket.emit('message', { text: text });
+        socket.emit('message', { text: text, room: currentRoom });
         messageInput.value = '';
         // 自动调整输入框高度
         adjustTextareaHeight();
@@ -54,6 +262,29 @@ function sendMessage() {
 
 // 添加消息到聊天区域
 function appendMessage(data) {
+    messagesDiv.appendChild(renderMessage(data));
+    scrollToBottom();
+}
+
+function renderMessage(data) {
+    const element = data.type === 'file' ? createFileMessageElement(data) : createMessageElement(data);
+    if (data.id !== undefined) element.dataset.messageId = data.id;
+    return element;
+}
+
+// 在顶部插入更早的消息，并保持当前阅读位置
+// 切换聊天室后请求的第一页可能包含已经通过实时广播收到的消息，跳过这些消息
+function prependMessages(messages) {
+    const previousHeight = messagesDiv.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    messages
+        .filter(msg => !messagesDiv.querySelector(`[data-message-id="${msg.id}"]`))
+        .forEach(msg => fragment.appendChild(renderMessage(msg)));
+    messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+    messagesDiv.scrollTop = messagesDiv.scrollHeight - previousHeight;
+}
+
+function createMessageElement(data) {
     const div = document.createElement('div');
     // 检查消息是否是自己发送的
     const isSelf = data.username === currentUser;
@@ -90,8 +321,7 @@ function appendMessage(data) {
     content.appendChild(text);
     div.appendChild(content);
     
-    messagesDiv.appendChild(div);
-    scrollToBottom();
+    return div;
 }
 
 // 添加状态消息
@@ -220,60 +450,78 @@ fileInput.addEventListener('change', function(e) {
     uploadPreview.style.display = 'block';
 });
 
-// 发送文件
+// 发送文件：分片上传，网络中断后从服务器已接收的位置继续
+const UPLOAD_RETRY_LIMIT = 5;
+
 async function sendFile() {
     if (!currentFile) return;
+    const file = currentFile;
+    
+    // 添加进度条到预览窗口
+    const progressBar = document.createElement('div');
+    progressBar.className = 'upload-progress';
+    progressBar.innerHTML = `
+        <div class="progress-bar">
+            <div class="progress-fill"></div>
+        </div>
+        <div class="progress-text">0%</div>
+    `;
+    document.querySelector('.modal-body').appendChild(progressBar);
     
-    const formData = new FormData();
-    formData.append('file', currentFile);
+    const setProgress = (loaded) => {
+        const percent = file.size ? Math.round((loaded / file.size) * 100) : 100;
+        progressBar.querySelector('.progress-fill').style.width = percent + '%';
+        progressBar.querySelector('.progress-text').textContent = percent + '%';
+    };
     
     try {
-        const xhr = new XMLHttpRequest();
-        
-        // 添加进度条到预览窗口
-        const progressBar = document.createElement('div');
-        progressBar.className = 'upload-progress';
-        progressBar.innerHTML = `
-            <div class="progress-bar">
-                <div class="progress-fill"></div>
-            </div>
-            <div class="progress-text">0%</div>
-        `;
-        document.querySelector('.modal-body').appendChild(progressBar);
-        
-        xhr.upload.onprogress = function(e) {
-            if (e.lengthComputable) {
-                const percent = Math.round((e.loaded / e.total) * 100);
-                progressBar.querySelector('.progress-fill').style.width = percent + '%';
-                progressBar.querySelector('.progress-text').textContent = percent + '%';
-            }
-        };
+        const upload = await uploadRequest('/upload/init', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                filename: file.name,
+                size: file.size,
+                room: currentRoom
+            })
+        });
         
-        xhr.onload = function() {
-            if (xhr.status === 200) {
-                const result = JSON.parse(xhr.responseText);
-                if (result.success) {
-                    uploadPreview.style.display = 'none';
-                    currentFile = null;
-                    fileInput.value = '';
-                } else {
-                    showNotification(result.error, 'error');
-                }
-            } else {
-                showNotification('文件上传失败', 'error');
+        let offset = upload.offset;
+        let retries = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + upload.chunk_size);
+            try {
+                const result = await uploadRequest(`/upload/${upload.upload_id}?offset=${offset}`, {
+                    method: 'PUT',
+                    headers: { 'Content-Type': 'application/octet-stream' },
+                    body: chunk
+                });
+                offset = result.offset;
+                retries = 0;
+            } catch (error) {
+                if (++retries > UPLOAD_RETRY_LIMIT) throw error;
+                // 稍后查询服务器已接收的字节数，从该位置续传
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                offset = (await uploadRequest(`/upload/${upload.upload_id}`)).offset;
             }
-        };
-        
-        xhr.onerror = function() {
-            showNotification('文件上传失败', 'error');
-        };
-        
-        xhr.open('POST', '/upload', true);
-        xhr.send(formData);
+            setProgress(offset);
+        }
         
+        await uploadRequest(`/upload/${upload.upload_id}/finalize`, { method: 'POST' });
+        uploadPreview.style.display = 'none';
+        currentFile = null;
+        fileInput.value = '';
     } catch (error) {
-        showNotification('文件上传失败', 'error');
+        showNotification(error.message || '文件上传失败', 'error');
+    }
+}
+
+async function uploadRequest(url, options = {}) {
+    const response = await fetch(url, options);
+    const result = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        throw new Error(result.error || '文件上传失败');
     }
+    return result;
 }
 
 // 格式化文件大小
@@ -285,7 +533,7 @@ function formatFileSize(bytes) {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
-function appendFileMessage(data) {
+function createFileMessageElement(data) {
     const div = document.createElement('div');
     div.className = `message ${data.username === currentUser ? 'self' : ''}`;
     
@@ -300,7 +548,10 @@ function appendFileMessage(data) {
             <span class="message-time">${data.timestamp}</span>
         </div>
         ${isImage ? `
-            <img src="${data.url}" alt="${data.filename}" style="max-width: 200px; max-height: 200px;">
+            <a href="${data.url}" target="_blank">
+                <img src="${data.thumbnail_url || data.url}" alt="${data.filename}" loading="lazy"
+                     style="max-width: 200px; max-height: 200px;${data.preview_url ? ` background: url('${data.preview_url}') center / cover;` : ''}">
+            </a>
         ` : `
             <div class="file-message">
                 <i class="fas fa-file file-icon"></i>
@@ -315,9 +566,46 @@ function appendFileMessage(data) {
         `}
     `;
     
+    const img = content.querySelector('img');
+    if (img && data.thumbnail_url) {
+        watchThumbnail(img, data);
+    }
+    
     div.appendChild(content);
-    messagesDiv.appendChild(div);
-    scrollToBottom();
+    return div;
+}
+
+// 等待生成的缩略图：缩略图地址 -> 加载失败的 img 元素
+const pendingThumbnails = new Map();
+const THUMBNAIL_WAIT_MS = 5000;
+
+function watchThumbnail(img, data) {
+    // 缩略图刚上传时可能还没生成完成，加载失败后等待 thumbnail 事件，超时仍未收到则显示原图
+    img.addEventListener('error', () => {
+        const state = img.dataset.thumbnail;
+        if (state === 'original') return;
+        if (state) {
+            showOriginalImage(img, data.url);
+            return;
+        }
+        img.dataset.thumbnail = 'waiting';
+        const waiting = pendingThumbnails.get(data.thumbnail_url) || new Set();
+        waiting.add(img);
+        pendingThumbnails.set(data.thumbnail_url, waiting);
+        setTimeout(() => {
+            if (!waiting.delete(img)) return;
+            if (waiting.size === 0 && pendingThumbnails.get(data.thumbnail_url) === waiting) {
+                pendingThumbnails.delete(data.thumbnail_url);
+            }
+            showOriginalImage(img, data.url);
+        }, THUMBNAIL_WAIT_MS);
+    });
+}
+
+function showOriginalImage(img, url) {
+    img.dataset.thumbnail = 'original';
+    img.style.background = '';
+    img.src = url;
 }
 
 // 添加粘贴处理函数
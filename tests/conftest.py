@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# 测试从仓库根目录导入 server 包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def chat_app(tmp_path_factory):
+    """server.app 模块：导入时会在当前目录创建数据库和上传目录，因此切换到临时目录后再导入"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        import server.app as chat_app
+        yield chat_app
+    finally:
+        os.chdir(cwd)
+
+
+def login(chat_app, username, password):
+    client = chat_app.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def admin_client(chat_app):
+    """以默认管理员登录的 Flask 测试客户端"""
+    return login(chat_app, 'admin', 'admin123')
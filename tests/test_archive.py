@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from server.archive import MessageArchive
+from server.database import Database
+
+OLD = 40    # ID 1-40 为一年多以前的消息（跨两个月），41-60 为最近的消息
+TOTAL = 60
+PAGE = 7
+
+
+def make_messages():
+    old_start = datetime(2023, 5, 31, 23, 59, 50)
+    recent_start = datetime.now() - timedelta(hours=1)
+    messages = []
+    for i in range(1, TOTAL + 1):
+        timestamp = old_start + timedelta(seconds=i) if i <= OLD else recent_start + timedelta(seconds=i)
+        messages.append({
+            'id': i, 'username': 'alice', 'text': f'message {i}', 'is_admin': False,
+            'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            'room': 'b' if i % 3 == 0 else 'a',
+        })
+    return messages
+
+
+@pytest.fixture
+def db(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'archive'))
+    # 小分段、小数据块，少量消息就能覆盖跨分段、跨数据块的情况；测试中不用等待其他进程刷新索引
+    archive.SEGMENT_SIZE, archive.BLOCK_SIZE, archive.REFRESH_INTERVAL = 15, 4, 0
+    db = Database(str(tmp_path / 'chat.db'), archive=archive)
+    assert db.save_messages(make_messages())
+    return db
+
+
+def ids(messages):
+    return [m['id'] for m in messages]
+
+
+def walk_backward(db, room):
+    """从最新的消息开始用 before_id 向前翻页，返回每一页的 ID"""
+    pages, page = [], db.get_messages(limit=PAGE, room=room)
+    while page:
+        pages.append(ids(page))
+        page = db.get_messages(before_id=page[0]['id'], limit=PAGE, room=room)
+    return pages
+
+
+def walk_forward(db, room):
+    """从头开始用 after_id 向后翻页，返回每一页的 ID"""
+    pages, page = [], db.get_messages(after_id=0, limit=PAGE, room=room)
+    while page:
+        pages.append(ids(page))
+        page = db.get_messages(after_id=page[-1]['id'], limit=PAGE, room=room)
+    return pages
+
+
+@pytest.mark.parametrize('room', [None, 'a', 'b'])
+def test_pagination_unchanged_by_archiving(db, room):
+    backward, forward = walk_backward(db, room), walk_forward(db, room)
+
+    assert db.archive_messages(max_age_days=30) == OLD
+    assert db.archive.last_id == OLD
+    assert db.archive.stats()['segments'] > 2  # 按月分区并按 SEGMENT_SIZE 切分
+
+    assert walk_backward(db, room) == backward
+    assert walk_forward(db, room) == forward
+    expected = [i for i in range(1, TOTAL + 1) if room is None or (room == 'b') == (i % 3 == 0)]
+    assert sum(forward, []) == expected
+
+
+def test_pages_spanning_the_boundary(db):
+    db.archive_messages(max_age_days=30)
+    # 数据库中只剩未归档的消息
+    with db.pool.connection() as conn:
+        assert conn.execute('SELECT MIN(id), COUNT(*) FROM messages').fetchone() == (OLD + 1, TOTAL - OLD)
+    assert ids(db.get_messages(before_id=OLD + 5, limit=10)) == list(range(OLD - 5, OLD + 5))
+    assert ids(db.get_messages(after_id=OLD - 5, limit=10)) == list(range(OLD - 4, OLD + 6))
+    assert ids(db.get_messages(after_id=OLD - 5, limit=3)) == list(range(OLD - 4, OLD - 1))
+    assert ids(db.get_messages(before_id=OLD + 1, limit=3, room='b')) == [33, 36, 39]
+    # 归档的消息保留原有字段
+    archived = db.get_messages(before_id=2, limit=1)[0]
+    assert archived == dict(make_messages()[0], is_admin=archived['is_admin'])
+
+
+def test_archived_messages_are_searchable(db):
+    db.archive_messages(max_age_days=30)
+    messages, _ = db.search_messages('message 12')
+    assert 12 in ids(messages)
+
+
+def test_interrupted_archive_does_not_duplicate(db, monkeypatch):
+    # 分段写完后、从数据库删除前中断：已归档的消息只出现一次，下次归档时删除
+    delete_archived = db._delete_archived
+
+    def interrupted(last_id, interval=0):
+        if last_id:
+            raise RuntimeError('interrupted')
+        delete_archived(last_id)
+
+    monkeypatch.setattr(db, '_delete_archived', interrupted)
+    with pytest.raises(RuntimeError):
+        db.archive_messages(max_age_days=30)
+    monkeypatch.undo()
+
+    archived = db.archive.last_id
+    assert 0 < archived < OLD
+    assert ids(db.get_messages(after_id=0, limit=TOTAL)) == list(range(1, TOTAL + 1))
+
+    db.archive_messages(max_age_days=30)
+    assert ids(db.get_messages(after_id=0, limit=TOTAL)) == list(range(1, TOTAL + 1))
+    with db.pool.connection() as conn:
+        assert conn.execute('SELECT MIN(id) FROM messages').fetchone()[0] == OLD + 1
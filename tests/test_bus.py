@@ -0,0 +1,25 @@
+from server.bus import SQLiteBusManager
+
+
+def test_listener_starts_from_marked_position(tmp_path):
+    bus_file = str(tmp_path / 'bus.db')
+    local, remote = SQLiteBusManager(bus_file), SQLiteBusManager(bus_file)
+    remote._publish({'method': 'emit', 'event': 'before'})
+
+    # 记录位置之后、监听线程启动之前（预热缓冲区期间）发布的消息不能遗漏
+    local.mark_position()
+    remote._publish({'method': 'emit', 'event': 'during'})
+    listener = local._listen()
+    assert next(listener)['event'] == 'during'
+
+
+def test_remote_message_warms_missing_ring(chat_app, admin_client):
+    manager = chat_app.chat_manager
+    room = 'bus-room'
+    manager.chat_rooms[room] = {'name': room}
+    message = {'id': 10 ** 9, 'username': 'remote', 'text': 'hi', 'timestamp': '2024-01-01 00:00:00',
+               'is_admin': False, 'room': room}
+    assert room not in manager.history_buffers
+    manager._on_remote_deliver({'room': room, 'event': 'message', 'data': message, 'ephemeral': False})
+    assert manager.get_history(after_id=10 ** 9 - 1, room=room)['messages'] == [message]
+    del manager.chat_rooms[room], manager.history_buffers[room]
@@ -0,0 +1,115 @@
+import itertools
+import threading
+
+import pytest
+
+from server.history import MessageRing
+
+_room_names = itertools.count(1)
+
+
+@pytest.fixture
+def room(chat_app, admin_client):
+    """新建的聊天室，避免受其他测试消息的影响"""
+    name = f'catchup-{next(_room_names)}'
+    client = chat_app.socketio.test_client(chat_app.app, flask_test_client=admin_client)
+    client.emit('create_room', {'name': name})
+    client.disconnect()
+    assert name in chat_app.chat_manager.chat_rooms
+    return name
+
+
+def post(chat_app, room, count):
+    """发送 count 条消息，返回它们的 ID"""
+    manager = chat_app.chat_manager
+    for i in range(count):
+        message = {'username': 'admin', 'text': f'message {i}', 'timestamp': '2024-01-01 00:00:00',
+                   'is_admin': True}
+        assert manager.broadcast_message(message, room)
+    return [m['id'] for m in manager.get_history(limit=count, room=room)['messages']]
+
+
+def reconnect(chat_app, admin_client, last_ids):
+    """带着 last_ids 重新连接，返回收到的 history 事件（按房间）"""
+    client = chat_app.socketio.test_client(chat_app.app, flask_test_client=admin_client,
+                                           auth={'last_ids': last_ids})
+    events = client.get_received()
+    client.disconnect()
+    return {event['args'][0]['room']: event['args'][0] for event in events if event['name'] == 'history'}
+
+
+def ids(history):
+    return [m['id'] for m in history['messages']]
+
+
+def test_catchup_sends_only_missed_messages(chat_app, admin_client, room):
+    sent = post(chat_app, room, 5)
+    history = reconnect(chat_app, admin_client, {room: sent[1]})[room]
+    assert history.get('catchup') and not history.get('gap')
+    assert ids(history) == sent[2:]
+
+
+def test_catchup_when_up_to_date(chat_app, admin_client, room):
+    sent = post(chat_app, room, 3)
+    history = reconnect(chat_app, admin_client, {room: sent[-1]})[room]
+    assert history.get('catchup')
+    assert ids(history) == []
+
+
+def test_catchup_reads_database_beyond_ring(chat_app, admin_client, room, monkeypatch):
+    sent = post(chat_app, room, 6)
+    # 缓冲区只保留最近 2 条，更早的缺失消息要从数据库读取
+    chat_app.message_writer.flush()
+    ring = MessageRing(2)
+    ring.warm(chat_app.db.get_messages(limit=2, room=room), complete=False)
+    monkeypatch.setitem(chat_app.chat_manager.history_buffers, room, ring)
+    history = reconnect(chat_app, admin_client, {room: sent[0]})[room]
+    assert history.get('catchup')
+    assert ids(history) == sent[1:]
+
+
+def test_large_gap_replays_recent_messages(chat_app, admin_client, room, monkeypatch):
+    monkeypatch.setattr(chat_app.chat_manager, 'CATCHUP_LIMIT', 2)
+    monkeypatch.setattr(chat_app.chat_manager, 'HISTORY_REPLAY_SIZE', 3)
+    sent = post(chat_app, room, 6)
+    history = reconnect(chat_app, admin_client, {room: sent[0]})[room]
+    assert history.get('gap') and history.get('replay')
+    assert ids(history) == sent[-3:]
+
+
+def test_invalid_last_ids_are_ignored(chat_app, admin_client, room):
+    post(chat_app, room, 2)
+    default_room = chat_app.chat_manager.DEFAULT_ROOM
+    histories = reconnect(chat_app, admin_client, {default_room: -1, room: 'x', 'no-such-room': 1})
+    # 默认聊天室照常回放，无效的 ID 和不存在的聊天室被忽略
+    assert set(histories) == {default_room}
+    assert histories[default_room].get('replay') and not histories[default_room].get('catchup')
+
+
+def test_messages_are_published_in_id_order(chat_app, room, monkeypatch):
+    manager = chat_app.chat_manager
+    published = []
+    monkeypatch.setattr(manager, 'publish_message', lambda room, message: published.append(message['id']))
+    waiting, release = threading.Event(), threading.Event()
+    confirm = manager.writer.confirm
+
+    def slow_first(pending):
+        if pending.message['text'] == 'first':
+            waiting.set()
+            release.wait(5)
+        return confirm(pending)
+
+    monkeypatch.setattr(manager.writer, 'confirm', slow_first)
+
+    def message(text):
+        return {'username': 'admin', 'text': text, 'timestamp': '2024-01-01 00:00:00', 'is_admin': True}
+
+    first = threading.Thread(target=manager.post_message, args=(room, message('first')))
+    first.start()
+    assert waiting.wait(5)
+    # 后一条消息先确认写入，也要等前一条确认后按 ID 顺序广播
+    assert manager.post_message(room, message('second'))
+    assert published == []
+    release.set()
+    first.join()
+    assert published == sorted(published) and len(published) == 2
@@ -0,0 +1,93 @@
+import io
+
+import pytest
+
+DATA = bytes(range(256)) * 4  # 1024 字节
+
+
+@pytest.fixture
+def uploaded(admin_client):
+    response = admin_client.post('/upload', data={'file': (io.BytesIO(DATA), 'notes.txt')},
+                                 content_type='multipart/form-data')
+    assert response.status_code == 200
+    info = response.get_json()
+    return info['file_url'], f'"{info["sha256"]}"'
+
+
+def get(client, url, **headers):
+    response = client.get(url, headers=headers)
+    body = response.get_data()
+    response.close()
+    return response, body
+
+
+def test_full_download_advertises_ranges(admin_client, uploaded):
+    url, etag = uploaded
+    response, body = get(admin_client, url)
+    assert response.status_code == 200
+    assert body == DATA
+    assert response.headers['ETag'] == etag
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'immutable' in response.headers['Cache-Control']
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 99),
+    ('bytes=100-100', 100, 100),
+    ('bytes=1000-', 1000, 1023),        # 到文件末尾
+    ('bytes=-24', 1000, 1023),          # 最后 24 字节
+    ('bytes=1000-5000', 1000, 1023),    # 结束位置超出文件大小时截断
+])
+def test_range_request(admin_client, uploaded, header, start, end):
+    url, _ = uploaded
+    response, body = get(admin_client, url, Range=header)
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {start}-{end}/{len(DATA)}'
+    assert body == DATA[start:end + 1]
+
+
+def test_unsatisfiable_range(admin_client, uploaded):
+    url, _ = uploaded
+    response, _ = get(admin_client, url, Range='bytes=2000-3000')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_if_range(admin_client, uploaded):
+    url, etag = uploaded
+    # ETag 一致时续传，文件已变化（ETag 不一致）时返回完整内容
+    response, body = get(admin_client, url, Range='bytes=0-9', **{'If-Range': etag})
+    assert response.status_code == 206 and body == DATA[:10]
+    response, body = get(admin_client, url, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert response.status_code == 200 and body == DATA
+
+
+def test_if_none_match(admin_client, uploaded):
+    url, etag = uploaded
+    response, body = get(admin_client, url, **{'If-None-Match': etag})
+    assert response.status_code == 304
+    assert body == b''
+
+
+def test_download_requires_login(chat_app, uploaded):
+    url, _ = uploaded
+    response, _ = get(chat_app.app.test_client(), url)
+    assert response.status_code in (302, 401)
+
+
+def test_delete_removes_content_with_last_reference(admin_client):
+    content = b'shared content' * 10
+
+    def upload():
+        response = admin_client.post('/upload', data={'file': (io.BytesIO(content), 'shared.txt')},
+                                     content_type='multipart/form-data')
+        return response.get_json()['file_url']
+
+    first, second = upload(), upload()
+    assert admin_client.delete(first).get_json() == {'success': True, 'removed': False}
+    assert get(admin_client, second)[1] == content
+    assert admin_client.delete(second).get_json() == {'success': True, 'removed': True}
+    assert get(admin_client, second)[0].status_code == 404
+
+    # 删除后重新上传相同内容：重新写入文件
+    assert get(admin_client, upload())[1] == content
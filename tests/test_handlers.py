@@ -0,0 +1,33 @@
+import pytest
+
+
+@pytest.fixture
+def client(chat_app, admin_client):
+    client = chat_app.socketio.test_client(chat_app.app, flask_test_client=admin_client)
+    client.get_received()
+    yield client
+    client.disconnect()
+
+
+def errors(client):
+    return [event['args'][0]['message'] for event in client.get_received() if event['name'] == 'error']
+
+
+@pytest.mark.parametrize('event, data', [
+    ('message', {'text': 'hi', 'room': ['chat_room']}),
+    ('message', {'text': {'a': 1}}),
+    ('message', {'text': 'hi', 'room': 5}),
+    ('history', {'room': {'a': 1}}),
+    ('join_room', {'room': ['chat_room']}),
+])
+def test_invalid_room_is_rejected(client, event, data):
+    # 无法哈希的房间名等无效参数只返回错误，不会在处理函数中抛出异常
+    client.emit(event, data)
+    assert errors(client)
+
+
+def test_leave_invalid_room_is_ignored(client):
+    client.emit('leave_room', {'room': ['chat_room']})
+    assert client.is_connected()
+    client.emit('history', {'room': 'chat_room'})
+    assert any(event['name'] == 'history' for event in client.get_received())
@@ -0,0 +1,152 @@
+import sqlite3
+
+import pytest
+
+from server import migrations
+from server.database import Database
+
+# 引入版本号之前（user_version = 0）的数据库结构
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        email TEXT UNIQUE,
+        is_admin BOOLEAN DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_login TIMESTAMP,
+        status TEXT DEFAULT 'active'
+    );
+    CREATE TABLE mutes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        muted_by INTEGER,
+        muted_until TIMESTAMP,
+        reason TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT NOT NULL,
+        filepath TEXT NOT NULL,
+        filetype TEXT NOT NULL,
+        filesize INTEGER NOT NULL,
+        uploaded_by INTEGER,
+        uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        text TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_admin BOOLEAN DEFAULT 0
+    );
+'''
+
+
+# 只用到 DEFAULT_ROOM 和 hash_password，不打开数据库
+DB = Database.__new__(Database)
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 1)',
+                 ('admin', DB.hash_password('admin123')))
+    conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                 ('alice', DB.hash_password('secret')))
+    conn.executemany('INSERT INTO messages (username, text, timestamp) VALUES (?, ?, ?)', [
+        ('alice', f'旧消息 {i}', f'2023-05-01 10:00:{i:02d}') for i in range(10)
+    ])
+    conn.execute("INSERT INTO files (filename, filepath, filetype, filesize, uploaded_by) "
+                 "VALUES ('a.txt', 'static/uploads/a.txt', 'txt', 3, 2)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def names(conn, kind):
+    return {row[0] for row in conn.execute('SELECT name FROM sqlite_master WHERE type = ?', (kind,))}
+
+
+def test_upgrade_from_baseline(baseline_db):
+    db = Database(baseline_db)
+    conn = sqlite3.connect(baseline_db)
+    assert migrations.schema_version(conn) == migrations.LATEST_VERSION
+    assert {'room', 'attachment'} <= columns(conn, 'messages')
+    assert 'hash' in columns(conn, 'files')
+    assert {'rooms', 'file_blobs'} <= names(conn, 'table')
+    assert {'idx_messages_room_id', 'idx_messages_timestamp', 'idx_files_hash',
+            'idx_mutes_user_until', 'idx_files_uploaded_by'} <= names(conn, 'index')
+    # 已有数据保留，旧消息归入默认聊天室，不会再创建一个管理员
+    assert conn.execute('SELECT COUNT(*) FROM users WHERE is_admin = 1').fetchone()[0] == 1
+    assert [room['name'] for room in db.get_rooms()] == [db.DEFAULT_ROOM]
+    messages = db.get_messages(limit=20, room=db.DEFAULT_ROOM)
+    assert [m['text'] for m in messages] == [f'旧消息 {i}' for i in range(10)]
+    assert db.verify_user('alice', 'secret')[0]
+    conn.close()
+
+
+def test_old_messages_are_searchable_after_backfill(baseline_db):
+    db = Database(baseline_db)
+    if not db.search_enabled:
+        pytest.skip('SQLite 不支持 FTS5 trigram')
+    while db.backfill_search_index():
+        pass
+    messages, _ = db.search_messages('旧消息 7')
+    assert [m['text'] for m in messages] == ['旧消息 7']
+
+
+def test_migrate_is_noop_at_latest_version(baseline_db):
+    Database(baseline_db)
+    conn = sqlite3.connect(baseline_db)
+    schema = conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall()
+    assert migrations.migrate(conn, None) == (migrations.LATEST_VERSION, migrations.LATEST_VERSION)
+    assert conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall() == schema
+    conn.close()
+
+
+def recording(step, executed):
+    def run(cursor, db):
+        executed.append(step.__name__)
+        step(cursor, db)
+    run.__doc__ = step.__doc__
+    return run
+
+
+def test_resume_from_intermediate_version(baseline_db, monkeypatch):
+    # 只执行过前两步的数据库：从第三步开始执行，已完成的步骤不会重复执行
+    conn = sqlite3.connect(baseline_db, isolation_level=None)
+    for version, step in enumerate(migrations.MIGRATIONS[:2], 1):
+        step(conn.cursor(), DB)
+        conn.execute(f'PRAGMA user_version = {version}')
+    steps, executed = list(migrations.MIGRATIONS), []
+    monkeypatch.setattr(migrations, 'MIGRATIONS', [recording(step, executed) for step in steps])
+    assert migrations.migrate(conn, DB) == (2, migrations.LATEST_VERSION)
+    assert executed == [step.__name__ for step in steps[2:]]
+    assert 'attachment' in columns(conn, 'messages')
+    conn.close()
+
+
+def test_newer_database_is_left_alone(baseline_db):
+    conn = sqlite3.connect(baseline_db)
+    conn.execute(f'PRAGMA user_version = {migrations.LATEST_VERSION + 1}')
+    conn.commit()
+    version = migrations.LATEST_VERSION + 1
+    assert migrations.migrate(conn, None) == (version, version)
+    assert 'room' not in columns(conn, 'messages')
+    conn.close()
+
+
+def test_fresh_database(tmp_path):
+    db = Database(str(tmp_path / 'new.db'))
+    conn = sqlite3.connect(db.db_file)
+    assert migrations.schema_version(conn) == migrations.LATEST_VERSION
+    assert db.verify_user('admin', 'admin123')[0]
+    conn.close()
@@ -0,0 +1,30 @@
+import sys
+import time
+
+from server.profiler import SamplingProfiler
+
+
+def running_samplers():
+    """当前正在执行采样循环的线程数"""
+    count = 0
+    for frame in sys._current_frames().values():
+        while frame is not None:
+            if frame.f_code is SamplingProfiler._sample_loop.__code__:
+                count += 1
+                break
+            frame = frame.f_back
+    return count
+
+
+def test_restart_does_not_leave_two_samplers(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path), interval=0.05)
+    assert profiler.start()[0]
+    time.sleep(0.01)
+    assert profiler.stop()[0]
+    # 旧的采样线程还在 sleep 中，立即重新开始
+    assert profiler.start()[0]
+    time.sleep(0.2)
+    assert running_samplers() == 1
+    assert profiler.stop()[0]
+    time.sleep(0.2)
+    assert running_samplers() == 0
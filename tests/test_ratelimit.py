@@ -0,0 +1,95 @@
+import pytest
+
+from server import ratelimit
+from server.ratelimit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """只替换 ratelimit 模块使用的时钟"""
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+
+def drain(limiter, key, rate, burst):
+    """连续请求直到被拒绝，返回放行的次数"""
+    allowed = 0
+    while limiter.allow(key, rate, burst):
+        allowed += 1
+    return allowed
+
+
+def test_burst_then_throttled(clock):
+    limiter = RateLimiter('test')
+    assert drain(limiter, 'sid', rate=1, burst=5) == 5
+    assert not limiter.allow('sid', 1, 5)
+    assert limiter.stats() == {'allowed': 5, 'throttled': 2, 'keys': 1}
+
+
+def test_refill_at_rate(clock):
+    limiter = RateLimiter('test')
+    drain(limiter, 'sid', rate=2, burst=10)
+    clock.advance(0.4)                      # 0.8 个令牌，不够一次
+    assert not limiter.allow('sid', 2, 10)
+    clock.advance(0.1)                      # 累计 1 个令牌
+    assert limiter.allow('sid', 2, 10)
+    assert not limiter.allow('sid', 2, 10)
+    clock.advance(2)
+    assert drain(limiter, 'sid', rate=2, burst=10) == 4
+
+
+def test_refill_capped_at_burst(clock):
+    limiter = RateLimiter('test')
+    drain(limiter, 'sid', rate=5, burst=3)
+    clock.advance(3600)
+    assert drain(limiter, 'sid', rate=5, burst=3) == 3
+
+
+def test_cost_and_independent_keys(clock):
+    limiter = RateLimiter('test')
+    assert limiter.allow('a', 1, 5, cost=4)
+    assert not limiter.allow('a', 1, 5, cost=2)  # 只剩 1 个令牌，被拒绝时不扣除
+    assert limiter.allow('a', 1, 5, cost=1)
+    assert drain(limiter, 'b', rate=1, burst=5) == 5
+
+
+def test_limits_are_per_call(clock):
+    # 同一个限流器对不同键使用不同限额（例如管理员和普通用户）
+    limiter = RateLimiter('test')
+    assert drain(limiter, 'user', rate=1, burst=2) == 2
+    assert drain(limiter, 'admin', rate=10, burst=20) == 20
+    clock.advance(1)
+    assert drain(limiter, 'user', rate=1, burst=2) == 1
+    assert drain(limiter, 'admin', rate=10, burst=20) == 10
+
+
+def test_idle_buckets_are_swept(clock):
+    limiter = RateLimiter('test', idle_ttl=60)
+    drain(limiter, 'idle', rate=1, burst=2)
+    clock.advance(30)
+    limiter.allow('active', 1, 2)
+    clock.advance(45)                       # idle 已 75 秒未使用，active 45 秒
+    limiter.allow('active', 1, 2)
+    assert limiter.stats()['keys'] == 1
+    # 清理后的桶等同于满桶
+    assert drain(limiter, 'idle', rate=1, burst=2) == 2
+
+
+def test_discard_resets_bucket(clock):
+    limiter = RateLimiter('test')
+    drain(limiter, 'sid', rate=1, burst=3)
+    limiter.discard('sid')
+    assert limiter.stats()['keys'] == 0
+    assert drain(limiter, 'sid', rate=1, burst=3) == 3
@@ -0,0 +1,191 @@
+import hashlib
+import io
+import threading
+
+import pytest
+from werkzeug.exceptions import ClientDisconnected
+
+from server.storage import ContentStore
+from server.uploads import UploadManager
+
+DATA = bytes(range(256)) * 40  # 10240 字节
+CHUNK = 4096
+
+
+class DisconnectingStream:
+    """与 Werkzeug 的 LimitedStream 一样，客户端断开后读取时抛出 ClientDisconnected"""
+
+    def __init__(self, data, disconnect_after):
+        self._stream = io.BytesIO(data[:disconnect_after])
+
+    def read(self, size):
+        block = self._stream.read(size)
+        if not block:
+            raise ClientDisconnected()
+        return block
+
+
+def make_manager(tmp_path):
+    return UploadManager(str(tmp_path / 'uploads_tmp'), max_size=1024 * 1024, chunk_size=CHUNK)
+
+
+def make_store(tmp_path):
+    return ContentStore(str(tmp_path / 'uploads'), str(tmp_path / 'uploads_tmp'))
+
+
+def finalize(manager, session, store):
+    def put(source, sha256, size):
+        with store.lock():
+            path, created = store.put(source, sha256, 'bin')
+        return {'path': path, 'created': created, 'sha256': sha256, 'filesize': size}
+    return manager.finalize(session, put)
+
+
+def write(manager, session, offset, data, length=None):
+    return manager.write_chunk(session, offset, io.BytesIO(data), len(data) if length is None else length)
+
+
+def upload_rest(manager, session):
+    while session.received < len(DATA):
+        offset = session.received
+        ok, _ = write(manager, session, offset, DATA[offset:offset + CHUNK])
+        assert ok
+
+
+def test_chunk_must_start_at_received_offset(tmp_path):
+    manager = make_manager(tmp_path)
+    ok, session = manager.init(1, 'a.bin', len(DATA), 'chat_room')
+    assert ok
+    assert write(manager, session, 0, DATA[:CHUNK]) == (True, CHUNK)
+
+    # 重发已接收的分片或跳过一段都会被拒绝，并告知服务器已接收的字节数
+    ok, msg = write(manager, session, 0, DATA[:CHUNK])
+    assert not ok and str(CHUNK) in msg
+    ok, _ = write(manager, session, 2 * CHUNK, DATA[2 * CHUNK:3 * CHUNK])
+    assert not ok
+    assert session.received == CHUNK
+
+
+def test_invalid_chunk_sizes_are_rejected(tmp_path):
+    manager = make_manager(tmp_path)
+    _, session = manager.init(1, 'a.bin', len(DATA), 'chat_room')
+    assert not write(manager, session, 0, DATA[:CHUNK + 1])[0]          # 超过分片大小
+    _, small = manager.init(1, 'b.bin', 100, 'chat_room')
+    assert not write(manager, small, 0, DATA[:200], length=200)[0]      # 超出文件大小
+    assert not manager.init(1, 'c.bin', 2 * 1024 * 1024, 'chat_room')[0]
+    assert session.received == 0 and small.received == 0
+
+
+def test_interrupted_chunk_keeps_received_bytes(tmp_path):
+    manager = make_manager(tmp_path)
+    manager.READ_SIZE = 256
+    _, session = manager.init(1, 'a.bin', len(DATA), 'chat_room')
+    # 声明 4096 字节但连接在 1000 字节后断开：已读取的 1000 字节保留
+    stream = DisconnectingStream(DATA[:CHUNK], disconnect_after=1000)
+    ok, msg = manager.write_chunk(session, 0, stream, CHUNK)
+    assert not ok and '1000' in msg
+    assert session.received == 1000
+    # 客户端从错误的位置重试会被拒绝，从服务器报告的位置续传
+    stream = DisconnectingStream(DATA[1000:1000 + CHUNK], disconnect_after=2000)
+    ok, msg = manager.write_chunk(session, 1000, stream, CHUNK)
+    assert not ok and session.received == 3000
+
+    store = make_store(tmp_path)
+    ok, msg = finalize(manager, session, store)
+    assert not ok  # 未上传完成
+
+    upload_rest(manager, session)
+    ok, info = finalize(manager, session, store)
+    assert ok
+    assert info['sha256'] == hashlib.sha256(DATA).hexdigest()
+    with open(store.path(info['path']), 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_unexpected_error_rebuilds_hash_from_part_file(tmp_path):
+    manager = make_manager(tmp_path)
+    manager.READ_SIZE = 256
+
+    class FailingStream(DisconnectingStream):
+        def read(self, size):
+            block = self._stream.read(size)
+            if not block:
+                raise ValueError('unexpected')
+            return block
+
+    _, session = manager.init(1, 'a.bin', len(DATA), 'chat_room')
+    with pytest.raises(ValueError):
+        manager.write_chunk(session, 0, FailingStream(DATA[:CHUNK], disconnect_after=600), CHUNK)
+    assert session.received == 600 and session.sha256 is None
+
+    upload_rest(manager, session)
+    ok, info = finalize(manager, session, make_store(tmp_path))
+    assert ok and info['sha256'] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_resume_in_another_process(tmp_path):
+    first = make_manager(tmp_path)
+    _, session = first.init(7, 'a.bin', len(DATA), 'chat_room')
+    write(first, session, 0, DATA[:CHUNK])
+
+    # 新的 UploadManager 相当于重启后或其他进程：会话从磁盘恢复，进度以 .part 文件大小为准
+    second = make_manager(tmp_path)
+    assert second.get(session.upload_id, 8) is None  # 其他用户不能续传
+    resumed = second.get(session.upload_id, 7)
+    assert resumed is not session
+    assert resumed.received == CHUNK
+    assert not write(second, resumed, 0, DATA[:CHUNK])[0]
+
+    upload_rest(second, resumed)
+    ok, info = finalize(second, resumed, make_store(tmp_path))
+    assert ok
+    # 增量哈希按已接收的数据重建
+    assert info['sha256'] == hashlib.sha256(DATA).hexdigest()
+    assert second.get(session.upload_id, 7) is None
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    manager = make_manager(tmp_path)
+    store = make_store(tmp_path)
+    paths = []
+    for name in ('a.bin', 'b.bin'):
+        _, session = manager.init(1, name, len(DATA), 'chat_room')
+        upload_rest(manager, session)
+        ok, info = finalize(manager, session, store)
+        assert ok
+        paths.append((info['path'], info['created']))
+    assert paths[0][0] == paths[1][0]
+    assert [created for _, created in paths] == [True, False]
+
+
+def test_failed_store_keeps_session(tmp_path):
+    manager = make_manager(tmp_path)
+    _, session = manager.init(1, 'a.bin', len(DATA), 'chat_room')
+    upload_rest(manager, session)
+
+    def broken(source, sha256, size):
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        manager.finalize(session, broken)
+    # 会话和已接收的数据都还在，客户端可以重试
+    assert manager.get(session.upload_id, 1) is session
+    ok, info = finalize(manager, session, make_store(tmp_path))
+    assert ok and info['created']
+
+
+def test_content_lock_is_shared_between_stores(tmp_path):
+    # 两个 ContentStore 相当于两个进程：一方持有锁时另一方等待
+    first, second = make_store(tmp_path), make_store(tmp_path)
+    acquired = threading.Event()
+
+    def take_lock():
+        with second.lock():
+            acquired.set()
+
+    with first.lock():
+        thread = threading.Thread(target=take_lock)
+        thread.start()
+        assert not acquired.wait(0.2)
+    assert acquired.wait(5)
+    thread.join()